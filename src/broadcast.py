@@ -0,0 +1,346 @@
+"""
+Рассылка сообщения всем пользователям бота.
+
+Получатели читаются пачками по первичному ключу users, пул воркеров
+отправляет их через общий с Notifier token bucket, так что рассылка
+и уведомления вместе не превышают лимит Telegram. Прогресс и чекпоинт
+периодически сохраняются в таблицу broadcasts и выводятся в сообщение
+админа; после рестарта незавершенные рассылки продолжаются с чекпоинта
+(повторно могут уйти лишь сообщения, отправленные после последнего
+сохранения).
+
+Рассылки ведет только ведущая реплика (run() — служба TaskRunner), иначе
+каждая реплика слала бы со своим лимитом. create() на любой реплике лишь
+добавляет строку, а триггер broadcast_created будит ведущую. Она арендует
+строку broadcasts (owner, lease_until) и продлевает аренду при каждом
+сохранении прогресса; рассылки упавшей реплики забирает resume() новой
+ведущей.
+"""
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from collections import OrderedDict
+from datetime import timedelta
+import asyncio
+import os
+import socket
+import time
+import uuid
+
+from database import Database
+from metrics import Counter
+from notifications import NOTIFY_GLOBAL_RATE, TokenBucket
+
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))
+BROADCAST_PROGRESS_INTERVAL = float(
+    os.getenv("BROADCAST_PROGRESS_INTERVAL_SECONDS", "5")
+)
+BROADCAST_MAX_ATTEMPTS = 3
+# Должна заметно превышать BROADCAST_PROGRESS_INTERVAL: аренда продлевается
+# при каждом сохранении прогресса
+BROADCAST_LEASE = timedelta(seconds=float(os.getenv("BROADCAST_LEASE_SECONDS", "60")))
+
+BROADCAST_MESSAGES = Counter(
+    "bot_broadcast_messages_total",
+    "Сообщения рассылок по результату",
+    ("result",),
+)
+
+STATUS_TITLES = {
+    "running": "⏳ идет",
+    "done": "✅ завершена",
+    "cancelled": "⏹ остановлена",
+}
+
+
+class BroadcastRun:
+    """Состояние одной выполняющейся рассылки"""
+
+    def __init__(self, broadcast, total: int):
+        self.id = broadcast["id"]
+        self.text = broadcast["text"]
+        self.admin_chat_id = broadcast["admin_chat_id"]
+        self.status_message_id = broadcast["status_message_id"]
+        self.delivered = broadcast["delivered"]
+        self.blocked = broadcast["blocked"]
+        self.failed = broadcast["failed"]
+        self.checkpoint = broadcast["last_user_id"]
+        self.total = total
+        self.cancelled = False
+        self.lease_lost = False
+        self.started_at = time.monotonic()
+        self.processed_at_start = self.processed
+        # user_id в порядке выдачи -> отправлено ли; чекпоинт двигается
+        # только по непрерывному префиксу отправленных
+        self._in_flight = OrderedDict()
+
+    @property
+    def processed(self) -> int:
+        return self.delivered + self.blocked + self.failed
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started_at
+        if elapsed <= 0:
+            return 0.0
+        return (self.processed - self.processed_at_start) / elapsed
+
+    def dispatched(self, user_id: int):
+        self._in_flight[user_id] = False
+
+    def done(self, user_id: int):
+        self._in_flight[user_id] = True
+        while self._in_flight:
+            first_id, is_done = next(iter(self._in_flight.items()))
+            if not is_done:
+                break
+            self._in_flight.popitem(last=False)
+            self.checkpoint = first_id
+
+    def progress_text(self, status: str = "running") -> str:
+        text = (
+            f"📣 <b>Рассылка #{self.id}</b>: {STATUS_TITLES.get(status, status)}\n"
+            f"Обработано: {self.processed} из {self.total}\n"
+            f"📬 Доставлено: {self.delivered}\n"
+            f"🚫 Заблокировали бота: {self.blocked}\n"
+            f"⚠️ Ошибки: {self.failed}\n"
+        )
+        rate = self.rate()
+        if status == "running":
+            text += f"⚡ Скорость: {rate:.1f} сообщ./с"
+            left = self.total - self.processed
+            if rate > 0 and left > 0:
+                text += f", осталось ~{left / rate / 60:.0f} мин."
+        return text
+
+
+class Broadcaster:
+    def __init__(
+        self,
+        db: Database,
+        bot: Bot,
+        bucket: TokenBucket = None,
+        workers: int = BROADCAST_WORKERS,
+    ):
+        self.db = db
+        self.bot = bot
+        self.bucket = bucket if bucket is not None else TokenBucket(NOTIFY_GLOBAL_RATE)
+        self.workers = workers
+        self.runs = {}
+        self._tasks = {}
+        self._wakeup = asyncio.Event()
+        # Уникален для процесса: после рестарта старая аренда не считается своей
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    async def create(self, text: str, admin_chat_id: int, status_message_id: int):
+        """Создает рассылку; запустит ее run() ведущей реплики"""
+        return await self.db.create_broadcast(text, admin_chat_id, status_message_id)
+
+    def wake(self):
+        """Появилась новая рассылка — забрать ее, не дожидаясь BROADCAST_LEASE"""
+        self._wakeup.set()
+
+    async def run(self):
+        """
+        Служба ведущей реплики: забирает рассылки без владельца при wake()
+        и раз в BROADCAST_LEASE. При отмене отпускает свои рассылки.
+        """
+        try:
+            while True:
+                self._wakeup.clear()
+                try:
+                    await self.resume()
+                except Exception as e:
+                    print(f"Не удалось забрать рассылки: {e}")
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), BROADCAST_LEASE.total_seconds()
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.stop()
+
+    async def resume(self):
+        """Забирает и продолжает рассылки без живого владельца"""
+        for broadcast in await self.db.claim_broadcasts(self.owner, BROADCAST_LEASE):
+            self.start(broadcast)
+
+    def start(self, broadcast):
+        broadcast_id = broadcast["id"]
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._forget(broadcast_id))
+
+    def _forget(self, broadcast_id: int):
+        self._tasks.pop(broadcast_id, None)
+        self.runs.pop(broadcast_id, None)
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        cancelled = await self.db.cancel_broadcast(broadcast_id)
+        run = self.runs.get(broadcast_id)
+        if run is not None:
+            run.cancelled = True
+        return cancelled
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, broadcast):
+        remaining = await self.db.count_broadcast_recipients(broadcast["last_user_id"])
+        run = BroadcastRun(
+            broadcast,
+            total=broadcast["delivered"]
+            + broadcast["blocked"]
+            + broadcast["failed"]
+            + remaining,
+        )
+        self.runs[run.id] = run
+
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [
+            asyncio.create_task(self._worker(queue, run)) for _ in range(self.workers)
+        ]
+        reporter = asyncio.create_task(self._report_loop(run))
+        try:
+            after_user_id = run.checkpoint
+            while not run.cancelled:
+                user_ids = await self.db.get_broadcast_recipients(
+                    after_user_id, BROADCAST_BATCH_SIZE
+                )
+                if not user_ids:
+                    break
+                for user_id in user_ids:
+                    if run.cancelled:
+                        break
+                    run.dispatched(user_id)
+                    await queue.put(user_id)
+                after_user_id = user_ids[-1]
+            await queue.join()
+
+            reporter.cancel()
+            if run.lease_lost:
+                return
+            status = await self._save(
+                run, "cancelled" if run.cancelled else "done", release=True
+            )
+            if status is not None:
+                await self._show_progress(run, status)
+        except asyncio.CancelledError:
+            # Бот останавливается — сохраняем чекпоинт и отпускаем рассылку
+            await self._save(run, release=True)
+            raise
+        except Exception as e:
+            print(f"Ошибка рассылки #{run.id}: {e}")
+            await self._save(run, release=True)
+        finally:
+            reporter.cancel()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(reporter, *workers, return_exceptions=True)
+
+    async def _worker(self, queue: asyncio.Queue, run: BroadcastRun):
+        while True:
+            user_id = await queue.get()
+            try:
+                if not run.cancelled:
+                    await self._send(run, user_id)
+            except Exception as e:
+                print(f"Ошибка отправки рассылки #{run.id} пользователю {user_id}: {e}")
+                run.failed += 1
+            finally:
+                run.done(user_id)
+                queue.task_done()
+
+    async def _send(self, run: BroadcastRun, user_id: int):
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(user_id, run.text)
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest):
+                # Бот заблокирован или чат удален — повтор не поможет
+                run.blocked += 1
+                BROADCAST_MESSAGES.inc("blocked")
+                return
+            except Exception as e:
+                if attempt + 1 == BROADCAST_MAX_ATTEMPTS:
+                    print(f"Рассылка #{run.id}: не доставлено {user_id}: {e}")
+                    break
+                await asyncio.sleep(2**attempt)
+            else:
+                run.delivered += 1
+                BROADCAST_MESSAGES.inc("delivered")
+                return
+        run.failed += 1
+        BROADCAST_MESSAGES.inc("failed")
+
+    async def _save(
+        self, run: BroadcastRun, finish_status: str = None, release: bool = False
+    ):
+        """Статус рассылки или None, если ее уже ведет другая реплика"""
+        try:
+            return await self.db.save_broadcast_progress(
+                run.id,
+                self.owner,
+                run.checkpoint,
+                run.delivered,
+                run.blocked,
+                run.failed,
+                finish_status=finish_status,
+                lease=None if release else BROADCAST_LEASE,
+            )
+        except Exception as e:
+            print(f"Не удалось сохранить прогресс рассылки #{run.id}: {e}")
+            return "running"
+
+    async def _report_loop(self, run: BroadcastRun):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            status = await self._save(run)
+            if status is None:
+                # Аренду не продлили вовремя, и рассылку забрала другая реплика
+                print(f"Рассылка #{run.id} перешла к другой реплике")
+                run.lease_lost = True
+                run.cancelled = True
+                return
+            if status != "running":
+                run.cancelled = True
+            await self._show_progress(run, status)
+
+    async def _show_progress(self, run: BroadcastRun, status: str):
+        reply_markup = None
+        if status == "running":
+            reply_markup = InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text="⏹ Остановить", callback_data=f"bcast_stop:{run.id}"
+                        )
+                    ]
+                ]
+            )
+        try:
+            await self.bucket.acquire()
+            await self.bot.edit_message_text(
+                run.progress_text(status),
+                chat_id=run.admin_chat_id,
+                message_id=run.status_message_id,
+                reply_markup=reply_markup,
+            )
+        except TelegramBadRequest:
+            # Текст не изменился или сообщение удалено
+            pass
+        except Exception as e:
+            print(f"Не удалось обновить прогресс рассылки #{run.id}: {e}")
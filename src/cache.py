@@ -0,0 +1,70 @@
+from collections import OrderedDict
+import time
+
+
+class ProductCache:
+    """
+    LRU-кэш карточек товаров внутри процесса.
+
+    Карточка (название, цена, описание) живет ttl секунд, а остаток — только
+    stock_ttl секунд: после этого get отдает карточку с stock_fresh=False,
+    и остаток нужно перечитать из БД.
+    """
+
+    def __init__(self, max_size: int, ttl: float, stock_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stock_ttl = stock_ttl
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stock_refreshes = 0
+
+    def get(self, product_id: int):
+        """Возвращает (product, stock_fresh) или (None, False)"""
+        entry = self._items.get(product_id)
+        now = time.monotonic()
+        if entry is None or now - entry[1] > self.ttl:
+            self._items.pop(product_id, None)
+            self.misses += 1
+            return None, False
+
+        self._items.move_to_end(product_id)
+        product, _, stock_at = entry
+        stock_fresh = now - stock_at <= self.stock_ttl
+        if stock_fresh:
+            self.hits += 1
+        else:
+            self.stock_refreshes += 1
+        return product, stock_fresh
+
+    def put(self, product):
+        if product is None:
+            return
+        now = time.monotonic()
+        self._items[product["id"]] = (dict(product), now, now)
+        self._items.move_to_end(product["id"])
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def set_stock(self, product_id: int, stock: int):
+        entry = self._items.get(product_id)
+        if entry is None:
+            return
+        product, cached_at, _ = entry
+        product["stock"] = stock
+        self._items[product_id] = (product, cached_at, time.monotonic())
+
+    def invalidate(self, product_id: int):
+        self._items.pop(product_id, None)
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stock_refreshes": self.stock_refreshes,
+        }
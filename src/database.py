@@ -1,9 +1,16 @@
+import asyncio
 import asyncpg
+from contextlib import asynccontextmanager
+from datetime import timedelta
 from decimal import Decimal
 from dotenv import load_dotenv
 import os
+import time
 
 from other import *
+from metrics import Counter, Histogram, add_dependency_time
+from cache import ProductCache
+from migrations import apply_migrations
 
 load_dotenv()
 
@@ -13,133 +20,457 @@ DB_NAME = os.getenv("DB_NAME")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))
+# Кэш подготовленных выражений на соединение: все запросы Database в него помещаются
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+DB_CONNECT_ATTEMPTS = int(os.getenv("DB_CONNECT_ATTEMPTS", "10"))
+DB_CONNECT_MAX_DELAY = float(os.getenv("DB_CONNECT_MAX_DELAY", "30"))
+# Для долгих операций (массовая загрузка), которым не хватит DB_COMMAND_TIMEOUT
+DB_LONG_COMMAND_TIMEOUT = float(os.getenv("DB_LONG_COMMAND_TIMEOUT", "3600"))
+
+PAYMENT_TTL = timedelta(hours=int(os.getenv("PAYMENT_TTL_HOURS", "24")))
+PAYMENT_CHECK_BASE_DELAY = timedelta(
+    seconds=int(os.getenv("PAYMENT_CHECK_BASE_DELAY_SECONDS", "60"))
+)
+PAYMENT_CHECK_MAX_DELAY = timedelta(
+    seconds=int(os.getenv("PAYMENT_CHECK_MAX_DELAY_SECONDS", "3600"))
+)
+
+# Зачисление платежей: $1 — метки, $2 — описание транзакции
+CREDIT_PAYMENTS_SQL = """
+WITH credited AS (
+    UPDATE payments SET is_paid = TRUE
+    WHERE label = ANY($1::text[]) AND is_paid = FALSE
+    RETURNING user_id, amount, label
+),
+balances AS (
+    UPDATE users u SET balance = u.balance + c.total
+    FROM (
+        SELECT user_id, SUM(amount) AS total
+        FROM credited
+        GROUP BY user_id
+    ) c
+    WHERE u.user_id = c.user_id
+),
+logged AS (
+    INSERT INTO transactions (user_id, amount, description)
+    SELECT user_id, amount, $2 FROM credited
+)
+SELECT user_id, amount, label FROM credited
+"""
+
+# Остаток товара: в шардированном режиме — сумма по goods_stock_shards
+PRODUCT_STOCK_SQL = """
+CASE WHEN g.stock_shards > 0 THEN (
+    SELECT COALESCE(SUM(s.stock), 0)::INT
+    FROM goods_stock_shards s WHERE s.product_id = g.id
+) ELSE g.stock END
+"""
+# Каждая попытка списать из шарда в buy_product — подтранзакция (BEGIN ...
+# EXCEPTION), за проход их не больше shards + 1. Потолок 63 шарда держит
+# покупку в пределах 64 подтранзакций — кэша subxid одного процесса
+# PostgreSQL; при переполнении проверки видимости замедляются у всех сессий
+MAX_STOCK_SHARDS = 63
+PRODUCT_COLUMNS = f"""
+g.id, g.type, g.name, g.description, g.price, g.stock_shards,
+{PRODUCT_STOCK_SQL} AS stock
+"""
+
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+
+DB_QUERY_SECONDS = Histogram(
+    "bot_db_query_seconds", "Время выполнения запроса", ("method",)
+)
+DB_ACQUIRE_WAIT_SECONDS = Histogram(
+    "bot_db_acquire_wait_seconds", "Ожидание соединения из пула", ("method",)
+)
+DB_CONNECTION_HOLD_SECONDS = Histogram(
+    "bot_db_connection_hold_seconds",
+    "Время удержания соединения (весь метод, включая транзакции)",
+    ("method",),
+)
+DB_ROWS = Counter("bot_db_rows_total", "Строк возвращено или изменено", ("method",))
+DB_ERRORS = Counter("bot_db_errors_total", "Ошибки запросов", ("method",))
+DB_SLOW_QUERIES = Counter("bot_db_slow_queries_total", "Медленные запросы", ("method",))
+
+
+def _param_shapes(args) -> str:
+    """Типы и размеры параметров для лога, без самих значений"""
+    shapes = []
+    for arg in args:
+        if isinstance(arg, (list, tuple, str, bytes)):
+            shapes.append(f"{type(arg).__name__}[{len(arg)}]")
+        else:
+            shapes.append(type(arg).__name__)
+    return ", ".join(shapes)
+
+
+def _log_slow(method: str, seconds: float, args=None):
+    DB_SLOW_QUERIES.inc(method)
+    params = f", параметры: ({_param_shapes(args)})" if args is not None else ""
+    print(f"🐢 Медленный запрос {method}: {seconds * 1000:.1f} мс{params}")
+
+
+PRODUCT_CACHE_ENABLED = os.getenv("PRODUCT_CACHE_ENABLED", "1") == "1"
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "10000"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL_SECONDS", "300"))
+PRODUCT_STOCK_TTL = float(os.getenv("PRODUCT_STOCK_TTL_SECONDS", "5"))
+
 
 class Database:
     def __init__(self):
         self.pool = None
+        self.product_cache = (
+            ProductCache(PRODUCT_CACHE_SIZE, PRODUCT_CACHE_TTL, PRODUCT_STOCK_TTL)
+            if PRODUCT_CACHE_ENABLED
+            else None
+        )
+        self.acquire_count = 0
+        self.acquire_waiting = 0
+        self.acquire_wait_total = 0.0
+        self.acquire_wait_max = 0.0
 
     async def connect(self):
+        """Создает пул; пока БД недоступна, повторяет с растущей задержкой"""
+        delay = 1.0
+        for attempt in range(1, DB_CONNECT_ATTEMPTS + 1):
+            try:
+                self.pool = await asyncpg.create_pool(
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    database=DB_NAME,
+                    host=DB_HOST,
+                    port=int(DB_PORT),
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+                    statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                    command_timeout=DB_COMMAND_TIMEOUT,
+                    server_settings={"application_name": "shop-bot"},
+                )
+                print("✅ База данных успешно подключена!")
+                return
+            except (OSError, asyncpg.PostgresError) as e:
+                if attempt == DB_CONNECT_ATTEMPTS:
+                    raise
+                print(
+                    f"❌ Ошибка подключения к БД (попытка {attempt}): {e}. "
+                    f"Повтор через {delay:.0f} с."
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, DB_CONNECT_MAX_DELAY)
+
+    @asynccontextmanager
+    async def acquire(self, method: str = "other", log_slow: bool = True):
+        """pool.acquire() с учетом ожидания и времени удержания соединения"""
+        started = time.perf_counter()
+        self.acquire_waiting += 1
         try:
-            self.pool = await asyncpg.create_pool(
-                user=DB_USER,
-                password=DB_PASSWORD,
-                database=DB_NAME,
-                host=DB_HOST,
-                port=int(DB_PORT),
-            )
-            print("✅ База данных успешно подключена!")
-        except Exception as e:
-            print(f"❌ Ошибка подключения к БД: {e}")
-            import sys
+            conn = await self.pool.acquire()
+        finally:
+            self.acquire_waiting -= 1
 
-            sys.exit(1)
+        acquired = time.perf_counter()
+        waited = acquired - started
+        self.acquire_count += 1
+        self.acquire_wait_total += waited
+        self.acquire_wait_max = max(self.acquire_wait_max, waited)
+        DB_ACQUIRE_WAIT_SECONDS.observe(waited, method)
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+            held = time.perf_counter() - acquired
+            DB_CONNECTION_HOLD_SECONDS.observe(held, method)
+            add_dependency_time("db", held + waited)
+            if log_slow and held * 1000 >= DB_SLOW_QUERY_MS:
+                _log_slow(method, held)
 
-    async def _execute(self, query: str, *args):
-        async with self.pool.acquire() as conn:
-            return await conn.execute(query, *args)
+    def pool_stats(self):
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {
+            "size": size,
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "acquired": size - idle,
+            "idle": idle,
+            "waiting": self.acquire_waiting,
+            "acquire_count": self.acquire_count,
+            "acquire_wait_avg_ms": (
+                self.acquire_wait_total / self.acquire_count * 1000
+                if self.acquire_count
+                else 0.0
+            ),
+            "acquire_wait_max_ms": self.acquire_wait_max * 1000,
+        }
 
-    async def _fetch(self, query: str, *args):
-        async with self.pool.acquire() as conn:
-            return await conn.fetch(query, *args)
+    async def _query(self, kind: str, method: str, query: str, args):
+        async with self.acquire(method, log_slow=False) as conn:
+            started = time.perf_counter()
+            try:
+                result = await getattr(conn, kind)(query, *args)
+            except Exception:
+                DB_ERRORS.inc(method)
+                raise
+            elapsed = time.perf_counter() - started
 
-    async def _fetchrow(self, query: str, *args):
-        async with self.pool.acquire() as conn:
-            return await conn.fetchrow(query, *args)
+        DB_QUERY_SECONDS.observe(elapsed, method)
+        if kind == "fetch":
+            rows = len(result)
+        elif kind == "execute":
+            count = result.rsplit(" ", 1)[-1]
+            rows = int(count) if count.isdigit() else 0
+        else:
+            rows = int(result is not None)
+        DB_ROWS.inc(method, amount=rows)
+        if elapsed * 1000 >= DB_SLOW_QUERY_MS:
+            _log_slow(method, elapsed, args)
+        return result
 
-    async def _fetchval(self, query: str, *args):
-        async with self.pool.acquire() as conn:
-            return await conn.fetchval(query, *args)
+    # name — метка метрик запроса: имя метода Database,
+    # у методов FSM-хранилища — с префиксом fsm_
+    async def _execute(self, name: str, query: str, *args):
+        return await self._query("execute", name, query, args)
 
-    async def create_tables(self):
-        query = """
-        CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT PRIMARY KEY,
-            username TEXT,
-            balance NUMERIC(12, 2) DEFAULT 0.00
-        );
-
-        CREATE TABLE IF NOT EXISTS transactions (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT REFERENCES users(user_id),
-            amount NUMERIC(12, 2),
-            description TEXT,
-            created_at TIMESTAMP DEFAULT NOW()
-        );
-        CREATE TABLE IF NOT EXISTS payments (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
-            amount NUMERIC(12, 2),
-            label TEXT UNIQUE,
-            is_paid BOOLEAN DEFAULT FALSE
-        );
-        CREATE TABLE IF NOT EXISTS goods (
-            id SERIAL PRIMARY KEY,
-            type TEXT,
-            name TEXT UNIQUE,
-            description TEXT,
-            price NUMERIC(12, 2),
-            stock INT DEFAULT 0 CHECK (stock >= 0)
-        );
-        CREATE TABLE IF NOT EXISTS orders (
-            id SERIAL PRIMARY KEY,
-            order_code TEXT UNIQUE NOT NULL,
-            user_id BIGINT NOT NULL,
-            product_id INT NOT NULL,
-            price_at_purchase NUMERIC(12, 2) NOT NULL,
-            status TEXT DEFAULT 'paid',
-            created_at TIMESTAMP DEFAULT NOW(),
-            completed_at TIMESTAMP,
-            
-            FOREIGN KEY (user_id) REFERENCES users(user_id),
-            FOREIGN KEY (product_id) REFERENCES goods(id)
-        );
-        """
-        await self._execute(query)
+    async def _fetch(self, name: str, query: str, *args):
+        return await self._query("fetch", name, query, args)
+
+    async def _fetchrow(self, name: str, query: str, *args):
+        return await self._query("fetchrow", name, query, args)
+
+    async def _fetchval(self, name: str, query: str, *args):
+        return await self._query("fetchval", name, query, args)
+
+    async def migrate(self):
+        """Доводит схему БД до последней версии из migrations.py"""
+        await apply_migrations(self.pool)
 
     async def register_user(self, user_id: int, username):
+        """Регистрирует пользователя и возвращает его строку одним запросом.
+
+        Повторный /start ничего не пишет: существующая строка берется
+        из снимка того же запроса. Если два первых /start пришли разом,
+        проигравший INSERT дождется победителя, но его снимок новую строку
+        не видит — тогда читаем ее вторым запросом.
+        """
         query = """
-        INSERT INTO users (user_id, username)
-        VALUES ($1, $2)
-        ON CONFLICT (user_id) DO NOTHING
+        WITH ins AS (
+            INSERT INTO users (user_id, username)
+            VALUES ($1, $2)
+            ON CONFLICT (user_id) DO NOTHING
+            RETURNING *
+        )
+        SELECT * FROM ins
+        UNION ALL
+        SELECT * FROM users WHERE user_id = $1 AND NOT EXISTS (SELECT 1 FROM ins)
         """
-        await self._execute(query, user_id, username)
+        user = await self._fetchrow("register_user", query, user_id, username)
+        if user is None:
+            user = await self.get_user(user_id)
+        return user
 
     async def get_user(self, user_id: int):
         query = """
         SELECT * FROM users WHERE user_id = $1"""
-        return await self._fetchrow(query, user_id)
+        return await self._fetchrow("get_user", query, user_id)
+
+    async def get_profile(self, user_id: int):
+        """Пользователь, баланс, последний заказ и число заказов за один запрос.
+
+        Оба LATERAL-подзапроса идут по idx_orders_user_created_id.
+        Возвращает None, если пользователь не зарегистрирован.
+        """
+        query = """
+        SELECT
+            u.user_id, u.username, u.balance,
+            lo.order_code, lo.status, lo.created_at, lo.completed_at,
+            lo.product_name,
+            oc.orders_count
+        FROM users u
+        LEFT JOIN LATERAL (
+            SELECT
+                o.order_code, o.status, o.created_at, o.completed_at,
+                g.name AS product_name
+            FROM orders o
+            JOIN goods g ON o.product_id = g.id
+            WHERE o.user_id = u.user_id
+            ORDER BY o.created_at DESC, o.id DESC
+            LIMIT 1
+        ) lo ON TRUE
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) AS orders_count FROM orders o WHERE o.user_id = u.user_id
+        ) oc
+        WHERE u.user_id = $1
+        """
+        return await self._fetchrow("get_profile", query, user_id)
 
     async def get_balance(self, user_id: int):
         query = "SELECT balance FROM users WHERE user_id = $1"
-        balance = await self._fetchval(query, user_id)
+        balance = await self._fetchval("get_balance", query, user_id)
         return balance if balance is not None else 0
 
     async def create_payment(self, user_id: int, amount: Decimal, label: str):
-        """Создает запись о платеже в БД"""
+        """Создает запись о платеже в БД, счет действует PAYMENT_TTL"""
         query = """
-        INSERT INTO payments (user_id, amount, label)
-        VALUES ($1, $2, $3)
+        INSERT INTO payments (user_id, amount, label, expires_at)
+        VALUES ($1, $2, $3, NOW() + $4::interval)
         RETURNING id
         """
-        return await self._fetchval(query, user_id, amount, label)
+        return await self._fetchval(
+            "create_payment", query, user_id, amount, label, PAYMENT_TTL
+        )
 
     async def get_payment(self, label: str):
         """Получает данные о платеже по его метке"""
         query = "SELECT * FROM payments WHERE label = $1;"
-        return await self._fetchrow(query, label)
+        return await self._fetchrow("get_payment", query, label)
 
-    async def set_payment_paid(self, label: str):
-        """Помечает платеж как исполненный"""
-        query = "UPDATE payments SET is_paid = TRUE WHERE label = $1;"
-        await self._execute(query, label)
+    async def get_archived_payment(self, label: str):
+        """Просроченный счет из payments_archive (оплату могли прислать позже)"""
+        query = "SELECT * FROM payments_archive WHERE label = $1"
+        return await self._fetchrow("get_archived_payment", query, label)
 
     async def get_unpaid_payments(self):
-        """Возвращает список всех неоплаченных платежей"""
-        query = "SELECT user_id, amount, label FROM payments WHERE is_paid = FALSE;"
-        return await self._fetch(query)
+        """
+        Возвращает неоплаченные платежи, которые пора проверить.
+        created_at — время с часовым поясом (столбец хранит время сервера БД)
+        """
+        query = """
+        SELECT user_id, amount, label, created_at::timestamptz AS created_at
+        FROM payments
+        WHERE is_paid = FALSE AND next_check_at <= NOW()
+        """
+        return await self._fetch("get_unpaid_payments", query)
+
+    async def get_next_payment_check_delay(self):
+        """Секунд до ближайшей проверки неоплаченного счета или None"""
+        query = """
+        SELECT EXTRACT(EPOCH FROM MIN(next_check_at) - NOW())::float
+        FROM payments
+        WHERE is_paid = FALSE
+        """
+        return await self._fetchval("get_next_payment_check_delay", query)
+
+    async def postpone_payment_checks(self, labels: list[str]):
+        """
+        Откладывает следующую проверку неоплаченных счетов с экспоненциальной
+        задержкой: base, 2·base, 4·base... но не больше PAYMENT_CHECK_MAX_DELAY
+        и не позже expires_at, чтобы перед архивацией счет проверился еще раз.
+        Передавать только метки, которые ЮMoney действительно не нашел:
+        last_checked_at разрешает архивацию.
+        """
+        query = """
+        UPDATE payments
+        SET check_attempts = check_attempts + 1,
+            last_checked_at = NOW(),
+            next_check_at = LEAST(
+                NOW() + LEAST(
+                    $2::interval * power(2, LEAST(check_attempts, 20)), $3::interval
+                ),
+                expires_at
+            )
+        WHERE label = ANY($1::text[]) AND is_paid = FALSE
+        """
+        await self._execute(
+            "postpone_payment_checks",
+            query,
+            labels,
+            PAYMENT_CHECK_BASE_DELAY,
+            PAYMENT_CHECK_MAX_DELAY,
+        )
+
+    async def archive_expired_payments(self):
+        """
+        Переносит просроченные неоплаченные счета в payments_archive
+        (партиции по месяцу created_at). Счет, который после expires_at
+        еще ни разу не удалось сверить (ЮMoney недоступен), остается
+        в payments до успешной проверки. Возвращает число перенесенных строк.
+        """
+        async with self.acquire("archive_expired_payments") as conn:
+            async with conn.transaction():
+                months = await conn.fetch("""
+                    SELECT DISTINCT date_trunc('month', created_at) AS month
+                    FROM payments
+                    WHERE is_paid = FALSE AND expires_at < NOW()
+                          AND last_checked_at >= expires_at
+                    """)
+                for row in months:
+                    month = row["month"]
+                    next_month = (month + timedelta(days=32)).replace(day=1)
+                    await conn.execute(f"""
+                        CREATE TABLE IF NOT EXISTS payments_archive_{month:%Y_%m}
+                        PARTITION OF payments_archive
+                        FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month:%Y-%m-%d}')
+                        """)
+
+                result = await conn.execute("""
+                    WITH expired AS (
+                        DELETE FROM payments
+                        WHERE is_paid = FALSE AND expires_at < NOW()
+                              AND last_checked_at >= expires_at
+                        RETURNING id, user_id, amount, label, created_at,
+                                  expires_at, check_attempts
+                    )
+                    INSERT INTO payments_archive (
+                        id, user_id, amount, label, created_at,
+                        expires_at, check_attempts
+                    )
+                    SELECT * FROM expired
+                    """)
+                return int(result.split()[-1])
+
+    async def credit_payments(self, labels: list[str], description: str):
+        """
+        Помечает платежи оплаченными и зачисляет деньги одним запросом.
+        Уже оплаченные метки пропускаются: при гонке двух зачислений второе
+        UPDATE дождется блокировки строки, увидит is_paid = TRUE и ничего
+        не начислит. Возвращает зачисленные платежи.
+        """
+        return await self._fetch(
+            "credit_payments", CREDIT_PAYMENTS_SQL, labels, description
+        )
+
+    async def credit_payment(self, label: str, description: str):
+        """
+        Зачисляет один платеж ровно один раз.
+        Возвращает платеж или None, если он уже был зачислен.
+        """
+        credited = await self.credit_payments([label], description)
+        return credited[0] if credited else None
+
+    async def credit_archived_payment(self, label: str, description: str):
+        """
+        Зачисляет оплату, пришедшую после того, как счет ушел в архив:
+        возвращает строку в payments и зачисляет ее в той же транзакции.
+        Возвращает платеж или None, если его уже восстановили и зачислили.
+        """
+        async with self.acquire("credit_archived_payment") as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    WITH restored AS (
+                        DELETE FROM payments_archive
+                        WHERE label = $1
+                        RETURNING id, user_id, amount, label, created_at,
+                                  expires_at, check_attempts
+                    )
+                    INSERT INTO payments (
+                        id, user_id, amount, label, created_at,
+                        expires_at, check_attempts
+                    )
+                    SELECT * FROM restored
+                    """,
+                    label,
+                )
+                credited = await conn.fetch(CREDIT_PAYMENTS_SQL, [label], description)
+        return credited[0] if credited else None
 
     async def add_money(self, user_id: int, amount: Decimal, description: str):
-        async with self.pool.acquire() as conn:
+        async with self.acquire("add_money") as conn:
             async with conn.transaction():
                 await conn.execute(
                     "UPDATE users SET balance = balance + $1 WHERE user_id = $2;",
@@ -155,8 +486,62 @@ class Database:
                 )
 
     async def get_goods(self, limit: int, offset: int):
+        """Старый постраничный вывод через OFFSET, нужен для кнопок page_N"""
         query = "SELECT * FROM goods ORDER BY id LIMIT $1 OFFSET $2"
-        return await self._fetch(query, limit, offset)
+        return await self._fetch("get_goods", query, limit, offset)
+
+    async def get_goods_page(
+        self,
+        limit: int,
+        *,
+        after_id: int = None,
+        before_id: int = None,
+        category_id: int = None,
+    ):
+        """
+        Keyset-пагинация каталога: каждая страница — один проход по индексу id
+        (или (type, id) для категории из goods_categories).
+        Возвращает до limit + 1 товаров, отсортированных по id; лишний
+        товар показывает, что в этом направлении есть еще страница.
+        """
+        category_filter = ""
+        if category_id is not None:
+            category_filter = (
+                "AND type = (SELECT type FROM goods_categories WHERE id = $3)"
+            )
+        args = [limit + 1] + ([category_id] if category_id is not None else [])
+
+        if before_id is not None:
+            query = f"""
+            SELECT * FROM (
+                SELECT id, name, price FROM goods
+                WHERE id < $1 {category_filter}
+                ORDER BY id DESC LIMIT $2
+            ) AS page
+            ORDER BY id
+            """
+            return await self._fetch("get_goods_page", query, before_id, *args)
+
+        query = f"""
+        SELECT id, name, price FROM goods
+        WHERE id > $1 {category_filter}
+        ORDER BY id LIMIT $2
+        """
+        return await self._fetch("get_goods_page", query, after_id or 0, *args)
+
+    async def get_categories(self):
+        """Категории с числом товаров и минимальной ценой из goods_categories"""
+        query = """
+        SELECT id, type, product_count, min_price
+        FROM goods_categories
+        WHERE product_count > 0
+        ORDER BY type
+        """
+        return await self._fetch("get_categories", query)
+
+    def _invalidate_product(self, product_id: int):
+        if self.product_cache is not None:
+            self.product_cache.invalidate(product_id)
 
     async def add_product(
         self, type: str, name: str, description: str, price: Decimal, stock: int
@@ -165,13 +550,151 @@ class Database:
         INSERT INTO goods (type, name, description, price, stock)
         VALUES ($1, $2, $3, $4, $5)
         """
-        await self._execute(query, type, name, description, price, stock)
+        await self._execute("add_product", query, type, name, description, price, stock)
 
-    async def get_product_by_id(self, product_id: int):
+    async def import_goods(self, records, max_errors: int = 20):
+        """
+        Массовая загрузка товаров: records (line, type, name, description,
+        price, stock, error) потоком уходят через COPY во временную таблицу,
+        проверяются одним запросом и вставляются/обновляются по name.
+        Возвращает (число загруженных, число ошибок, первые max_errors ошибок).
+        """
+        async with self.acquire("import_goods") as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    CREATE TEMP TABLE goods_import (
+                        line INT, type TEXT, name TEXT, description TEXT,
+                        price TEXT, stock TEXT, error TEXT
+                    ) ON COMMIT DROP
+                    """,
+                    timeout=DB_LONG_COMMAND_TIMEOUT,
+                )
+                await conn.copy_records_to_table(
+                    "goods_import", records=records, timeout=DB_LONG_COMMAND_TIMEOUT
+                )
+
+                await conn.execute(
+                    """
+                    UPDATE goods_import SET error = CASE
+                        WHEN COALESCE(name, '') = '' THEN 'пустое название'
+                        WHEN COALESCE(type, '') = '' THEN 'пустая категория'
+                        WHEN length(COALESCE(description, '')) > 600
+                            THEN 'описание длиннее 600 символов'
+                        WHEN COALESCE(price, '') !~ '^[0-9]{1,10}([.,][0-9]{1,2})?$'
+                            THEN 'некорректная цена: ' || COALESCE(price, '')
+                        WHEN replace(price, ',', '.')::NUMERIC <= 0
+                            THEN 'цена должна быть больше нуля'
+                        WHEN COALESCE(stock, '') !~ '^[0-9]{1,9}$'
+                            THEN 'некорректный остаток: ' || COALESCE(stock, '')
+                    END
+                    WHERE error IS NULL
+                    """,
+                    timeout=DB_LONG_COMMAND_TIMEOUT,
+                )
+
+                result = await conn.execute(
+                    """
+                    INSERT INTO goods (type, name, description, price, stock)
+                    SELECT DISTINCT ON (name)
+                        type, name, description,
+                        replace(price, ',', '.')::NUMERIC(12, 2), stock::INT
+                    FROM goods_import
+                    WHERE error IS NULL
+                    ORDER BY name, line DESC
+                    ON CONFLICT (name) DO UPDATE SET
+                        type = EXCLUDED.type,
+                        description = EXCLUDED.description,
+                        price = EXCLUDED.price,
+                        stock = EXCLUDED.stock
+                    """,
+                    timeout=DB_LONG_COMMAND_TIMEOUT,
+                )
+                imported = int(result.split()[-1])
+
+                # У шардированных товаров остаток нужно разложить по шардам
+                await conn.execute(
+                    """
+                    SELECT set_product_stock(g.id, g.stock)
+                    FROM goods g
+                    WHERE g.stock_shards > 0 AND g.name IN (
+                        SELECT name FROM goods_import WHERE error IS NULL
+                    )
+                    """,
+                    timeout=DB_LONG_COMMAND_TIMEOUT,
+                )
+
+                error_count = await conn.fetchval(
+                    "SELECT COUNT(*) FROM goods_import WHERE error IS NOT NULL"
+                )
+                errors = await conn.fetch(
+                    """
+                    SELECT line, error FROM goods_import
+                    WHERE error IS NOT NULL
+                    ORDER BY line
+                    LIMIT $1
+                    """,
+                    max_errors,
+                )
+
+        if self.product_cache is not None:
+            self.product_cache.clear()
+        return imported, error_count, errors
+
+    async def search_goods(self, text: str, limit: int, offset: int = 0):
+        """
+        Поиск товаров по названию, категории и описанию: полнотекстовый
+        (GIN по search_vector) плюс нечеткий по названию через pg_trgm,
+        чтобы находить товары с опечатками. Результаты отсортированы
+        по релевантности; возвращает до limit + 1 товаров.
+        """
         query = """
-        SELECT * FROM goods WHERE id = $1
+        WITH q AS (SELECT websearch_to_tsquery('russian', $1) AS tsq),
+        matches AS (
+            SELECT g.id, ts_rank(g.search_vector, q.tsq) + 1 AS rank
+            FROM goods g, q
+            WHERE g.search_vector @@ q.tsq
+            UNION ALL
+            SELECT g.id, similarity(g.name, $1) AS rank
+            FROM goods g
+            WHERE g.name % $1
+        ),
+        ranked AS (
+            SELECT id, MAX(rank) AS rank
+            FROM matches
+            GROUP BY id
+            ORDER BY rank DESC, id
+            LIMIT $2 OFFSET $3
+        )
+        SELECT g.id, g.name, g.price
+        FROM ranked r
+        JOIN goods g ON g.id = r.id
+        ORDER BY r.rank DESC, r.id
         """
-        return await self._fetchrow(query, product_id)
+        return await self._fetch("search_goods", query, text, limit + 1, offset)
+
+    async def get_product_by_id(self, product_id: int):
+        query = f"SELECT {PRODUCT_COLUMNS} FROM goods g WHERE g.id = $1"
+        if self.product_cache is None:
+            return await self._fetchrow("get_product_by_id", query, product_id)
+
+        product, stock_fresh = self.product_cache.get(product_id)
+        if product is None:
+            product = await self._fetchrow("get_product_by_id", query, product_id)
+            self.product_cache.put(product)
+            return product
+
+        if not stock_fresh:
+            stock = await self._fetchval(
+                "get_product_by_id",
+                f"SELECT {PRODUCT_STOCK_SQL} FROM goods g WHERE g.id = $1",
+                product_id,
+            )
+            if stock is None:
+                self.product_cache.invalidate(product_id)
+                return None
+            self.product_cache.set_stock(product_id, stock)
+        return product
 
     async def edit_product(
         self,
@@ -182,80 +705,152 @@ class Database:
         price: Decimal,
         stock: int,
     ):
-        query = """
-        UPDATE goods SET type = $2, name = $3, description = $4, price = $5, stock = $6
-        WHERE id = $1
-        """
-        await self._execute(query, product_id, type, name, description, price, stock)
+        async with self.acquire("edit_product") as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    UPDATE goods SET type = $2, name = $3, description = $4, price = $5
+                    WHERE id = $1
+                    """,
+                    product_id,
+                    type,
+                    name,
+                    description,
+                    price,
+                )
+                await conn.execute(
+                    "SELECT set_product_stock($1, $2)", product_id, stock
+                )
+        self._invalidate_product(product_id)
 
     async def update_stock(self, product_id: int, stock: int):
-        query = """
-        UPDATE goods SET stock = $1 WHERE id = $2
-        """
-        await self._execute(query, stock, product_id)
+        """Задает остаток; у шардированного товара он заново делится по шардам"""
+        await self._execute(
+            "update_stock", "SELECT set_product_stock($1, $2)", product_id, stock
+        )
+        self._invalidate_product(product_id)
 
-    async def buy_product(self, user_id: int, product_id: int, price: Decimal):
-        async with self.pool.acquire() as conn:
+    async def set_stock_shards(self, product_id: int, shards: int):
+        """
+        Включает (shards > 0) или выключает (shards = 0) шардированный остаток.
+        Текущий остаток сохраняется и перераспределяется по новым шардам.
+        """
+        if not 0 <= shards <= MAX_STOCK_SHARDS:
+            raise ValueError(f"Число шардов должно быть от 0 до {MAX_STOCK_SHARDS}")
+        async with self.acquire("set_stock_shards") as conn:
             async with conn.transaction():
-                user_update = await conn.execute(
-                    "UPDATE users SET balance = balance - $1 WHERE user_id = $2 AND balance >= $1",
-                    price,
-                    user_id,
+                found = await conn.fetchval(
+                    "SELECT TRUE FROM goods WHERE id = $1 FOR NO KEY UPDATE", product_id
                 )
-                if user_update == "UPDATE 0":
-                    return "low_balance", None
-
-                stock_update = await conn.execute(
-                    "UPDATE goods SET stock = stock - 1 WHERE id = $1 AND stock > 0",
+                if not found:
+                    return False
+                # Покупатели списывают из шардов, не трогая строку товара:
+                # ждем их и не даем списать, пока остаток не перераспределен
+                await conn.execute(
+                    "SELECT 1 FROM goods_stock_shards WHERE product_id = $1 FOR UPDATE",
+                    product_id,
+                )
+                stock = await conn.fetchval(
+                    f"SELECT {PRODUCT_STOCK_SQL} FROM goods g WHERE g.id = $1",
                     product_id,
                 )
-                if stock_update == "UPDATE 0":
-                    return "no_stock", None
-
-                for _ in range(5):
-                    new_code = generate_other_code()
-                    try:
-                        async with conn.transaction():
-                            await conn.execute(
-                                """INSERT INTO orders (order_code, user_id, product_id, price_at_purchase) 
-                                   VALUES ($1, $2, $3, $4)""",
-                                new_code,
-                                user_id,
-                                product_id,
-                                price,
-                            )
-                        return "success", new_code
-                    except asyncpg.UniqueViolationError:
-                        continue
-
-        raise Exception("could_not_generate_unique_code")
+                await conn.execute(
+                    "UPDATE goods SET stock_shards = $2 WHERE id = $1",
+                    product_id,
+                    shards,
+                )
+                await conn.execute(
+                    "SELECT set_product_stock($1, $2)", product_id, stock
+                )
+        self._invalidate_product(product_id)
+        return True
+
+    async def buy_product(self, user_id: int, product_id: int, price: Decimal):
+        """
+        Покупка одним вызовом серверной функции buy_product (см. migrations.py):
+        списание, резерв остатка и заказ с кодом, сгенерированным в БД.
+        Возвращает (status, order_code), status — success, low_balance, no_stock
+        или price_changed (price не совпала с текущей ценой товара).
+        """
+        query = "SELECT status, order_code FROM buy_product($1, $2, $3)"
+        try:
+            result = await self._fetchrow(
+                "buy_product", query, user_id, product_id, price
+            )
+            return result["status"], result["order_code"]
+        finally:
+            # Остаток (или цена на другой реплике) изменился — карточку перечитаем
+            # из БД
+            self._invalidate_product(product_id)
 
     async def get_order_by_id(self, order_id: int):
         query = "SELECT * FROM orders WHERE id = $1"
-        return await self._fetchrow(query, order_id)
+        return await self._fetchrow("get_order_by_id", query, order_id)
 
     async def get_order_by_code(self, order_code: str):
-        query = """
-        SELECT * FROM orders o
+        query = f"""
+        SELECT o.*, {PRODUCT_COLUMNS}
+        FROM orders o
         JOIN goods g ON o.product_id = g.id
         WHERE o.order_code = $1
         """
-        return await self._fetchrow(query, order_code)
+        return await self._fetchrow("get_order_by_code", query, order_code)
 
-    async def get_orders_by_user_id(self, user_id: int):
-        query = """
-        SELECT
-            o.order_code,
-            o.price_at_purchase,
-            o.status,
-            o.created_at,
-            g.name as product_name
+    async def get_orders_page(
+        self, user_id: int, limit: int, *, after_id: int = None, before_id: int = None
+    ):
+        """
+        Keyset-пагинация истории заказов (новые сверху) по (created_at, id).
+        after_id — заказы, идущие в списке после указанного (более старые),
+        before_id — перед ним (более новые). Возвращает до limit + 1 заказов
+        в порядке списка; лишний показывает, что в этом направлении есть еще.
+        """
+        columns = """
+            o.id, o.order_code, o.price_at_purchase, o.status,
+            o.created_at, o.completed_at, g.name AS product_name
+        """
+        if before_id is not None:
+            query = f"""
+            SELECT * FROM (
+                SELECT {columns}
+                FROM orders o
+                JOIN goods g ON o.product_id = g.id
+                WHERE o.user_id = $1 AND (o.created_at, o.id) > (
+                    SELECT created_at, id FROM orders WHERE id = $2
+                )
+                ORDER BY o.created_at, o.id
+                LIMIT $3
+            ) AS page
+            ORDER BY created_at DESC, id DESC
+            """
+            return await self._fetch(
+                "get_orders_page", query, user_id, before_id, limit + 1
+            )
+
+        if after_id is not None:
+            query = f"""
+            SELECT {columns}
+            FROM orders o
+            JOIN goods g ON o.product_id = g.id
+            WHERE o.user_id = $1 AND (o.created_at, o.id) < (
+                SELECT created_at, id FROM orders WHERE id = $2
+            )
+            ORDER BY o.created_at DESC, o.id DESC
+            LIMIT $3
+            """
+            return await self._fetch(
+                "get_orders_page", query, user_id, after_id, limit + 1
+            )
+
+        query = f"""
+        SELECT {columns}
         FROM orders o
         JOIN goods g ON o.product_id = g.id
         WHERE o.user_id = $1
-        ORDER BY o.created_at DESC
+        ORDER BY o.created_at DESC, o.id DESC
+        LIMIT $2
         """
-        return await self._fetch(query, user_id)
+        return await self._fetch("get_orders_page", query, user_id, limit + 1)
 
     async def update_order_status(
         self, new_status: str, *, order_id: int = None, order_code: str = None
@@ -273,26 +868,283 @@ class Database:
         else:
             raise ValueError("Нужно указать либо order_id, либо order_code")
 
-        return await self._execute(query, *params)
+        return await self._execute("update_order_status", query, *params)
 
-    async def get_active_orders(self):
-        query = """
-        SELECT o.id, o.order_code, g.name, o.status 
-        FROM orders o 
-        JOIN goods g ON o.product_id = g.id 
-        WHERE o.status != 'completed' 
-        ORDER BY o.created_at DESC
+    async def bulk_update_order_status(
+        self,
+        new_status: str,
+        *,
+        order_ids: list[int] = None,
+        order_codes: list[str] = None,
+        current_status: str = None,
+    ):
         """
-        return await self._fetch(query)
+        Меняет статус сразу многим заказам одним UPDATE: по списку id, по списку
+        кодов или всем заказам с текущим статусом current_status.
+        Возвращает измененные заказы (id, user_id, order_code, product_id).
+        """
+        set_clause = "status = $1"
+        if new_status == "completed":
+            set_clause += ", completed_at = NOW()"
 
-    async def get_last_order(self, user_id):
-        query = """
-        SELECT
-            o.order_code, o.status, o.created_at, o.completed_at, g.name AS product_name
+        if order_ids is not None:
+            condition, param = "id = ANY($2::int[])", order_ids
+        elif order_codes is not None:
+            condition, param = "order_code = ANY($2::text[])", order_codes
+        elif current_status is not None:
+            condition, param = "status = $2", current_status
+        else:
+            raise ValueError("Нужно указать order_ids, order_codes или current_status")
+
+        query = f"""
+        UPDATE orders SET {set_clause}
+        WHERE {condition}
+        RETURNING id, user_id, order_code, product_id
+        """
+        return await self._fetch("bulk_update_order_status", query, new_status, param)
+
+    async def get_active_orders_page(
+        self,
+        limit: int,
+        *,
+        status: str = None,
+        after_id: int = None,
+        before_id: int = None,
+    ):
+        """
+        Keyset-пагинация незавершенных заказов (новые сверху), при status —
+        только заказы с этим статусом. Курсоры и limit + 1 — как в get_orders_page.
+        """
+        conditions = ["o.status <> 'completed'"]
+        args = []
+        if status is not None:
+            args.append(status)
+            conditions.append(f"o.status = ${len(args)}")
+
+        order, outer_order = "DESC", None
+        if before_id is not None:
+            args.append(before_id)
+            conditions.append(
+                f"(o.created_at, o.id) > (SELECT created_at, id FROM orders WHERE id = ${len(args)})"
+            )
+            order, outer_order = "", "DESC"
+        elif after_id is not None:
+            args.append(after_id)
+            conditions.append(
+                f"(o.created_at, o.id) < (SELECT created_at, id FROM orders WHERE id = ${len(args)})"
+            )
+
+        args.append(limit + 1)
+        query = f"""
+        SELECT o.id, o.order_code, g.name, o.status, o.created_at
         FROM orders o
         JOIN goods g ON o.product_id = g.id
-        WHERE o.user_id = $1
-        ORDER BY created_at DESC
-        LIMIT 1
+        WHERE {" AND ".join(conditions)}
+        ORDER BY o.created_at {order}, o.id {order}
+        LIMIT ${len(args)}
+        """
+        if outer_order:
+            query = f"""
+            SELECT * FROM ({query}) AS page
+            ORDER BY created_at {outer_order}, id {outer_order}
+            """
+        return await self._fetch("get_active_orders_page", query, *args)
+
+    async def get_active_order_counts(self):
+        """Число незавершенных заказов по статусам (index-only scan по частичному индексу)"""
+        query = """
+        SELECT status, COUNT(*) AS count
+        FROM orders
+        WHERE status <> 'completed'
+        GROUP BY status
+        """
+        return {
+            row["status"]: row["count"]
+            for row in await self._fetch("get_active_order_counts", query)
+        }
+
+    async def enqueue_notification(self, chat_id: int, text: str, reply_markup=None):
+        """Ставит сообщение пользователю в очередь; отправит notifications.Notifier"""
+        await self.enqueue_notifications([(chat_id, text, reply_markup)])
+
+    async def enqueue_notifications(self, messages):
+        """Пакетная постановка в очередь: messages — (chat_id, text, reply_markup)"""
+        if not messages:
+            return
+        chat_ids, texts, markups = [], [], []
+        for chat_id, text, reply_markup in messages:
+            chat_ids.append(chat_id)
+            texts.append(text)
+            markups.append(
+                reply_markup.model_dump_json(exclude_none=True)
+                if reply_markup is not None
+                else None
+            )
+        query = """
+        INSERT INTO notifications (chat_id, text, reply_markup)
+        SELECT * FROM unnest($1::bigint[], $2::text[], $3::jsonb[])
+        """
+        await self._execute("enqueue_notifications", query, chat_ids, texts, markups)
+
+    async def claim_notifications(self, limit: int, lease: timedelta):
+        """
+        Забирает до limit готовых к отправке сообщений. На время lease они
+        скрыты от других воркеров; если процесс упадет, их заберут повторно.
+        """
+        query = """
+        UPDATE notifications SET
+            attempts = attempts + 1,
+            next_attempt_at = NOW() + $2::interval
+        WHERE id IN (
+            SELECT id FROM notifications
+            WHERE status = 'pending' AND next_attempt_at <= NOW()
+            ORDER BY next_attempt_at, id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, chat_id, text, reply_markup::text, attempts
+        """
+        return await self._fetch("claim_notifications", query, limit, lease)
+
+    async def complete_notification(self, notification_id: int):
+        await self._execute(
+            "complete_notification",
+            "DELETE FROM notifications WHERE id = $1",
+            notification_id,
+        )
+
+    async def retry_notification(
+        self,
+        notification_id: int,
+        delay: timedelta,
+        error: str,
+        count_attempt: bool = True,
+    ):
+        """Откладывает отправку; count_attempt=False — не считать попытку (лимиты)"""
+        query = """
+        UPDATE notifications
+        SET next_attempt_at = NOW() + $2::interval,
+            last_error = COALESCE($3, last_error),
+            attempts = attempts - (NOT $4)::int
+        WHERE id = $1
+        """
+        await self._execute(
+            "retry_notification", query, notification_id, delay, error, count_attempt
+        )
+
+    async def dead_letter_notification(self, notification_id: int, error: str):
+        query = (
+            "UPDATE notifications SET status = 'dead', last_error = $2 WHERE id = $1"
+        )
+        await self._execute("dead_letter_notification", query, notification_id, error)
+
+    async def create_broadcast(
+        self, text: str, admin_chat_id: int, status_message_id: int
+    ):
+        """
+        Создает рассылку без владельца: ее заберет claim_broadcasts ведущей
+        реплики, которую будит триггер broadcast_created.
+        """
+        query = """
+        INSERT INTO broadcasts (text, admin_chat_id, status_message_id)
+        VALUES ($1, $2, $3)
+        RETURNING *
+        """
+        return await self._fetchrow(
+            "create_broadcast", query, text, admin_chat_id, status_message_id
+        )
+
+    async def claim_broadcasts(self, owner: str, lease: timedelta):
+        """
+        Забирает незавершенные рассылки без владельца или с истекшей арендой
+        (реплика остановилась или упала). Возвращает захваченные строки.
+        """
+        query = """
+        UPDATE broadcasts b
+        SET owner = $1, lease_until = NOW() + $2::interval
+        WHERE b.id IN (
+            SELECT id FROM broadcasts
+            WHERE status = 'running'
+              AND (owner IS NULL OR lease_until < NOW())
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING b.*
+        """
+        return await self._fetch("claim_broadcasts", query, owner, lease)
+
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int):
+        """Следующая пачка получателей рассылки по первичному ключу users"""
+        query = """
+        SELECT user_id FROM users
+        WHERE user_id > $1
+        ORDER BY user_id
+        LIMIT $2
+        """
+        rows = await self._fetch(
+            "get_broadcast_recipients", query, after_user_id, limit
+        )
+        return [row["user_id"] for row in rows]
+
+    async def count_broadcast_recipients(self, after_user_id: int = 0):
+        query = "SELECT COUNT(*) FROM users WHERE user_id > $1"
+        return await self._fetchval("count_broadcast_recipients", query, after_user_id)
+
+    async def save_broadcast_progress(
+        self,
+        broadcast_id: int,
+        owner: str,
+        last_user_id: int,
+        delivered: int,
+        blocked: int,
+        failed: int,
+        *,
+        finish_status: str = None,
+        lease: timedelta = None,
+    ):
+        """
+        Сохраняет чекпоинт и счетчики, с finish_status — завершает рассылку.
+        lease продлевает аренду owner; без lease рассылка отпускается,
+        чтобы ее сразу могла подхватить другая реплика.
+        Возвращает текущий статус (рассылку могли остановить из другого
+        процесса) или None, если аренда уже перешла к другой реплике.
+        """
+        query = """
+        UPDATE broadcasts SET
+            last_user_id = $3,
+            delivered = $4,
+            blocked = $5,
+            failed = $6,
+            status = CASE
+                WHEN status = 'running' THEN COALESCE($7, status)
+                ELSE status
+            END,
+            finished_at = CASE
+                WHEN status = 'running' AND $7 IS NOT NULL THEN NOW()
+                ELSE finished_at
+            END,
+            owner = CASE WHEN $8::interval IS NULL THEN NULL ELSE owner END,
+            lease_until = NOW() + $8::interval
+        WHERE id = $1 AND owner = $2
+        RETURNING status
+        """
+        return await self._fetchval(
+            "save_broadcast_progress",
+            query,
+            broadcast_id,
+            owner,
+            last_user_id,
+            delivered,
+            blocked,
+            failed,
+            finish_status,
+            lease,
+        )
+
+    async def cancel_broadcast(self, broadcast_id: int) -> bool:
+        query = """
+        UPDATE broadcasts SET status = 'cancelled', finished_at = NOW()
+        WHERE id = $1 AND status = 'running'
+        RETURNING id
         """
-        return await self._fetchrow(query, user_id)
+        return await self._fetchval("cancel_broadcast", query, broadcast_id) is not None
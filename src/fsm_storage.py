@@ -0,0 +1,187 @@
+"""
+Хранилища состояний FSM. Выбираются переменной FSM_STORAGE:
+
+- memory (по умолчанию) — MemoryStorage aiogram, только для одного процесса;
+- postgres — таблица fsm_states в той же БД через Database.pool;
+- redis — RedisStorage aiogram по адресу REDIS_URL (нужен пакет redis).
+"""
+
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.state import State
+from datetime import timedelta
+from decimal import Decimal
+import json
+import os
+
+from database import Database
+
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_STATE_TTL = timedelta(seconds=int(os.getenv("FSM_STATE_TTL_SECONDS", "86400")))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+
+def _default(value):
+    # В данных FSM лежат цены в Decimal — сохраняем их без потери точности
+    if isinstance(value, Decimal):
+        return {"__decimal__": str(value)}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _object_hook(obj):
+    if set(obj) == {"__decimal__"}:
+        return Decimal(obj["__decimal__"])
+    return obj
+
+
+def json_dumps(data) -> str:
+    return json.dumps(data, default=_default)
+
+
+def json_loads(data: str):
+    return json.loads(data, object_hook=_object_hook)
+
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM в таблице fsm_states. Каждая запись продлевается на ttl при записи,
+    просроченные не читаются и удаляются delete_expired.
+    """
+
+    def __init__(self, db: Database, ttl: timedelta = FSM_STATE_TTL):
+        self.db = db
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            await self._reset(key, "state", "data = '{}'")
+            return
+        query = """
+        INSERT INTO fsm_states (key, state, expires_at)
+        VALUES ($1, $2, NOW() + $3::interval)
+        ON CONFLICT (key) DO UPDATE
+        SET state = EXCLUDED.state,
+            data = CASE
+                WHEN fsm_states.expires_at > NOW() THEN fsm_states.data
+                ELSE '{}'
+            END,
+            expires_at = EXCLUDED.expires_at
+        """
+        await self.db._execute(
+            "fsm_set_state", query, self.key_builder.build(key), state, self.ttl
+        )
+
+    async def _reset(self, key: StorageKey, field: str, other_empty: str):
+        """
+        Сбрасывает field одним запросом. Если другая половина записи пуста
+        (other_empty) или запись просрочена — удаляет ее, а уже сброшенное
+        не трогает: state.clear() без диалога ничего не пишет и не оставляет
+        пустых строк, а для диалога без данных обходится одним DELETE.
+        """
+        empty = "NULL" if field == "state" else "'{}'"
+        query = f"""
+        WITH deleted AS (
+            DELETE FROM fsm_states
+            WHERE key = $1 AND ({other_empty} OR expires_at <= NOW())
+        )
+        UPDATE fsm_states
+        SET {field} = {empty}, expires_at = NOW() + $2::interval
+        WHERE key = $1 AND NOT ({other_empty}) AND expires_at > NOW()
+            AND {field} IS DISTINCT FROM {empty}
+        """
+        await self.db._execute(
+            f"fsm_reset_{field}", query, self.key_builder.build(key), self.ttl
+        )
+
+    async def get_state(self, key: StorageKey):
+        query = "SELECT state FROM fsm_states WHERE key = $1 AND expires_at > NOW()"
+        return await self.db._fetchval(
+            "fsm_get_state", query, self.key_builder.build(key)
+        )
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        if not data:
+            await self._reset(key, "data", "state IS NULL")
+            return
+        query = """
+        INSERT INTO fsm_states (key, data, expires_at)
+        VALUES ($1, $2::jsonb, NOW() + $3::interval)
+        ON CONFLICT (key) DO UPDATE
+        SET data = EXCLUDED.data,
+            state = CASE
+                WHEN fsm_states.expires_at > NOW() THEN fsm_states.state
+            END,
+            expires_at = EXCLUDED.expires_at
+        """
+        await self.db._execute(
+            "fsm_set_data",
+            query,
+            self.key_builder.build(key),
+            json_dumps(dict(data)),
+            self.ttl,
+        )
+
+    async def get_data(self, key: StorageKey):
+        query = (
+            "SELECT data::text FROM fsm_states WHERE key = $1 AND expires_at > NOW()"
+        )
+        data = await self.db._fetchval(
+            "fsm_get_data", query, self.key_builder.build(key)
+        )
+        return json_loads(data) if data else {}
+
+    async def update_data(self, key: StorageKey, data):
+        # Слияние на стороне БД: один запрос вместо get_data + set_data
+        query = """
+        INSERT INTO fsm_states (key, data, expires_at)
+        VALUES ($1, $2::jsonb, NOW() + $3::interval)
+        ON CONFLICT (key) DO UPDATE
+        SET data = CASE
+                WHEN fsm_states.expires_at > NOW() THEN fsm_states.data || EXCLUDED.data
+                ELSE EXCLUDED.data
+            END,
+            state = CASE
+                WHEN fsm_states.expires_at > NOW() THEN fsm_states.state
+            END,
+            expires_at = EXCLUDED.expires_at
+        RETURNING data::text
+        """
+        merged = await self.db._fetchval(
+            "fsm_update_data",
+            query,
+            self.key_builder.build(key),
+            json_dumps(dict(data)),
+            self.ttl,
+        )
+        return json_loads(merged)
+
+    async def delete_expired(self):
+        """Удаляет брошенные диалоги, у которых истек TTL"""
+        await self.db._execute(
+            "fsm_delete_expired", "DELETE FROM fsm_states WHERE expires_at <= NOW()"
+        )
+
+    async def close(self) -> None:
+        # Пулом соединений владеет Database
+        pass
+
+
+def create_fsm_storage(db: Database) -> BaseStorage:
+    if FSM_STORAGE == "postgres":
+        return PostgresStorage(db)
+    if FSM_STORAGE == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage
+
+        return RedisStorage.from_url(
+            REDIS_URL,
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+            state_ttl=FSM_STATE_TTL,
+            data_ttl=FSM_STATE_TTL,
+            json_dumps=json_dumps,
+            json_loads=json_loads,
+        )
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Неизвестное хранилище FSM_STORAGE={FSM_STORAGE}")
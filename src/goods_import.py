@@ -0,0 +1,72 @@
+"""
+Разбор файлов массовой загрузки товаров (CSV или JSONL).
+
+Строки читаются по одной и сразу уходят в COPY (Database.import_goods),
+поэтому расход памяти не зависит от размера файла. Ошибки разбора не
+прерывают загрузку: строка попадает в staging с текстом ошибки. Если же
+файл нельзя читать дальше (не UTF-8, битый CSV), поднимается
+GoodsFileError, и загрузка откатывается целиком.
+"""
+
+import csv
+import json
+
+IMPORT_FIELDS = ("type", "name", "description", "price", "stock")
+
+
+class GoodsFileError(Exception):
+    """Файл загрузки не читается как CSV/JSONL в UTF-8"""
+
+
+def _error(line: int, error: str):
+    return (line, *([None] * len(IMPORT_FIELDS)), error)
+
+
+def _record(line: int, row: dict):
+    values = [row.get(field) for field in IMPORT_FIELDS]
+    values = [None if value is None else str(value).strip() for value in values]
+    # Такую строку PostgreSQL не примет, и COPY упадет целиком
+    if any(value is not None and "\x00" in value for value in values):
+        return _error(line, "недопустимый символ NUL")
+    return (line, *values, None)
+
+
+def iter_csv(path: str):
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        reader = csv.DictReader(file)
+        missing = set(IMPORT_FIELDS) - set(reader.fieldnames or ())
+        if missing:
+            yield _error(1, f"нет колонок: {', '.join(sorted(missing))}")
+            return
+        for row in reader:
+            yield _record(reader.line_num, row)
+
+
+def iter_jsonl(path: str):
+    with open(path, encoding="utf-8-sig") as file:
+        for line, text in enumerate(file, start=1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except json.JSONDecodeError as e:
+                yield _error(line, f"некорректный JSON: {e.msg}")
+                continue
+            if not isinstance(row, dict):
+                yield _error(line, "ожидается JSON-объект")
+                continue
+            yield _record(line, row)
+
+
+def iter_goods_file(path: str, file_name: str):
+    """Записи для staging: (line, type, name, description, price, stock, error)"""
+    if file_name.lower().endswith((".jsonl", ".ndjson")):
+        records = iter_jsonl(path)
+    else:
+        records = iter_csv(path)
+    try:
+        yield from records
+    except UnicodeDecodeError as e:
+        raise GoodsFileError("файл не в кодировке UTF-8") from e
+    except csv.Error as e:
+        raise GoodsFileError(f"некорректный CSV: {e}") from e
@@ -5,17 +5,21 @@ from aiogram.types import (
     InlineKeyboardButton,
     ReplyKeyboardRemove,
 )
-from aiogram.filters import Command, CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.fsm.context import FSMContext
 from dotenv import load_dotenv
+import html
 import os
+import tempfile
 from decimal import Decimal, InvalidOperation
 
-from database import Database
+from broadcast import Broadcaster
+from database import MAX_STOCK_SHARDS, Database
 from states import *
 from payment import *
 from keyboards import *
 from other import *
+from goods_import import GoodsFileError, iter_goods_file
 
 load_dotenv()
 
@@ -35,8 +39,7 @@ async def go_undo(callback: CallbackQuery, state: FSMContext):
 async def cmd_start(message: Message, db: Database):
     user_id = message.from_user.id
 
-    await db.register_user(user_id, message.from_user.username)
-    user = await db.get_user(user_id)
+    user = await db.register_user(user_id, message.from_user.username)
     if not user:
         await message.answer(
             "Похоже что-то не так. Попробуйте запустить бота еще раз. /start"
@@ -107,26 +110,40 @@ async def verify_payment_handler(callback: CallbackQuery, db: Database):
     payment_label = callback.data.replace("check_pay_", "")
 
     payment_record = await db.get_payment(payment_label)
+    archived = False
+    if not payment_record:
+        # Срок счета истек, но ссылка на оплату продолжает работать
+        payment_record = await db.get_archived_payment(payment_label)
+        archived = True
 
     if not payment_record:
         await callback.answer("Платеж не найден.", show_alert=True)
         return
 
-    if payment_record["is_paid"]:
+    if not archived and payment_record["is_paid"]:
         await callback.answer("Этот счет уже оплачен!", show_alert=True)
         return
 
     is_confirmed = await check_yoomoney_payment(YOOMONEY_TOKEN, payment_label)
 
-    if is_confirmed:
-        await db.set_payment_paid(payment_label)
-
-        await db.add_money(
-            payment_record["user_id"], payment_record["amount"], "Пополнение счета"
+    if is_confirmed is None:
+        await callback.answer(
+            "Не удалось связаться с ЮMoney. Попробуйте через минуту.", show_alert=True
         )
+    elif is_confirmed:
+        if archived:
+            credited = await db.credit_archived_payment(
+                payment_label, "Пополнение счета"
+            )
+        else:
+            credited = await db.credit_payment(payment_label, "Пополнение счета")
+        if not credited:
+            # Пока ждали ЮMoney, платеж зачислила фоновая сверка
+            await callback.answer("Этот счет уже оплачен!", show_alert=True)
+            return
 
         await callback.message.edit_text(
-            f"✅ Оплата подтверждена! Зачислено {payment_record['amount']} руб."
+            f"✅ Оплата подтверждена! Зачислено {credited['amount']} руб."
         )
     else:
         await callback.answer(
@@ -134,17 +151,77 @@ async def verify_payment_handler(callback: CallbackQuery, db: Database):
         )
 
 
+GOODS_PAGE_SIZE = 5
+
+
 @router.message(Command("view_goods"))
-@router.callback_query(F.data.startswith("page_"))
-async def show_goods_page(event: Message | CallbackQuery, db: Database):
+@router.callback_query(F.data == "catalog")
+async def show_categories(event: Message | CallbackQuery, db: Database):
+    categories = await db.get_categories()
+
+    builder = InlineKeyboardBuilder()
+    for category in categories:
+        builder.row(
+            InlineKeyboardButton(
+                text=(
+                    f"{category['type']} ({category['product_count']}) "
+                    f"— от {category['min_price']} руб."
+                ),
+                callback_data=f"page_c{category['id']}:a0",
+            )
+        )
+    builder.row(InlineKeyboardButton(text="📋 Все товары", callback_data="page_a0"))
+
+    text = "<b>🛒 Выберите категорию:</b>"
+
     if isinstance(event, Message):
-        page = 0
+        await event.answer(text, reply_markup=builder.as_markup())
+    else:
+        await event.message.edit_text(text, reply_markup=builder.as_markup())
+        await event.answer()
+
+
+@router.callback_query(F.data.startswith("page_"))
+async def show_goods_page(callback: CallbackQuery, db: Database):
+    # page_a<id> — товары после id, page_b<id> — товары до id,
+    # page_c<категория>:a<id> — то же внутри категории,
+    # page_<N> — старые кнопки с номером страницы, которые еще лежат в чатах
+    cursor = callback.data.split("_")[1]
+    limit = GOODS_PAGE_SIZE
+
+    category_id, prefix = None, ""
+    if cursor.startswith("c"):
+        category, cursor = cursor[1:].split(":")
+        category_id, prefix = int(category), f"c{category}:"
+
+    if cursor.startswith("b"):
+        before_id = int(cursor[1:])
+        products = await db.get_goods_page(
+            limit, before_id=before_id, category_id=category_id
+        )
+        has_prev = len(products) > limit
+        products = products[-limit:]
+        has_next = True
+        if not products:
+            products = await db.get_goods_page(limit, category_id=category_id)
+            has_next = len(products) > limit
+            products = products[:limit]
+    elif cursor.startswith("a"):
+        after_id = int(cursor[1:])
+        products = await db.get_goods_page(
+            limit, after_id=after_id, category_id=category_id
+        )
+        has_next = len(products) > limit
+        products = products[:limit]
+        has_prev = after_id > 0
     else:
-        page = int(event.data.split("_")[1])
+        page = int(cursor)
+        products = await db.get_goods(limit + 1, page * limit)
+        has_next = len(products) > limit
+        products = products[:limit]
+        has_prev = page > 0
 
-    limit = 5
-    offset = page * limit
-    products = await db.get_goods(limit, offset)
+    page_cursor = prefix + (f"a{products[0]['id'] - 1}" if products else "a0")
 
     builder = InlineKeyboardBuilder()
 
@@ -152,38 +229,40 @@ async def show_goods_page(event: Message | CallbackQuery, db: Database):
         builder.row(
             InlineKeyboardButton(
                 text=f"{prod['name']} — {prod['price']} руб.",
-                callback_data=f"prod_{prod['id']}_p{page}",
+                callback_data=f"prod_{prod['id']}_p{page_cursor}",
             )
         )
 
     nav_buttons = []
-    if page > 0:
+    if has_prev and products:
         nav_buttons.append(
-            InlineKeyboardButton(text="⬅️", callback_data=f"page_{page-1}")
+            InlineKeyboardButton(
+                text="⬅️", callback_data=f"page_{prefix}b{products[0]['id']}"
+            )
         )
 
-    if len(products) == limit:
+    if has_next and products:
         nav_buttons.append(
-            InlineKeyboardButton(text="➡️", callback_data=f"page_{page+1}")
+            InlineKeyboardButton(
+                text="➡️", callback_data=f"page_{prefix}a{products[-1]['id']}"
+            )
         )
 
     if nav_buttons:
         builder.row(*nav_buttons)
+    builder.row(InlineKeyboardButton(text="🗂 Категории", callback_data="catalog"))
 
     text = "<b>🛒 Наш ассортимент:</b>"
 
-    if isinstance(event, Message):
-        await event.answer(text, reply_markup=builder.as_markup())
-    else:
-        await event.message.edit_text(text, reply_markup=builder.as_markup())
-        await event.answer()
+    await callback.message.edit_text(text, reply_markup=builder.as_markup())
+    await callback.answer()
 
 
 @router.callback_query(F.data.startswith("prod_"))
 async def show_product(callback: CallbackQuery, db: Database):
     data = callback.data.split("_")
     product_id = int(data[1])
-    page_info = data[2] if len(data) > 2 else "p0"
+    page_info = data[2] if len(data) > 2 else "pa0"
     product = await db.get_product_by_id(product_id)
 
     if not product:
@@ -317,6 +396,110 @@ async def stock_added(message: Message, state: FSMContext, db: Database):
     await state.clear()
 
 
+@router.message(Command("import_goods"))
+async def start_import_goods(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Вы не можете добавлять товары!")
+        return
+
+    await message.answer(
+        "Пришлите файл CSV или JSONL с полями "
+        "<code>type, name, description, price, stock</code>.\n"
+        "Товары с существующим названием будут обновлены.",
+        reply_markup=get_undo_kb(),
+    )
+    await state.set_state(ImportGoods.waiting_for_file)
+
+
+@router.message(ImportGoods.waiting_for_file)
+async def import_goods_file(message: Message, state: FSMContext, db: Database):
+    if not message.document:
+        await message.answer("Пришлите файл документом (CSV или JSONL):")
+        return
+
+    await message.answer("⏳ Загружаю товары...")
+    file_name = message.document.file_name or "goods.csv"
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "goods_import")
+            await message.bot.download(message.document, destination=path)
+            imported, error_count, errors = await db.import_goods(
+                iter_goods_file(path, file_name)
+            )
+    except GoodsFileError as e:
+        await message.answer(
+            f"❌ Товары не загружены: {html.escape(str(e))}.\n"
+            "Исправьте файл (CSV или JSONL в UTF-8) и повторите /import_goods"
+        )
+        await state.clear()
+        return
+    except Exception as e:
+        print(f"Ошибка загрузки товаров: {e}")
+        await message.answer("❌ Товары не загружены: ошибка при загрузке файла")
+        await state.clear()
+        return
+
+    text = f"✅ Загружено товаров: {imported}\n❗️ Строк с ошибками: {error_count}"
+    if errors:
+        text += "\n\n" + "\n".join(
+            f"Строка {row['line']}: {html.escape(row['error'])}" for row in errors
+        )
+        if error_count > len(errors):
+            text += f"\n...и еще {error_count - len(errors)}"
+
+    await message.answer(text)
+    await state.clear()
+
+
+@router.message(Command("db_stats"))
+async def db_stats(message: Message, db: Database):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    pool = db.pool_stats()
+    text = (
+        "<b>🗄 Пул соединений</b>\n"
+        f"Соединений: {pool['size']} (min {pool['min_size']}, max {pool['max_size']})\n"
+        f"Занято: {pool['acquired']}, свободно: {pool['idle']}, "
+        f"ждут: {pool['waiting']}\n"
+        f"Ожидание acquire: среднее {pool['acquire_wait_avg_ms']:.2f} мс, "
+        f"максимум {pool['acquire_wait_max_ms']:.2f} мс "
+        f"({pool['acquire_count']} раз)\n"
+    )
+    if db.product_cache is not None:
+        cache = db.product_cache.stats()
+        text += (
+            "\n<b>📦 Кэш товаров</b>\n"
+            f"Записей: {cache['size']}, попаданий: {cache['hits']}, "
+            f"промахов: {cache['misses']}, обновлений остатка: {cache['stock_refreshes']}"
+        )
+    await message.answer(text)
+
+
+@router.message(Command("shard_stock"))
+async def shard_stock(message: Message, command: CommandObject, db: Database):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    args = (command.args or "").split()
+    if len(args) != 2 or not all(arg.isdigit() for arg in args):
+        await message.answer(
+            "Использование: /shard_stock <id товара> <число шардов>\n"
+            "0 шардов — обычный остаток одной строкой."
+        )
+        return
+
+    product_id, shards = int(args[0]), int(args[1])
+    if shards > MAX_STOCK_SHARDS:
+        await message.answer(f"Шардов может быть не больше {MAX_STOCK_SHARDS}.")
+        return
+    if not await db.set_stock_shards(product_id, shards):
+        await message.answer("Товар не найден")
+        return
+
+    await message.answer(f"✅ Остаток товара {product_id} разделен на {shards} шардов.")
+
+
 @router.callback_query(F.data.startswith("buy_"))
 async def process_buying(callback: CallbackQuery, state: FSMContext, db: Database):
     prod_id = int(callback.data.replace("buy_", ""))
@@ -353,29 +536,28 @@ async def buy_confirmed(message: Message, state: FSMContext, db: Database):
         message.from_user.id, data["prod_id"], data["price"]
     )
 
-    try:
-        if status == "low_balance":
-            await message.answer(
-                "❌ Недостаточно средств на балансе! Покупка отменена.\nДля пополнения используйте\n/deposit",
-                reply_markup=ReplyKeyboardRemove(),
-            )
-            await state.clear()
-        elif status == "success":
-            await message.answer(
-                f"✅ Покупка прошла успешно!\n"
-                f"Номер заказа: <code>{order_code}</code>\n"
-                f"Сатус: Оплачен\n\n"
-                f"По всем вопросам: @si_zin_pin1989",
-                reply_markup=get_undo_to_products_kb(),
-            )
-        await state.clear()
-
-    except Exception as e:
-        if str(e) == "no_stock":
-            await message.answer("📦 Товар закончился!", reply_markup=get_undo_kb())
-
-        elif str(e) == "duplicate_code":
-            await message.answer()
+    if status == "low_balance":
+        await message.answer(
+            "❌ Недостаточно средств на балансе! Покупка отменена.\nДля пополнения используйте\n/deposit",
+            reply_markup=ReplyKeyboardRemove(),
+        )
+    elif status == "no_stock":
+        await message.answer("📦 Товар закончился!", reply_markup=get_undo_kb())
+    elif status == "price_changed":
+        await message.answer(
+            "⚠️ Цена товара изменилась. Покупка отменена, деньги не списаны.\n"
+            "Откройте товар заново, чтобы увидеть новую цену.",
+            reply_markup=get_undo_to_products_kb(),
+        )
+    elif status == "success":
+        await message.answer(
+            f"✅ Покупка прошла успешно!\n"
+            f"Номер заказа: <code>{order_code}</code>\n"
+            f"Сатус: Оплачен\n\n"
+            f"По всем вопросам: @si_zin_pin1989",
+            reply_markup=get_undo_to_products_kb(),
+        )
+    await state.clear()
 
 
 @router.message(Command("profile"))
@@ -383,10 +565,9 @@ async def buy_confirmed(message: Message, state: FSMContext, db: Database):
 async def show_profile(event: Message | CallbackQuery, state: FSMContext, db: Database):
     await state.clear()
     user_id = event.from_user.id
-    user = await db.get_user(user_id)
-    last_order = await db.get_last_order(user_id)
+    profile = await db.get_profile(user_id)
 
-    if not user:
+    if not profile:
         if isinstance(event, Message):
             await event.answer("Вы не зарегистрированы! Нажмите /start для регистрации")
         else:
@@ -397,12 +578,14 @@ async def show_profile(event: Message | CallbackQuery, state: FSMContext, db: Da
 
     text = (
         f"👤 <b>Личный кабинет</b>\n"
-        f"🆔 ID: <code>{user['user_id']}</code>\n"
-        f"💰 Баланс: <b>{user['balance']} руб.</b>\n"
+        f"🆔 ID: <code>{profile['user_id']}</code>\n"
+        f"💰 Баланс: <b>{profile['balance']} руб.</b>\n"
+        f"🛍 Заказов: {profile['orders_count']}\n"
         f"────────────────────\n"
     )
 
-    if last_order:
+    if profile["order_code"]:
+        last_order = profile
         status_key = last_order["status"]
         status_text = STATUS_TRANSLATIONS.get(status_key, status_key)
 
@@ -435,9 +618,34 @@ async def show_profile(event: Message | CallbackQuery, state: FSMContext, db: Da
         )
 
 
+ORDERS_PAGE_SIZE = 10
+
+
 @router.callback_query(F.data == "order_history")
+@router.callback_query(F.data.startswith("hist_"))
 async def show_order_history(callback: CallbackQuery, db: Database):
-    orders = await db.get_orders_by_user_id(callback.from_user.id)
+    # hist_a<id> — заказы старше указанного, hist_b<id> — новее
+    user_id = callback.from_user.id
+    limit = ORDERS_PAGE_SIZE
+    cursor = callback.data[len("hist_") :] if callback.data != "order_history" else ""
+
+    if cursor.startswith("b"):
+        orders = await db.get_orders_page(user_id, limit, before_id=int(cursor[1:]))
+        has_prev = len(orders) > limit
+        orders = orders[-limit:]
+        has_next = True
+    elif cursor.startswith("a"):
+        orders = await db.get_orders_page(user_id, limit, after_id=int(cursor[1:]))
+        has_next = len(orders) > limit
+        orders = orders[:limit]
+        has_prev = True
+    else:
+        orders = await db.get_orders_page(user_id, limit)
+        has_next = len(orders) > limit
+        orders = orders[:limit]
+        has_prev = False
+
+    builder = InlineKeyboardBuilder()
 
     if not orders:
         text = "📜 У вас пока нет заказов."
@@ -458,30 +666,128 @@ async def show_order_history(callback: CallbackQuery, db: Database):
                 f"└ Дата: {date_str}\n\n"
             )
 
-    await callback.message.answer(text)
-    callback.answer()
+        nav_buttons = []
+        if has_prev:
+            nav_buttons.append(
+                InlineKeyboardButton(
+                    text="⬅️", callback_data=f"hist_b{orders[0]['id']}"
+                )
+            )
+        if has_next:
+            nav_buttons.append(
+                InlineKeyboardButton(
+                    text="➡️", callback_data=f"hist_a{orders[-1]['id']}"
+                )
+            )
+        if nav_buttons:
+            builder.row(*nav_buttons)
+
+    builder.row(InlineKeyboardButton(text="⬅️ В кабинет", callback_data="profile"))
+
+    if cursor:
+        await callback.message.edit_text(text, reply_markup=builder.as_markup())
+    else:
+        await callback.message.answer(text, reply_markup=builder.as_markup())
+    await callback.answer()
+
+
+ADMIN_ORDERS_PAGE_SIZE = 10
 
 
 @router.callback_query(F.data == "admin_main")
+@router.callback_query(F.data.startswith("adm:"))
 async def admin_orders_list(callback: CallbackQuery, db: Database):
-    orders = await db.get_active_orders()
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
 
-    if not orders:
-        return await callback.message.edit_text("📭 Новых заказов пока нет.")
+    # adm:<статус или all>:<курсор>, курсор a<id> — дальше по списку, b<id> — назад
+    if callback.data == "admin_main":
+        status_filter, cursor = "all", ""
+    else:
+        _, status_filter, cursor = callback.data.split(":")
+    status = None if status_filter == "all" else status_filter
+    limit = ADMIN_ORDERS_PAGE_SIZE
+
+    if cursor.startswith("b"):
+        orders = await db.get_active_orders_page(
+            limit, status=status, before_id=int(cursor[1:])
+        )
+        has_prev = len(orders) > limit
+        orders = orders[-limit:]
+        has_next = True
+    elif cursor.startswith("a"):
+        orders = await db.get_active_orders_page(
+            limit, status=status, after_id=int(cursor[1:])
+        )
+        has_next = len(orders) > limit
+        orders = orders[:limit]
+        has_prev = True
+    else:
+        orders = await db.get_active_orders_page(limit, status=status)
+        has_next = len(orders) > limit
+        orders = orders[:limit]
+        has_prev = False
+
+    counts = await db.get_active_order_counts()
 
     builder = InlineKeyboardBuilder()
 
-    text = "🔍 <b>Активные заказы:</b>\n"
-    for order in orders:
-        status = STATUS_TRANSLATIONS.get(order["status"], order["status"])
-        text += f"\n🆔 {order['id']} | <code>{order['order_code']}</code> | {order['name']}\nСтатус: <b>{status}</b>\n"
-        builder.button(
-            text=f"⚙️ Статус #{order['id']}",
-            callback_data=f"edit_st:{order['id']}:{order['status']}",
+    filter_buttons = [
+        InlineKeyboardButton(
+            text=f"{'• ' if status is None else ''}Все ({sum(counts.values())})",
+            callback_data="adm:all:",
         )
+    ]
+    for status_key, status_name in STATUS_TRANSLATIONS.items():
+        if status_key == "completed":
+            continue
+        mark = "• " if status_key == status else ""
+        filter_buttons.append(
+            InlineKeyboardButton(
+                text=f"{mark}{status_name} ({counts.get(status_key, 0)})",
+                callback_data=f"adm:{status_key}:",
+            )
+        )
+    for k in range(0, len(filter_buttons), 2):
+        builder.row(*filter_buttons[k : k + 2])
+    builder.row(
+        InlineKeyboardButton(text="📦 Массовая смена статуса", callback_data="bulk_st")
+    )
+    builder.row(InlineKeyboardButton(text="📣 Рассылка", callback_data="bcast"))
+
+    if not orders:
+        text = "📭 Новых заказов пока нет."
+    else:
+        text = "🔍 <b>Активные заказы:</b>\n"
+        for order in orders:
+            order_status = STATUS_TRANSLATIONS.get(order["status"], order["status"])
+            text += f"\n🆔 {order['id']} | <code>{order['order_code']}</code> | {order['name']}\nСтатус: <b>{order_status}</b>\n"
+            builder.row(
+                InlineKeyboardButton(
+                    text=f"⚙️ Статус #{order['id']}",
+                    callback_data=f"edit_st:{order['id']}:{order['status']}",
+                )
+            )
+
+        nav_buttons = []
+        if has_prev:
+            nav_buttons.append(
+                InlineKeyboardButton(
+                    text="⬅️", callback_data=f"adm:{status_filter}:b{orders[0]['id']}"
+                )
+            )
+        if has_next:
+            nav_buttons.append(
+                InlineKeyboardButton(
+                    text="➡️", callback_data=f"adm:{status_filter}:a{orders[-1]['id']}"
+                )
+            )
+        if nav_buttons:
+            builder.row(*nav_buttons)
 
-    builder.adjust(1)
     await callback.message.edit_text(text, reply_markup=builder.as_markup())
+    await callback.answer()
 
 
 @router.callback_query(F.data.startswith("edit_st:"))
@@ -505,6 +811,19 @@ async def process_edit_status(callback: CallbackQuery):
     )
 
 
+def order_status_notification(order, status_text: str):
+    """(chat_id, text, reply_markup) уведомления покупателю о новом статусе"""
+    return (
+        order["user_id"],
+        (
+            f"🔔 <b>Статус вашего заказа обновлен!</b>\n\n"
+            f"📦 Заказ: <code>{order['order_code']}</code>\n"
+            f"🔄 Новый статус: <b>{status_text}</b>"
+        ),
+        get_customers_kb(product_id=order["product_id"]),
+    )
+
+
 @router.callback_query(F.data.startswith("save_st:"))
 async def save_new_order_status(callback: CallbackQuery, db: Database):
     data = callback.data.split(":")
@@ -512,34 +831,19 @@ async def save_new_order_status(callback: CallbackQuery, db: Database):
     order_id = int(data[1])
     status_key = data[2]
 
-    order = await db.get_order_by_id(order_id)
+    updated = await db.bulk_update_order_status(status_key, order_ids=[order_id])
 
-    if not order:
+    if not updated:
         await callback.answer("Заказ не найден!", show_alert=True)
         return
 
-    buyer_id = order["user_id"]
-    order_code = order["order_code"]
-    product_id = order["product_id"]
-
-    await db.update_order_status(status_key, order_id=order_id)
-
     status_text = STATUS_TRANSLATIONS.get(status_key, status_key)
     text = f"✅ Статус заказа №{order_id} успешно изменен на «{status_text}»"
 
-    try:
-        await callback.bot.send_message(
-            chat_id=buyer_id,
-            text=(
-                f"🔔 <b>Статус вашего заказа обновлен!</b>\n\n"
-                f"📦 Заказ: <code>{order_code}</code>\n"
-                f"🔄 Новый статус: <b>{status_text}</b>"
-            ),
-            reply_markup=get_customers_kb(product_id=product_id),
-        )
-        text += ".\nКлиент получил уведомление."
-    except Exception as e:
-        print(f"Не удалось отправить уведомление пользователю {buyer_id}: {e}")
+    await db.enqueue_notifications(
+        [order_status_notification(order, status_text) for order in updated]
+    )
+    text += ".\nУведомление клиенту поставлено в очередь."
 
     await callback.message.answer(
         text,
@@ -548,6 +852,167 @@ async def save_new_order_status(callback: CallbackQuery, db: Database):
     await callback.answer()
 
 
+BULK_STATUS_MAX_CODES = 1000
+
+
+@router.callback_query(F.data == "bulk_st")
+async def start_bulk_status(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+
+    builder = InlineKeyboardBuilder()
+    for status_key, status_name in STATUS_TRANSLATIONS.items():
+        if status_key == "completed":
+            continue
+        builder.button(
+            text=f"Все «{status_name}»", callback_data=f"bulk_from:{status_key}"
+        )
+    builder.adjust(2)
+    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel"))
+
+    await callback.message.answer(
+        "📦 <b>Массовая смена статуса</b>\n"
+        "Пришлите коды заказов через пробел, запятую или с новой строки "
+        f"(до {BULK_STATUS_MAX_CODES} шт.), либо выберите заказы по текущему статусу:",
+        reply_markup=builder.as_markup(),
+    )
+    await state.set_state(BulkOrderStatus.waiting_for_orders)
+    await callback.answer()
+
+
+@router.callback_query(
+    BulkOrderStatus.waiting_for_orders, F.data.startswith("bulk_from:")
+)
+async def bulk_status_by_filter(callback: CallbackQuery, state: FSMContext):
+    current_status = callback.data.split(":")[1]
+    await state.update_data(current_status=current_status, order_codes=None)
+
+    status_text = STATUS_TRANSLATIONS.get(current_status, current_status)
+    await callback.message.answer(
+        f"Выбраны все заказы со статусом «{status_text}». Новый статус:",
+        reply_markup=get_bulk_target_status_kb(),
+    )
+    await state.set_state(BulkOrderStatus.waiting_for_status)
+    await callback.answer()
+
+
+@router.message(BulkOrderStatus.waiting_for_orders)
+async def bulk_status_by_codes(message: Message, state: FSMContext):
+    if not message.text:
+        await message.answer("Пришлите коды заказов текстом:")
+        return
+
+    order_codes = list(dict.fromkeys(message.text.replace(",", " ").upper().split()))
+    if len(order_codes) > BULK_STATUS_MAX_CODES:
+        await message.answer(
+            f"Слишком много кодов: {len(order_codes)}. Максимум {BULK_STATUS_MAX_CODES}."
+        )
+        return
+
+    await state.update_data(order_codes=order_codes, current_status=None)
+    await message.answer(
+        f"Получено кодов: {len(order_codes)}. Новый статус:",
+        reply_markup=get_bulk_target_status_kb(),
+    )
+    await state.set_state(BulkOrderStatus.waiting_for_status)
+
+
+@router.callback_query(
+    BulkOrderStatus.waiting_for_status, F.data.startswith("bulk_to:")
+)
+async def bulk_status_apply(callback: CallbackQuery, state: FSMContext, db: Database):
+    new_status = callback.data.split(":")[1]
+    data = await state.get_data()
+    await state.clear()
+
+    if data.get("current_status") == new_status:
+        await callback.answer("Заказы уже в этом статусе", show_alert=True)
+        return
+
+    updated = await db.bulk_update_order_status(
+        new_status,
+        order_codes=data.get("order_codes"),
+        current_status=data.get("current_status"),
+    )
+
+    status_text = STATUS_TRANSLATIONS.get(new_status, new_status)
+    await db.enqueue_notifications(
+        [order_status_notification(order, status_text) for order in updated]
+    )
+
+    text = f"✅ Статус «{status_text}» установлен для {len(updated)} заказов."
+    if data.get("order_codes"):
+        found = {order["order_code"] for order in updated}
+        missing = [code for code in data["order_codes"] if code not in found]
+        if missing:
+            shown = ", ".join(missing[:20])
+            more = f" и еще {len(missing) - 20}" if len(missing) > 20 else ""
+            text += f"\nНе найдены: <code>{shown}</code>{more}"
+
+    await callback.message.answer(text, reply_markup=get_undo_to_admin_orders_list_kb())
+    await callback.answer()
+
+
+@router.callback_query(F.data == "bcast")
+async def start_broadcast(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+
+    await callback.message.answer(
+        "📣 <b>Рассылка всем пользователям</b>\nПришлите текст сообщения:",
+        reply_markup=get_undo_kb(),
+    )
+    await state.set_state(Broadcast.waiting_for_text)
+    await callback.answer()
+
+
+@router.message(Broadcast.waiting_for_text)
+async def broadcast_preview(message: Message, state: FSMContext):
+    if not message.text:
+        await message.answer("Рассылка поддерживает только текст. Пришлите текст:")
+        return
+
+    text = message.html_text
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🚀 Отправить всем", callback_data="bcast_go")
+    builder.button(text="❌ Отмена", callback_data="cancel")
+
+    # Предпросмотр тем же текстом: ошибка разметки всплывет здесь, а не в рассылке
+    await message.answer("Так сообщение увидят пользователи:")
+    await message.answer(text, reply_markup=builder.as_markup())
+    await state.update_data(broadcast_text=text)
+    await state.set_state(Broadcast.waiting_for_confirm)
+
+
+@router.callback_query(Broadcast.waiting_for_confirm, F.data == "bcast_go")
+async def broadcast_confirmed(
+    callback: CallbackQuery, state: FSMContext, broadcaster: Broadcaster
+):
+    data = await state.get_data()
+    await state.clear()
+
+    status_message = await callback.message.answer("📣 Рассылка запускается...")
+    await broadcaster.create(
+        data["broadcast_text"], status_message.chat.id, status_message.message_id
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("bcast_stop:"))
+async def broadcast_stop(callback: CallbackQuery, broadcaster: Broadcaster):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+
+    broadcast_id = int(callback.data.split(":")[1])
+    if await broadcaster.cancel(broadcast_id):
+        await callback.answer("Рассылка останавливается")
+    else:
+        await callback.answer("Рассылка уже завершена", show_alert=True)
+
+
 @router.callback_query(F.data == "search_order")
 async def process_search_order(callback: CallbackQuery, state: FSMContext):
     await callback.message.answer("Введите номер вашего заказа:")
@@ -611,27 +1076,74 @@ async def result_search_order(message: Message, db: Database):
     await message.answer(text, reply_markup=builder.as_markup())
 
 
+SEARCH_PAGE_SIZE = 8
+SEARCH_MAX_PAGES = 10
+
+
 @router.callback_query(F.data == "search_product")
 async def process_search_product(callback: CallbackQuery, state: FSMContext):
-    await callback.message.answer("Пожалуйста, введите ID товара:")
+    await callback.message.answer(
+        "Введите название или описание товара, либо его ID (например, 10042):"
+    )
     await state.set_state(SearchProduct.waiting_for_id)
 
 
+def parse_product_id(text: str):
+    # ID показывается пользователю как 100<id>
+    text = text.strip()
+    if text.isdigit() and text.startswith("100") and len(text) > 3:
+        return int(text[3:])
+    return None
+
+
+async def render_search_results(db: Database, query: str, page: int):
+    products = await db.search_goods(query, SEARCH_PAGE_SIZE, page * SEARCH_PAGE_SIZE)
+    has_next = len(products) > SEARCH_PAGE_SIZE and page + 1 < SEARCH_MAX_PAGES
+    products = products[:SEARCH_PAGE_SIZE]
+
+    builder = InlineKeyboardBuilder()
+    for prod in products:
+        builder.row(
+            InlineKeyboardButton(
+                text=f"{prod['name']} — {prod['price']} руб.",
+                callback_data=f"prod_{prod['id']}_pa0",
+            )
+        )
+
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(
+            InlineKeyboardButton(text="⬅️", callback_data=f"srch_{page - 1}")
+        )
+    if has_next:
+        nav_buttons.append(
+            InlineKeyboardButton(text="➡️", callback_data=f"srch_{page + 1}")
+        )
+    if nav_buttons:
+        builder.row(*nav_buttons)
+    builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="profile"))
+
+    if products:
+        text = f"🔍 Результаты по запросу «{html.escape(query)}»:"
+    else:
+        text = "Ничего не найдено. Попробуйте другой запрос, или вернитесь назад."
+    return text, builder.as_markup()
+
+
 @router.message(SearchProduct.waiting_for_id)
-async def result_search_product(message: Message, db: Database):
+async def result_search_product(message: Message, state: FSMContext, db: Database):
     if not message.text:
-        await message.answer("Пожалуйста, введите номер заказа текстом:")
+        await message.answer("Пожалуйста, введите запрос текстом:")
         return
 
-    product_id = int(message.text.replace("100", ""))
-
-    product = await db.get_product_by_id(product_id)
+    product_id = parse_product_id(message.text)
+    product = await db.get_product_by_id(product_id) if product_id else None
 
     if not product:
-        await message.answer(
-            "Заказа с таким кодом не существует. Попробуйте снова, или вернитесь назад.",
-            reply_markup=get_undo_to_profile_kb(),
-        )
+        query = message.text.strip()[:100]
+        await state.update_data(search_query=query)
+        text, markup = await render_search_results(db, query, 0)
+        await message.answer(text, reply_markup=markup)
         return
 
     in_stock = (
@@ -658,3 +1170,16 @@ async def result_search_product(message: Message, db: Database):
     builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"profile"))
 
     await message.answer(text, reply_markup=builder.as_markup())
+
+
+@router.callback_query(F.data.startswith("srch_"))
+async def search_results_page(callback: CallbackQuery, state: FSMContext, db: Database):
+    query = (await state.get_data()).get("search_query")
+    if not query:
+        await callback.answer("Поиск устарел, повторите запрос.", show_alert=True)
+        return
+
+    page = min(int(callback.data.replace("srch_", "")), SEARCH_MAX_PAGES - 1)
+    text, markup = await render_search_results(db, query, page)
+    await callback.message.edit_text(text, reply_markup=markup)
+    await callback.answer()
@@ -4,9 +4,12 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
+from aiogram.utils.keyboard import InlineKeyboardBuilder
 from dotenv import load_dotenv
 import os
 
+from other import STATUS_TRANSLATIONS
+
 load_dotenv()
 
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
@@ -36,7 +39,7 @@ def get_confirm_buy_kb():
 def get_undo_to_products_kb():
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="🛒 К товарам", callback_data=f"page_0")],
+            [InlineKeyboardButton(text="🛒 К товарам", callback_data="catalog")],
             {InlineKeyboardButton(text="👤 В кабинет", callback_data="profile")},
         ]
     )
@@ -90,7 +93,7 @@ def get_customers_kb(product_id):
                     text="📜 Мои заказы", callback_data="order_history"
                 ),
                 InlineKeyboardButton(
-                    text="🔍 О товаре", callback_data=f"prod_{product_id}_p0"
+                    text="🔍 О товаре", callback_data=f"prod_{product_id}_pa0"
                 ),
             ]
         ]
@@ -103,3 +106,12 @@ def get_undo_to_profile_kb():
             [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"profile")]
         ]
     )
+
+
+def get_bulk_target_status_kb():
+    kb = InlineKeyboardBuilder()
+    for status_key, status_name in STATUS_TRANSLATIONS.items():
+        kb.button(text=status_name, callback_data=f"bulk_to:{status_key}")
+    kb.adjust(2)
+    kb.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel"))
+    return kb.as_markup()
@@ -3,24 +3,43 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.types import BotCommand
 import asyncio
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import os
 from dotenv import load_dotenv
 
+from broadcast import Broadcaster
 from database import Database
-from tasks import check_pending_payments
+from metrics import Gauge, start_metrics_server
+from middlewares import (
+    HandlerMetricsMiddleware,
+    TelegramTimingMiddleware,
+    ThrottlingMiddleware,
+)
+from fsm_storage import PostgresStorage, create_fsm_storage
+from notifications import Notifier
+from task_runner import TaskRunner
+from tasks import (
+    PAYMENTS_MAX_INTERVAL,
+    PAYMENTS_MIN_INTERVAL,
+    check_pending_payments,
+    next_payments_check,
+)
 from handlers import router as user_router
+from webhook import run_webhook
+from yoomoney_client import close_clients
 
 load_dotenv()
 
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+BOT_MODE = os.getenv("BOT_MODE", "polling")
 
 if TOKEN is None:
     raise ValueError("Токен TELEGRAM_BOT_TOKEN не найден в переменных окружения.")
 
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+bot.session.middleware(TelegramTimingMiddleware())
 db = Database()
+storage = create_fsm_storage(db)
+dp = Dispatcher(storage=storage)
 
 
 async def set_main_menu(bot: Bot):
@@ -34,24 +53,83 @@ async def set_main_menu(bot: Bot):
     await bot.set_my_commands(main_menu_commands)
 
 
-async def main():
-    await db.connect()
-    await db.create_tables()
+def register_pool_metrics(db: Database):
+    Gauge(
+        "bot_db_pool_connections",
+        "Соединения пула по состоянию",
+        ("state",),
+        callback=lambda: {
+            (state,): db.pool_stats()[state]
+            for state in ("acquired", "idle", "waiting")
+        },
+    )
+    Gauge(
+        "bot_product_cache",
+        "Счетчики кэша товаров",
+        ("stat",),
+        callback=lambda: (
+            {(key,): value for key, value in db.product_cache.stats().items()}
+            if db.product_cache is not None
+            else {}
+        ),
+    )
 
-    scheduler = AsyncIOScheduler()
 
-    scheduler.add_job(check_pending_payments, "interval", minutes=5, args=(db, bot))
-    scheduler.start()
+async def main():
+    await db.connect()
+    await db.migrate()
+
+    register_pool_metrics(db)
+    metrics_runner = await start_metrics_server()
+
+    notifier = Notifier(db, bot)
+    # Общий bucket: рассылка и уведомления вместе укладываются в лимит Telegram.
+    # Отправляет только ведущая реплика, иначе лимит умножился бы на их число
+    broadcaster = Broadcaster(db, bot, bucket=notifier.global_bucket)
+
+    runner = TaskRunner(db)
+    runner.add_service("notifier", notifier.run)
+    runner.add_service("broadcaster", broadcaster.run)
+    runner.listen("broadcast_created", broadcaster.wake)
+    runner.add_task(
+        "payments",
+        check_pending_payments,
+        PAYMENTS_MAX_INTERVAL,
+        args=(db, bot),
+        first_run_in=PAYMENTS_MIN_INTERVAL,
+        next_interval=lambda: next_payments_check(db),
+    )
+    # Новый счет: проверим его вскоре, а не через PAYMENTS_MAX_INTERVAL
+    runner.listen(
+        "payment_created", lambda: runner.wake("payments", PAYMENTS_MIN_INTERVAL)
+    )
+    if isinstance(storage, PostgresStorage):
+        runner.add_task("fsm_cleanup", storage.delete_expired, 30 * 60)
+    await runner.start()
 
     await set_main_menu(bot)
 
+    throttling = ThrottlingMiddleware()
+    user_router.message.outer_middleware(throttling)
+    user_router.callback_query.outer_middleware(throttling)
+    user_router.message.middleware(HandlerMetricsMiddleware())
+    user_router.callback_query.middleware(HandlerMetricsMiddleware())
     dp.include_router(user_router)
 
     try:
         print("Бот запущен и база готова!")
-        await dp.start_polling(bot, db=db)
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot, db=db, broadcaster=broadcaster)
+        else:
+            # getUpdates не работает, пока у бота установлен вебхук
+            await bot.delete_webhook()
+            await dp.start_polling(bot, db=db, broadcaster=broadcaster)
     finally:
-        scheduler.shutdown()
+        # Останавливает и службы: рассылки сохраняют чекпоинт и отпускаются
+        await runner.shutdown()
+        await close_clients()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":
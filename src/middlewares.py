@@ -0,0 +1,206 @@
+"""
+Middleware бота. HandlerMetricsMiddleware регистрируется как inner-middleware
+на message и callback_query роутера: к этому моменту фильтры уже выбрали
+обработчик, и метрики можно подписать его именем. ThrottlingMiddleware —
+outer-middleware: лишние нажатия отбрасываются еще до фильтров и обращений
+к базе.
+"""
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import CallbackQuery
+import asyncio
+import os
+import time
+
+from metrics import (
+    DEPENDENCY_TIMINGS,
+    Counter,
+    Gauge,
+    Histogram,
+    add_dependency_time,
+)
+from notifications import TokenBucket
+
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", "3"))
+THROTTLE_USER_BURST = float(os.getenv("THROTTLE_USER_BURST", "5"))
+# Лимиты на префиксы callback_data: "префикс=в_секунду/запас,..."
+THROTTLE_CALLBACK_LIMITS = os.getenv(
+    "THROTTLE_CALLBACK_LIMITS", "check_pay_=0.2/2,buy_=0.5/2,page_=2/4"
+)
+THROTTLE_IDLE_SECONDS = 60
+
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Время работы обработчика", ("handler",)
+)
+HANDLER_DEPENDENCY_SECONDS = Histogram(
+    "bot_handler_dependency_seconds",
+    "Время обработчика в ожидании db, telegram или yoomoney",
+    ("handler", "dependency"),
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Исключения в обработчиках", ("handler",)
+)
+HANDLERS_IN_FLIGHT = Gauge(
+    "bot_handlers_in_flight", "Обработчики, выполняющиеся сейчас", ("handler",)
+)
+
+THROTTLE_DROPPED = Counter(
+    "bot_throttle_dropped_total",
+    "События, отброшенные ограничителем, по сработавшему лимиту",
+    ("limit",),
+)
+THROTTLE_COALESCED = Counter(
+    "bot_throttle_coalesced_total",
+    "Повторные нажатия, дождавшиеся уже выполняющегося обработчика",
+    ("prefix",),
+)
+
+
+def parse_callback_limits(value: str):
+    """Строку "check_pay_=0.2/2,buy_=0.5/2" -> {префикс: (rate, burst)}"""
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        prefix, limit = item.strip().split("=")
+        rate, burst = limit.split("/")
+        limits[prefix] = (float(rate), float(burst))
+    return limits
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту событий от пользователя: общий token bucket на
+    пользователя и отдельные на префиксы callback_data (check_pay_, buy_...).
+    Нажатие той же кнопки, пока прошлое еще обрабатывается, не запускает
+    обработчик повторно, а дожидается его результата.
+    """
+
+    def __init__(
+        self,
+        user_rate: float = THROTTLE_USER_RATE,
+        user_burst: float = THROTTLE_USER_BURST,
+        callback_limits: dict = None,
+    ):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.callback_limits = (
+            callback_limits
+            if callback_limits is not None
+            else parse_callback_limits(THROTTLE_CALLBACK_LIMITS)
+        )
+        self.buckets = {}
+        self.in_flight = {}
+        self._swept_at = time.monotonic()
+
+    def _allow(self, key, rate: float, burst: float) -> bool:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket.try_acquire()
+
+    def _forget_idle_buckets(self):
+        now = time.monotonic()
+        if now - self._swept_at < THROTTLE_IDLE_SECONDS:
+            return
+        self._swept_at = now
+        idle = [
+            key
+            for key, bucket in self.buckets.items()
+            if now - bucket.updated_at > THROTTLE_IDLE_SECONDS
+        ]
+        for key in idle:
+            del self.buckets[key]
+
+    def _callback_prefix(self, callback_data: str):
+        matches = [p for p in self.callback_limits if callback_data.startswith(p)]
+        return max(matches, key=len) if matches else None
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        self._forget_idle_buckets()
+
+        if isinstance(event, CallbackQuery):
+            return await self._handle_callback(handler, event, data, user.id)
+
+        if not self._allow(("user", user.id), self.user_rate, self.user_burst):
+            # На сообщения не отвечаем, чтобы не плодить ответы на спам
+            THROTTLE_DROPPED.inc("user")
+            return None
+        return await handler(event, data)
+
+    async def _handle_callback(self, handler, event: CallbackQuery, data, user_id):
+        callback_data = event.data or ""
+        prefix = self._callback_prefix(callback_data)
+
+        key = (user_id, callback_data)
+        pending = self.in_flight.get(key)
+        if pending is not None:
+            THROTTLE_COALESCED.inc(prefix or "other")
+            await self._answer(event)
+            return await asyncio.shield(pending)
+
+        if not self._allow(("user", user_id), self.user_rate, self.user_burst):
+            THROTTLE_DROPPED.inc("user")
+            await self._answer(event, "⏳ Слишком много нажатий, подождите немного")
+            return None
+        if prefix is not None and not self._allow(
+            (prefix, user_id), *self.callback_limits[prefix]
+        ):
+            THROTTLE_DROPPED.inc(prefix)
+            await self._answer(event, "⏳ Слишком много нажатий, подождите немного")
+            return None
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        result = None
+        try:
+            result = await handler(event, data)
+            return result
+        finally:
+            # Ошибку получает только первый вызов, повторные просто завершаются
+            future.set_result(result)
+            del self.in_flight[key]
+
+    async def _answer(self, event: CallbackQuery, text: str = None):
+        try:
+            await event.answer(text)
+        except TelegramBadRequest:
+            # Запрос устарел — Telegram уже убрал часики сам
+            pass
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+
+        token = DEPENDENCY_TIMINGS.set({})
+        HANDLERS_IN_FLIGHT.inc(name)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+            HANDLERS_IN_FLIGHT.dec(name)
+            for dependency, seconds in DEPENDENCY_TIMINGS.get().items():
+                HANDLER_DEPENDENCY_SECONDS.observe(seconds, name, dependency)
+            DEPENDENCY_TIMINGS.reset(token)
+
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Учитывает время запросов к Bot API в метриках текущего обработчика"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            add_dependency_time("telegram", time.perf_counter() - started)
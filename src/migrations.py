@@ -0,0 +1,971 @@
+"""
+Версионированные миграции схемы.
+
+Каждая миграция применяется один раз, ее номер записывается в schema_migrations.
+Новые изменения схемы добавляются в конец MIGRATIONS, старые не редактируются.
+Шаги с concurrently=True выполняются вне транзакции по одному
+(так требует CREATE INDEX CONCURRENTLY), остальные — в одной транзакции.
+"""
+
+from dataclasses import dataclass, field
+import asyncio
+import os
+import time
+
+# Общий ключ advisory-lock, чтобы две реплики бота не мигрировали одновременно
+MIGRATIONS_LOCK_KEY = 7_340_001
+# Построение индексов на больших таблицах дольше обычного DB_COMMAND_TIMEOUT
+MIGRATION_TIMEOUT = float(os.getenv("MIGRATION_TIMEOUT", "21600"))
+# Как часто реплика проверяет, освободилась ли блокировка миграций
+MIGRATION_LOCK_POLL = float(os.getenv("MIGRATION_LOCK_POLL_SECONDS", "1"))
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    statements: list[str] = field(default_factory=list)
+    concurrently: bool = False
+
+
+MIGRATIONS = [
+    Migration(
+        1,
+        "initial schema",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                username TEXT,
+                balance NUMERIC(12, 2) DEFAULT 0.00
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS transactions (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT REFERENCES users(user_id),
+                amount NUMERIC(12, 2),
+                description TEXT,
+                created_at TIMESTAMP DEFAULT NOW()
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS payments (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                amount NUMERIC(12, 2),
+                label TEXT UNIQUE,
+                is_paid BOOLEAN DEFAULT FALSE
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS goods (
+                id SERIAL PRIMARY KEY,
+                type TEXT,
+                name TEXT UNIQUE,
+                description TEXT,
+                price NUMERIC(12, 2),
+                stock INT DEFAULT 0 CHECK (stock >= 0)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS orders (
+                id SERIAL PRIMARY KEY,
+                order_code TEXT UNIQUE NOT NULL,
+                user_id BIGINT NOT NULL,
+                product_id INT NOT NULL,
+                price_at_purchase NUMERIC(12, 2) NOT NULL,
+                status TEXT DEFAULT 'paid',
+                created_at TIMESTAMP DEFAULT NOW(),
+                completed_at TIMESTAMP,
+
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                FOREIGN KEY (product_id) REFERENCES goods(id)
+            )
+            """,
+        ],
+    ),
+    Migration(
+        2,
+        "indexes for hot queries",
+        [
+            # get_orders_by_user_id, get_last_order
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_orders_user_created
+            ON orders (user_id, created_at DESC)
+            """,
+            # get_active_orders
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_orders_active_created
+            ON orders (created_at DESC) WHERE status <> 'completed'
+            """,
+            # get_unpaid_payments
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_payments_unpaid
+            ON payments (label) INCLUDE (user_id, amount) WHERE is_paid = FALSE
+            """,
+            # JOIN orders -> goods и проверки внешнего ключа при изменении goods
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_orders_product
+            ON orders (product_id)
+            """,
+        ],
+        concurrently=True,
+    ),
+    Migration(
+        3,
+        "payment lifecycle and archive",
+        [
+            """
+            ALTER TABLE payments
+                ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP NOT NULL
+                    DEFAULT NOW() + INTERVAL '24 hours',
+                ADD COLUMN IF NOT EXISTS check_attempts INT NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS next_check_at TIMESTAMP NOT NULL DEFAULT NOW()
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS payments_archive (
+                id INT NOT NULL,
+                user_id BIGINT NOT NULL,
+                amount NUMERIC(12, 2),
+                label TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL,
+                expires_at TIMESTAMP NOT NULL,
+                check_attempts INT NOT NULL,
+                archived_at TIMESTAMP NOT NULL DEFAULT NOW()
+            ) PARTITION BY RANGE (created_at)
+            """,
+        ],
+    ),
+    Migration(
+        4,
+        "index for due payment checks",
+        [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_payments_unpaid_due
+            ON payments (next_check_at) INCLUDE (user_id, amount, label, created_at)
+            WHERE is_paid = FALSE
+            """,
+        ],
+        concurrently=True,
+    ),
+    Migration(
+        5,
+        "fsm storage",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data JSONB NOT NULL DEFAULT '{}',
+                expires_at TIMESTAMP NOT NULL
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states (expires_at)
+            """,
+        ],
+    ),
+    Migration(
+        6,
+        "buy_product function",
+        [
+            """
+            CREATE OR REPLACE FUNCTION generate_order_code() RETURNS TEXT AS $$
+            DECLARE
+                chars CONSTANT TEXT := 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789';
+                bytes BYTEA := uuid_send(gen_random_uuid());
+                code TEXT := '';
+                i INT;
+            BEGIN
+                -- байты 0-5 и 10-11 UUIDv4 случайны целиком
+                FOREACH i IN ARRAY ARRAY[0, 1, 2, 3, 4, 5, 10, 11] LOOP
+                    code := code || substr(chars, 1 + get_byte(bytes, i) % 36, 1);
+                END LOOP;
+                RETURN code;
+            END;
+            $$ LANGUAGE plpgsql VOLATILE
+            """,
+            """
+            CREATE OR REPLACE FUNCTION buy_product(
+                p_user_id BIGINT, p_product_id INT, p_price NUMERIC
+            ) RETURNS TABLE (status TEXT, order_code TEXT) AS $$
+            #variable_conflict use_column
+            DECLARE
+                new_code TEXT;
+            BEGIN
+                UPDATE users SET balance = balance - p_price
+                WHERE user_id = p_user_id AND balance >= p_price;
+                IF NOT FOUND THEN
+                    RETURN QUERY SELECT 'low_balance'::TEXT, NULL::TEXT;
+                    RETURN;
+                END IF;
+
+                -- Строку товара блокируем как можно позже: она общая для всех покупателей
+                UPDATE goods SET stock = stock - 1 WHERE id = p_product_id AND stock > 0;
+                IF NOT FOUND THEN
+                    UPDATE users SET balance = balance + p_price WHERE user_id = p_user_id;
+                    RETURN QUERY SELECT 'no_stock'::TEXT, NULL::TEXT;
+                    RETURN;
+                END IF;
+
+                FOR attempt IN 1..5 LOOP
+                    new_code := generate_order_code();
+                    BEGIN
+                        INSERT INTO orders (order_code, user_id, product_id, price_at_purchase)
+                        VALUES (new_code, p_user_id, p_product_id, p_price);
+                        RETURN QUERY SELECT 'success'::TEXT, new_code;
+                        RETURN;
+                    EXCEPTION WHEN unique_violation THEN
+                        -- код уже занят, пробуем следующий
+                    END;
+                END LOOP;
+
+                RAISE EXCEPTION 'could_not_generate_unique_code';
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+        ],
+    ),
+    Migration(
+        7,
+        "sharded stock counters",
+        [
+            """
+            ALTER TABLE goods
+                ADD COLUMN IF NOT EXISTS stock_shards INT NOT NULL DEFAULT 0
+                CHECK (stock_shards >= 0)
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS goods_stock_shards (
+                product_id INT NOT NULL REFERENCES goods(id) ON DELETE CASCADE,
+                shard INT NOT NULL,
+                stock INT NOT NULL CHECK (stock >= 0),
+                PRIMARY KEY (product_id, shard)
+            )
+            """,
+            # Записывает остаток товара. В шардированном режиме делит его поровну
+            # между stock_shards строками, goods.stock хранит итог на момент записи.
+            """
+            CREATE OR REPLACE FUNCTION set_product_stock(
+                p_product_id INT, p_stock INT
+            ) RETURNS VOID AS $$
+            DECLARE
+                shards INT;
+            BEGIN
+                SELECT stock_shards INTO shards FROM goods WHERE id = p_product_id
+                FOR UPDATE;
+
+                UPDATE goods SET stock = p_stock WHERE id = p_product_id;
+                DELETE FROM goods_stock_shards
+                WHERE product_id = p_product_id AND shard >= COALESCE(shards, 0);
+
+                IF shards > 0 THEN
+                    INSERT INTO goods_stock_shards (product_id, shard, stock)
+                    SELECT p_product_id, s, p_stock / shards + (s < p_stock % shards)::INT
+                    FROM generate_series(0, shards - 1) AS s
+                    ON CONFLICT (product_id, shard) DO UPDATE SET stock = EXCLUDED.stock;
+                END IF;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE OR REPLACE FUNCTION buy_product(
+                p_user_id BIGINT, p_product_id INT, p_price NUMERIC
+            ) RETURNS TABLE (status TEXT, order_code TEXT) AS $$
+            #variable_conflict use_column
+            DECLARE
+                new_code TEXT;
+                shards INT;
+                start_shard INT;
+                claimed BOOLEAN := FALSE;
+            BEGIN
+                UPDATE users SET balance = balance - p_price
+                WHERE user_id = p_user_id AND balance >= p_price;
+                IF NOT FOUND THEN
+                    RETURN QUERY SELECT 'low_balance'::TEXT, NULL::TEXT;
+                    RETURN;
+                END IF;
+
+                SELECT stock_shards INTO shards FROM goods WHERE id = p_product_id;
+
+                IF shards > 0 THEN
+                    -- Начинаем со случайного шарда и пропускаем занятые другими
+                    -- покупателями; если свободных нет, ждем любой непустой
+                    start_shard := floor(random() * shards)::INT;
+                    FOR attempt IN 1..shards + 1 LOOP
+                        UPDATE goods_stock_shards SET stock = stock - 1
+                        WHERE product_id = p_product_id AND stock > 0 AND shard = (
+                            SELECT shard FROM goods_stock_shards
+                            WHERE product_id = p_product_id AND stock > 0
+                            ORDER BY (shard - start_shard + shards) % shards
+                            LIMIT 1
+                            FOR UPDATE SKIP LOCKED
+                        );
+                        IF NOT FOUND THEN
+                            UPDATE goods_stock_shards SET stock = stock - 1
+                            WHERE product_id = p_product_id AND stock > 0 AND shard = (
+                                SELECT shard FROM goods_stock_shards
+                                WHERE product_id = p_product_id AND stock > 0
+                                ORDER BY (shard - start_shard + shards) % shards
+                                LIMIT 1
+                                FOR UPDATE
+                            );
+                        END IF;
+                        claimed := FOUND;
+                        EXIT WHEN claimed OR NOT EXISTS (
+                            SELECT 1 FROM goods_stock_shards
+                            WHERE product_id = p_product_id AND stock > 0
+                        );
+                    END LOOP;
+                ELSE
+                    -- Строку товара блокируем как можно позже: она общая для всех покупателей
+                    UPDATE goods SET stock = stock - 1
+                    WHERE id = p_product_id AND stock > 0;
+                    claimed := FOUND;
+                END IF;
+
+                IF NOT claimed THEN
+                    UPDATE users SET balance = balance + p_price WHERE user_id = p_user_id;
+                    RETURN QUERY SELECT 'no_stock'::TEXT, NULL::TEXT;
+                    RETURN;
+                END IF;
+
+                FOR attempt IN 1..5 LOOP
+                    new_code := generate_order_code();
+                    BEGIN
+                        INSERT INTO orders (order_code, user_id, product_id, price_at_purchase)
+                        VALUES (new_code, p_user_id, p_product_id, p_price);
+                        RETURN QUERY SELECT 'success'::TEXT, new_code;
+                        RETURN;
+                    EXCEPTION WHEN unique_violation THEN
+                        -- код уже занят, пробуем следующий
+                    END;
+                END LOOP;
+
+                RAISE EXCEPTION 'could_not_generate_unique_code';
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+        ],
+    ),
+    Migration(
+        8,
+        "keyset index for order history",
+        [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_orders_user_created_id
+            ON orders (user_id, created_at DESC, id DESC)
+            """,
+            # Полностью покрывается новым индексом
+            """
+            DROP INDEX CONCURRENTLY IF EXISTS idx_orders_user_created
+            """,
+        ],
+        concurrently=True,
+    ),
+    Migration(
+        9,
+        "keyset indexes for active orders",
+        [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_orders_active_status
+            ON orders (status, created_at DESC, id DESC) WHERE status <> 'completed'
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_orders_active_created_id
+            ON orders (created_at DESC, id DESC) WHERE status <> 'completed'
+            """,
+            """
+            DROP INDEX CONCURRENTLY IF EXISTS idx_orders_active_created
+            """,
+        ],
+        concurrently=True,
+    ),
+    Migration(
+        10,
+        "notification outbox",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS notifications (
+                id BIGSERIAL PRIMARY KEY,
+                chat_id BIGINT NOT NULL,
+                text TEXT NOT NULL,
+                reply_markup JSONB,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INT NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                last_error TEXT,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_notifications_pending
+            ON notifications (next_attempt_at, id) WHERE status = 'pending'
+            """,
+        ],
+    ),
+    Migration(
+        11,
+        "product search vector",
+        [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            "ALTER TABLE goods ADD COLUMN IF NOT EXISTS search_vector TSVECTOR",
+            """
+            CREATE OR REPLACE FUNCTION goods_search_vector_update() RETURNS TRIGGER AS $$
+            BEGIN
+                NEW.search_vector :=
+                    setweight(to_tsvector('russian', COALESCE(NEW.name, '')), 'A')
+                    || setweight(to_tsvector('russian', COALESCE(NEW.type, '')), 'B')
+                    || setweight(to_tsvector('russian', COALESCE(NEW.description, '')), 'C');
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS goods_search_vector_trigger ON goods",
+            """
+            CREATE TRIGGER goods_search_vector_trigger
+            BEFORE INSERT OR UPDATE OF name, type, description ON goods
+            FOR EACH ROW EXECUTE FUNCTION goods_search_vector_update()
+            """,
+            # Заполняем уже существующие товары через тот же триггер
+            "UPDATE goods SET name = name",
+        ],
+    ),
+    Migration(
+        12,
+        "product search indexes",
+        [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_goods_search_vector
+            ON goods USING GIN (search_vector)
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_goods_name_trgm
+            ON goods USING GIN (name gin_trgm_ops)
+            """,
+        ],
+        concurrently=True,
+    ),
+    Migration(
+        13,
+        "category summary",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS goods_categories (
+                id SERIAL PRIMARY KEY,
+                type TEXT UNIQUE NOT NULL,
+                product_count INT NOT NULL DEFAULT 0,
+                min_price NUMERIC(12, 2)
+            )
+            """,
+            # Счетчик меняется на ±1, минимальная цена пересчитывается
+            # (через индекс (type, price)) только если ушел самый дешевый товар
+            """
+            CREATE OR REPLACE FUNCTION goods_categories_update() RETURNS TRIGGER AS $$
+            BEGIN
+                IF TG_OP IN ('DELETE', 'UPDATE') AND OLD.type IS NOT NULL THEN
+                    UPDATE goods_categories SET
+                        product_count = product_count - 1,
+                        min_price = CASE
+                            WHEN OLD.price <= min_price THEN (
+                                SELECT MIN(price) FROM goods WHERE type = OLD.type
+                            )
+                            ELSE min_price
+                        END
+                    WHERE type = OLD.type;
+                END IF;
+
+                IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.type IS NOT NULL THEN
+                    INSERT INTO goods_categories (type, product_count, min_price)
+                    VALUES (NEW.type, 1, NEW.price)
+                    ON CONFLICT (type) DO UPDATE SET
+                        product_count = goods_categories.product_count + 1,
+                        min_price = CASE
+                            WHEN goods_categories.min_price IS NULL THEN NEW.price
+                            ELSE LEAST(goods_categories.min_price, NEW.price)
+                        END;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS goods_categories_trigger ON goods",
+            """
+            CREATE TRIGGER goods_categories_trigger
+            AFTER INSERT OR DELETE OR UPDATE OF type, price ON goods
+            FOR EACH ROW EXECUTE FUNCTION goods_categories_update()
+            """,
+            """
+            INSERT INTO goods_categories (type, product_count, min_price)
+            SELECT type, COUNT(*), MIN(price) FROM goods
+            WHERE type IS NOT NULL
+            GROUP BY type
+            ON CONFLICT (type) DO UPDATE SET
+                product_count = EXCLUDED.product_count,
+                min_price = EXCLUDED.min_price
+            """,
+        ],
+    ),
+    Migration(
+        14,
+        "category browsing indexes",
+        [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_goods_type_id
+            ON goods (type, id)
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_goods_type_price
+            ON goods (type, price)
+            """,
+        ],
+        concurrently=True,
+    ),
+    Migration(
+        15,
+        "broadcasts",
+        [
+            # last_user_id — чекпоинт: всем пользователям с user_id <= него
+            # рассылка уже отправлена, после рестарта продолжаем с него
+            """
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id SERIAL PRIMARY KEY,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                last_user_id BIGINT NOT NULL DEFAULT 0,
+                delivered INT NOT NULL DEFAULT 0,
+                blocked INT NOT NULL DEFAULT 0,
+                failed INT NOT NULL DEFAULT 0,
+                admin_chat_id BIGINT NOT NULL,
+                status_message_id BIGINT NOT NULL,
+                created_at TIMESTAMP DEFAULT NOW(),
+                finished_at TIMESTAMP
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_broadcasts_running
+            ON broadcasts (id) WHERE status = 'running'
+            """,
+        ],
+    ),
+    Migration(
+        16,
+        "payment created notification",
+        [
+            # Будит сверку платежей на ведущей реплике (task_runner.TaskRunner)
+            """
+            CREATE OR REPLACE FUNCTION payments_notify_created() RETURNS TRIGGER AS $$
+            BEGIN
+                PERFORM pg_notify('payment_created', NEW.label);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS payments_notify_created_trigger ON payments",
+            """
+            CREATE TRIGGER payments_notify_created_trigger
+            AFTER INSERT ON payments
+            FOR EACH ROW EXECUTE FUNCTION payments_notify_created()
+            """,
+        ],
+    ),
+    Migration(
+        17,
+        "archive only checked payments",
+        [
+            # Время последней успешной сверки: в архив уходят только счета,
+            # которые ЮMoney подтвердил неоплаченными уже после expires_at
+            """
+            ALTER TABLE payments
+                ADD COLUMN IF NOT EXISTS last_checked_at TIMESTAMP
+            """,
+            # Поиск архивного счета по метке при запоздалой оплате
+            """
+            CREATE INDEX IF NOT EXISTS idx_payments_archive_label
+            ON payments_archive (label)
+            """,
+        ],
+    ),
+    Migration(
+        18,
+        "broadcast leases",
+        [
+            # Рассылку ведет одна реплика: owner продлевает аренду вместе
+            # с чекпоинтом, просроченную аренду забирает другая реплика
+            """
+            ALTER TABLE broadcasts
+                ADD COLUMN IF NOT EXISTS owner TEXT,
+                ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP
+            """,
+        ],
+    ),
+    Migration(
+        19,
+        "shard claim fixes",
+        [
+            # FOR NO KEY UPDATE не мешает FOR KEY SHARE, которую берет проверка
+            # внешнего ключа при вставке заказа: покупатель, уже списавший из
+            # шарда, не ждет строку товара, пока мы ждем его шард
+            """
+            CREATE OR REPLACE FUNCTION set_product_stock(
+                p_product_id INT, p_stock INT
+            ) RETURNS VOID AS $$
+            DECLARE
+                shards INT;
+            BEGIN
+                SELECT stock_shards INTO shards FROM goods WHERE id = p_product_id
+                FOR NO KEY UPDATE;
+
+                UPDATE goods SET stock = p_stock WHERE id = p_product_id;
+                DELETE FROM goods_stock_shards
+                WHERE product_id = p_product_id AND shard >= COALESCE(shards, 0);
+
+                IF shards > 0 THEN
+                    INSERT INTO goods_stock_shards (product_id, shard, stock)
+                    SELECT p_product_id, s, p_stock / shards + (s < p_stock % shards)::INT
+                    FROM generate_series(0, shards - 1) AS s
+                    ON CONFLICT (product_id, shard) DO UPDATE SET stock = EXCLUDED.stock;
+                END IF;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            # set_stock_shards блокирует строку товара и все его шарды, поэтому
+            # покупатель, прочитавший старый режим, не найдет остатка: шарды уже
+            # удалены или goods.stock_shards <> 0. Тогда режим читается заново.
+            """
+            CREATE OR REPLACE FUNCTION buy_product(
+                p_user_id BIGINT, p_product_id INT, p_price NUMERIC
+            ) RETURNS TABLE (status TEXT, order_code TEXT) AS $$
+            #variable_conflict use_column
+            DECLARE
+                new_code TEXT;
+                shards INT;
+                prev_shards INT;
+                start_shard INT;
+                claimed BOOLEAN := FALSE;
+            BEGIN
+                UPDATE users SET balance = balance - p_price
+                WHERE user_id = p_user_id AND balance >= p_price;
+                IF NOT FOUND THEN
+                    RETURN QUERY SELECT 'low_balance'::TEXT, NULL::TEXT;
+                    RETURN;
+                END IF;
+
+                SELECT stock_shards INTO shards FROM goods WHERE id = p_product_id;
+
+                LOOP
+                    IF shards > 0 THEN
+                        -- Начинаем со случайного шарда и пропускаем занятые другими
+                        -- покупателями; если свободных нет, ждем любой непустой.
+                        -- Неудачная попытка откатывается к точке сохранения и
+                        -- снимает блокировки шардов, опустевших за время ожидания:
+                        -- иначе покупатель ждал бы следующий шард, держа их
+                        start_shard := floor(random() * shards)::INT;
+                        FOR attempt IN 1..shards + 1 LOOP
+                            BEGIN
+                                UPDATE goods_stock_shards SET stock = stock - 1
+                                WHERE product_id = p_product_id AND stock > 0 AND shard = (
+                                    SELECT shard FROM goods_stock_shards
+                                    WHERE product_id = p_product_id AND stock > 0
+                                    ORDER BY (shard - start_shard + shards) % shards
+                                    LIMIT 1
+                                    FOR UPDATE SKIP LOCKED
+                                );
+                                IF NOT FOUND THEN
+                                    RAISE EXCEPTION USING ERRCODE = 'no_data_found';
+                                END IF;
+                                claimed := TRUE;
+                            EXCEPTION WHEN no_data_found THEN
+                            END;
+                            EXIT WHEN claimed;
+
+                            BEGIN
+                                UPDATE goods_stock_shards SET stock = stock - 1
+                                WHERE product_id = p_product_id AND stock > 0 AND shard = (
+                                    SELECT shard FROM goods_stock_shards
+                                    WHERE product_id = p_product_id AND stock > 0
+                                    ORDER BY (shard - start_shard + shards) % shards
+                                    LIMIT 1
+                                );
+                                IF NOT FOUND THEN
+                                    RAISE EXCEPTION USING ERRCODE = 'no_data_found';
+                                END IF;
+                                claimed := TRUE;
+                            EXCEPTION WHEN no_data_found THEN
+                            END;
+                            EXIT WHEN claimed OR NOT EXISTS (
+                                SELECT 1 FROM goods_stock_shards
+                                WHERE product_id = p_product_id AND stock > 0
+                            );
+                        END LOOP;
+                    ELSE
+                        -- Строку товара блокируем как можно позже: она общая для
+                        -- всех покупателей. Условие на stock_shards перепроверяется
+                        -- после ожидания блокировки, если режим успели сменить
+                        UPDATE goods SET stock = stock - 1
+                        WHERE id = p_product_id AND stock > 0 AND stock_shards = 0;
+                        claimed := FOUND;
+                    END IF;
+
+                    EXIT WHEN claimed;
+                    -- Остатка нет; если режим успели сменить, пробуем в новом
+                    prev_shards := shards;
+                    SELECT stock_shards INTO shards FROM goods WHERE id = p_product_id;
+                    EXIT WHEN shards IS NOT DISTINCT FROM prev_shards;
+                END LOOP;
+
+                IF NOT claimed THEN
+                    UPDATE users SET balance = balance + p_price WHERE user_id = p_user_id;
+                    RETURN QUERY SELECT 'no_stock'::TEXT, NULL::TEXT;
+                    RETURN;
+                END IF;
+
+                FOR attempt IN 1..5 LOOP
+                    new_code := generate_order_code();
+                    BEGIN
+                        INSERT INTO orders (order_code, user_id, product_id, price_at_purchase)
+                        VALUES (new_code, p_user_id, p_product_id, p_price);
+                        RETURN QUERY SELECT 'success'::TEXT, new_code;
+                        RETURN;
+                    EXCEPTION WHEN unique_violation THEN
+                        -- код уже занят, пробуем следующий
+                    END;
+                END LOOP;
+
+                RAISE EXCEPTION 'could_not_generate_unique_code';
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+        ],
+    ),
+    Migration(
+        20,
+        "buy_product price check",
+        [
+            # Цену покупатель видел в кэше своей реплики, а админ мог сменить
+            # ее на другой: списываем только цену, совпадающую с goods.price
+            """
+            CREATE OR REPLACE FUNCTION buy_product(
+                p_user_id BIGINT, p_product_id INT, p_price NUMERIC
+            ) RETURNS TABLE (status TEXT, order_code TEXT) AS $$
+            #variable_conflict use_column
+            DECLARE
+                new_code TEXT;
+                shards INT;
+                prev_shards INT;
+                start_shard INT;
+                claimed BOOLEAN := FALSE;
+            BEGIN
+                IF p_price IS DISTINCT FROM (
+                    SELECT price FROM goods WHERE id = p_product_id
+                ) THEN
+                    RETURN QUERY SELECT 'price_changed'::TEXT, NULL::TEXT;
+                    RETURN;
+                END IF;
+
+                UPDATE users SET balance = balance - p_price
+                WHERE user_id = p_user_id AND balance >= p_price;
+                IF NOT FOUND THEN
+                    RETURN QUERY SELECT 'low_balance'::TEXT, NULL::TEXT;
+                    RETURN;
+                END IF;
+
+                SELECT stock_shards INTO shards FROM goods WHERE id = p_product_id;
+
+                LOOP
+                    IF shards > 0 THEN
+                        -- Начинаем со случайного шарда и пропускаем занятые другими
+                        -- покупателями; если свободных нет, ждем любой непустой.
+                        -- Неудачная попытка откатывается к точке сохранения и
+                        -- снимает блокировки шардов, опустевших за время ожидания:
+                        -- иначе покупатель ждал бы следующий шард, держа их
+                        start_shard := floor(random() * shards)::INT;
+                        FOR attempt IN 1..shards + 1 LOOP
+                            BEGIN
+                                UPDATE goods_stock_shards SET stock = stock - 1
+                                WHERE product_id = p_product_id AND stock > 0 AND shard = (
+                                    SELECT shard FROM goods_stock_shards
+                                    WHERE product_id = p_product_id AND stock > 0
+                                    ORDER BY (shard - start_shard + shards) % shards
+                                    LIMIT 1
+                                    FOR UPDATE SKIP LOCKED
+                                );
+                                IF NOT FOUND THEN
+                                    RAISE EXCEPTION USING ERRCODE = 'no_data_found';
+                                END IF;
+                                claimed := TRUE;
+                            EXCEPTION WHEN no_data_found THEN
+                            END;
+                            EXIT WHEN claimed;
+
+                            BEGIN
+                                UPDATE goods_stock_shards SET stock = stock - 1
+                                WHERE product_id = p_product_id AND stock > 0 AND shard = (
+                                    SELECT shard FROM goods_stock_shards
+                                    WHERE product_id = p_product_id AND stock > 0
+                                    ORDER BY (shard - start_shard + shards) % shards
+                                    LIMIT 1
+                                );
+                                IF NOT FOUND THEN
+                                    RAISE EXCEPTION USING ERRCODE = 'no_data_found';
+                                END IF;
+                                claimed := TRUE;
+                            EXCEPTION WHEN no_data_found THEN
+                            END;
+                            EXIT WHEN claimed OR NOT EXISTS (
+                                SELECT 1 FROM goods_stock_shards
+                                WHERE product_id = p_product_id AND stock > 0
+                            );
+                        END LOOP;
+                    ELSE
+                        -- Строку товара блокируем как можно позже: она общая для
+                        -- всех покупателей. Условие на stock_shards перепроверяется
+                        -- после ожидания блокировки, если режим успели сменить
+                        UPDATE goods SET stock = stock - 1
+                        WHERE id = p_product_id AND stock > 0 AND stock_shards = 0;
+                        claimed := FOUND;
+                    END IF;
+
+                    EXIT WHEN claimed;
+                    -- Остатка нет; если режим успели сменить, пробуем в новом
+                    prev_shards := shards;
+                    SELECT stock_shards INTO shards FROM goods WHERE id = p_product_id;
+                    EXIT WHEN shards IS NOT DISTINCT FROM prev_shards;
+                END LOOP;
+
+                IF NOT claimed THEN
+                    UPDATE users SET balance = balance + p_price WHERE user_id = p_user_id;
+                    RETURN QUERY SELECT 'no_stock'::TEXT, NULL::TEXT;
+                    RETURN;
+                END IF;
+
+                FOR attempt IN 1..5 LOOP
+                    new_code := generate_order_code();
+                    BEGIN
+                        INSERT INTO orders (order_code, user_id, product_id, price_at_purchase)
+                        VALUES (new_code, p_user_id, p_product_id, p_price);
+                        RETURN QUERY SELECT 'success'::TEXT, new_code;
+                        RETURN;
+                    EXCEPTION WHEN unique_violation THEN
+                        -- код уже занят, пробуем следующий
+                    END;
+                END LOOP;
+
+                RAISE EXCEPTION 'could_not_generate_unique_code';
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+        ],
+    ),
+    Migration(
+        21,
+        "broadcast created notification",
+        [
+            # Будит Broadcaster.run на ведущей реплике (task_runner.TaskRunner)
+            """
+            CREATE OR REPLACE FUNCTION broadcasts_notify_created() RETURNS TRIGGER AS $$
+            BEGIN
+                PERFORM pg_notify('broadcast_created', NEW.id::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS broadcasts_notify_created_trigger ON broadcasts",
+            """
+            CREATE TRIGGER broadcasts_notify_created_trigger
+            AFTER INSERT ON broadcasts
+            FOR EACH ROW EXECUTE FUNCTION broadcasts_notify_created()
+            """,
+        ],
+    ),
+    Migration(
+        22,
+        "drop unused unpaid payments index",
+        [
+            # Поиск по label идет по UNIQUE-индексу payments.label, проверки
+            # по сроку — по idx_payments_unpaid_due: этот планировщик не выбирает
+            """
+            DROP INDEX CONCURRENTLY IF EXISTS idx_payments_unpaid
+            """,
+        ],
+        concurrently=True,
+    ),
+]
+
+
+async def _drop_invalid_index(conn, statement: str):
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет INVALID-индекс,
+    # который IF NOT EXISTS молча пропустит. Удаляем его перед повтором.
+    words = statement.split()
+    if "EXISTS" not in words:
+        return
+    index_name = words[words.index("EXISTS") + 1]
+    is_invalid = await conn.fetchval(
+        """
+        SELECT NOT i.indisvalid
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = $1
+        """,
+        index_name,
+    )
+    if is_invalid:
+        await conn.execute(
+            f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}", timeout=MIGRATION_TIMEOUT
+        )
+
+
+async def _lock_migrations(conn):
+    # Ждем не в pg_advisory_lock: его запрос держит снимок, и CREATE INDEX
+    # CONCURRENTLY у реплики, владеющей блокировкой, ждал бы нас вечно
+    deadline = time.monotonic() + MIGRATION_TIMEOUT
+    while not await conn.fetchval(
+        "SELECT pg_try_advisory_lock($1)", MIGRATIONS_LOCK_KEY
+    ):
+        if time.monotonic() >= deadline:
+            raise TimeoutError("Миграции выполняет другая реплика слишком долго")
+        await asyncio.sleep(MIGRATION_LOCK_POLL)
+
+
+async def apply_migrations(pool):
+    async with pool.acquire() as conn:
+        await _lock_migrations(conn)
+        try:
+            # Под блокировкой: параллельные CREATE TABLE IF NOT EXISTS падают
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT NOW()
+                )
+                """)
+            applied = {
+                row["version"]
+                for row in await conn.fetch("SELECT version FROM schema_migrations")
+            }
+            for migration in MIGRATIONS:
+                if migration.version in applied:
+                    continue
+
+                if migration.concurrently:
+                    for statement in migration.statements:
+                        await _drop_invalid_index(conn, statement)
+                        await conn.execute(statement, timeout=MIGRATION_TIMEOUT)
+                    await conn.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                        migration.version,
+                        migration.name,
+                    )
+                else:
+                    async with conn.transaction():
+                        for statement in migration.statements:
+                            await conn.execute(statement, timeout=MIGRATION_TIMEOUT)
+                        await conn.execute(
+                            "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                            migration.version,
+                            migration.name,
+                        )
+                print(f"✅ Миграция {migration.version} ({migration.name}) применена")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_KEY)
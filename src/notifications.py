@@ -0,0 +1,198 @@
+"""
+Отправка уведомлений пользователям через очередь в таблице notifications.
+
+Обработчики только ставят сообщения в очередь (Database.enqueue_notification),
+а Notifier в фоне рассылает их с учетом лимитов Telegram: общий поток
+и отдельный поток на каждый чат. При 429 ждет retry_after, при прочих
+ошибках повторяет с растущей задержкой, заблокировавших бота
+пользователей переводит в status = 'dead'.
+"""
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+from aiogram.types import InlineKeyboardMarkup
+from datetime import timedelta
+import asyncio
+import os
+import time
+
+from database import Database
+
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "8"))
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "25"))
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", "1"))
+NOTIFY_POLL_INTERVAL = float(os.getenv("NOTIFY_POLL_INTERVAL_SECONDS", "1"))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "8"))
+NOTIFY_BATCH_SIZE = 100
+NOTIFY_LEASE = timedelta(minutes=5)
+
+
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, запас до capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (после 429 от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class Notifier:
+    def __init__(
+        self,
+        db: Database,
+        bot: Bot,
+        workers: int = NOTIFY_WORKERS,
+        global_rate: float = NOTIFY_GLOBAL_RATE,
+        chat_rate: float = NOTIFY_CHAT_RATE,
+    ):
+        self.db = db
+        self.bot = bot
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.queue = asyncio.Queue(maxsize=NOTIFY_BATCH_SIZE)
+        self.sent = 0
+        self.failed = 0
+        self.dead = 0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    async def run(self):
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        try:
+            while True:
+                try:
+                    batch = await self.db.claim_notifications(
+                        NOTIFY_BATCH_SIZE, NOTIFY_LEASE
+                    )
+                except Exception as e:
+                    print(f"Не удалось получить очередь уведомлений: {e}")
+                    batch = []
+
+                for notification in batch:
+                    await self.queue.put(notification)
+
+                if len(batch) < NOTIFY_BATCH_SIZE:
+                    await asyncio.sleep(NOTIFY_POLL_INTERVAL)
+                    self._forget_idle_chats()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def _forget_idle_chats(self):
+        now = time.monotonic()
+        idle = [
+            chat_id
+            for chat_id, bucket in self.chat_buckets.items()
+            if now - bucket.updated_at > 60
+        ]
+        for chat_id in idle:
+            del self.chat_buckets[chat_id]
+
+    async def _worker(self):
+        while True:
+            notification = await self.queue.get()
+            try:
+                await self._deliver(notification)
+            except Exception as e:
+                print(f"Ошибка воркера уведомлений: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, notification):
+        notification_id = notification["id"]
+        chat_id = notification["chat_id"]
+
+        # Общий лимит ждем первым: иначе сообщения в один чат, получившие
+        # токены чата во время паузы после 429, ушли бы после нее разом
+        await self.global_bucket.acquire()
+        chat_bucket = self._chat_bucket(chat_id)
+        if not chat_bucket.try_acquire():
+            # В этот чат недавно писали — вернем сообщение в очередь, не занимая воркер
+            await self.db.retry_notification(
+                notification_id,
+                timedelta(seconds=1 / self.chat_rate),
+                None,
+                count_attempt=False,
+            )
+            return
+
+        reply_markup = None
+        if notification["reply_markup"]:
+            reply_markup = InlineKeyboardMarkup.model_validate_json(
+                notification["reply_markup"]
+            )
+
+        try:
+            await self.bot.send_message(
+                chat_id, notification["text"], reply_markup=reply_markup
+            )
+        except TelegramRetryAfter as e:
+            self.global_bucket.pause(e.retry_after)
+            await self.db.retry_notification(
+                notification_id,
+                timedelta(seconds=e.retry_after),
+                str(e),
+                count_attempt=False,
+            )
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован или чат не существует — повтор не поможет
+            self.dead += 1
+            await self.db.dead_letter_notification(notification_id, str(e))
+        except Exception as e:
+            self.failed += 1
+            if notification["attempts"] >= NOTIFY_MAX_ATTEMPTS:
+                self.dead += 1
+                await self.db.dead_letter_notification(notification_id, str(e))
+            else:
+                delay = timedelta(seconds=min(2 ** notification["attempts"], 3600))
+                await self.db.retry_notification(notification_id, delay, str(e))
+        else:
+            self.sent += 1
+            await self.db.complete_notification(notification_id)
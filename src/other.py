@@ -1,6 +1,3 @@
-import secrets
-import string
-
 STATUS_TRANSLATIONS = {
     "paid": "✅ Оплачен",
     "packing": "📦 Собирается",
@@ -9,8 +6,3 @@ STATUS_TRANSLATIONS = {
     "completed": "🏁 Получен",
     "refunded": "🔄 Возврат",
 }
-
-
-def generate_other_code(length=8):
-    characters = string.ascii_uppercase + string.digits
-    return "".join(secrets.choice(characters) for _ in range(length))
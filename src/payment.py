@@ -1,7 +1,12 @@
 import uuid
-from yoomoney import Quickpay, Client
+from datetime import datetime, timedelta, timezone
+from yoomoney import Quickpay
 import asyncio
 
+from yoomoney_client import YooMoneyError, get_client
+
+HISTORY_PAGE_SIZE = 100
+
 
 def create_yoomoney_link(receiver: str, amount: float):
     """
@@ -23,18 +28,78 @@ def create_yoomoney_link(receiver: str, amount: float):
     return quickpay.base_url, label
 
 
-def _check_payment_sync(token: str, label: str):
-    """Проверяет, поступил ли платеж с конкретным label"""
+async def check_yoomoney_payment(token: str, label: str):
+    """
+    Проверяет, поступил ли платеж с конкретным label.
+    True — оплачен, False — ЮMoney его не нашел, None — проверить не удалось.
+    """
     try:
-        client = Client(token)
-        history = client.operation_history(label=label, records=3)
-        for operation in history.operations:
-            if operation.status == "success":
-                return True
+        history = await get_client(token).operation_history(label=label, records=3)
+        operations = history["operations"]
     except Exception as e:
-        print(f"Ошибка при запросе к ЮMoney: {e}")
-    return False
+        print(f"Ошибка при запросе к ЮMoney: {e!r}")
+        return None
+    return any(operation.get("status") == "success" for operation in operations)
 
 
-async def check_yoomoney_payment(token: str, label: str):
-    return await asyncio.to_thread(_check_payment_sync, token, label)
+async def check_yoomoney_payments(token: str, labels):
+    """
+    Проверяет метки по одной; одновременных запросов не больше
+    YOOMONEY_CHECK_CONCURRENCY (ограничивает клиент). Возвращает
+    множества оплаченных меток и меток, которые проверить не удалось.
+    """
+
+    async def check(label):
+        return label, await check_yoomoney_payment(token, label)
+
+    results = await asyncio.gather(*(check(label) for label in labels))
+    paid = {label for label, is_paid in results if is_paid}
+    unknown = {label for label, is_paid in results if is_paid is None}
+    return paid, unknown
+
+
+async def fetch_paid_labels(
+    token: str,
+    from_date: datetime,
+    till_date: datetime = None,
+    window: timedelta = timedelta(days=1),
+):
+    """
+    Выгружает историю пополнений кошелька за период одним проходом
+    (окнами по window, каждое окно — постранично) и возвращает множество
+    меток успешных платежей. Ошибки ЮMoney пробрасываются вызывающему.
+    Без till_date последнее окно открыто: платежи, пришедшие во время
+    выгрузки, тоже попадут в результат.
+    """
+    open_end = till_date is None
+    if open_end:
+        till_date = datetime.now(timezone.utc)
+    client = get_client(token)
+    paid_labels = set()
+
+    window_start = from_date
+    while window_start < till_date:
+        window_end = min(window_start + window, till_date)
+        last_open_window = open_end and window_end == till_date
+        start_record = None
+        while True:
+            history = await client.operation_history(
+                type="deposition",
+                from_date=window_start,
+                till_date=None if last_open_window else window_end,
+                start_record=start_record,
+                records=HISTORY_PAGE_SIZE,
+            )
+            # Пустая выгрузка отложила бы проверку всех счетов — это ошибка
+            if "operations" not in history:
+                raise YooMoneyError("В ответе ЮMoney нет operations")
+            for operation in history["operations"]:
+                if operation.get("status") == "success" and operation.get("label"):
+                    paid_labels.add(operation["label"])
+
+            start_record = history.get("next_record")
+            if start_record is None:
+                break
+        window_start = window_end
+
+    return paid_labels
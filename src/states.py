@@ -23,3 +23,17 @@ class SearchOrder(StatesGroup):
 
 class SearchProduct(StatesGroup):
     waiting_for_id = State()
+
+
+class BulkOrderStatus(StatesGroup):
+    waiting_for_orders = State()
+    waiting_for_status = State()
+
+
+class ImportGoods(StatesGroup):
+    waiting_for_file = State()
+
+
+class Broadcast(StatesGroup):
+    waiting_for_text = State()
+    waiting_for_confirm = State()
@@ -0,0 +1,255 @@
+"""
+Запуск фоновых задач из tasks.py поверх APScheduler.
+
+- Задача не запускается повторно, пока идет прошлый запуск
+  (max_instances=1), а пропущенные запуски схлопываются в один (coalesce).
+- Если реплик бота несколько, задачи выполняет только ведущая: та, что
+  держит сессионную advisory-блокировку SCHEDULER_LOCK_KEY. Блокировка
+  живет на отдельном соединении пула; упала реплика — соединение
+  закрылось, блокировку подхватит другая.
+- Службы (add_service) — долгие корутины вроде Notifier.run: работают,
+  пока реплика ведущая, и отменяются, когда она перестает ею быть.
+  Так общий лимит отправки в Telegram держит один процесс.
+- Интервал может быть адаптивным: после запуска next_interval()
+  говорит, через сколько секунд запускать снова, а wake() по
+  LISTEN/NOTIFY из базы ускоряет ближайший запуск.
+"""
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from datetime import datetime, timedelta
+import asyncio
+import os
+import random
+import time
+
+from database import Database
+from metrics import Counter, Gauge, Histogram
+
+SCHEDULER_LOCK_KEY = 7_340_002
+LEADER_CHECK_SECONDS = float(os.getenv("SCHEDULER_LEADER_CHECK_SECONDS", "15"))
+TASK_JITTER_SECONDS = float(os.getenv("TASK_JITTER_SECONDS", "5"))
+TASK_MISFIRE_GRACE_SECONDS = 60
+
+TASK_RUN_SECONDS = Histogram(
+    "bot_task_run_seconds",
+    "Длительность запуска фоновой задачи",
+    ("task",),
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600),
+)
+TASK_RUNS = Counter(
+    "bot_task_runs_total",
+    "Запуски фоновых задач по результату",
+    ("task", "result"),
+)
+TASK_LAST_SUCCESS = Gauge(
+    "bot_task_last_success_timestamp_seconds",
+    "Время последнего успешного запуска задачи",
+    ("task",),
+)
+
+
+class LeaderLock:
+    """Сессионная advisory-блокировка, удерживаемая на своем соединении"""
+
+    def __init__(self, db: Database, key: int = SCHEDULER_LOCK_KEY):
+        self.db = db
+        self.key = key
+        self.conn = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.conn is not None
+
+    async def refresh(self) -> bool:
+        """Проверяет, что блокировка еще наша, или пытается ее взять"""
+        if self.conn is not None:
+            try:
+                await self.conn.fetchval("SELECT 1", timeout=LEADER_CHECK_SECONDS)
+                return True
+            except Exception as e:
+                print(f"Потеряно соединение ведущей реплики: {e}")
+                await self._drop()
+
+        conn = await self.db.pool.acquire()
+        try:
+            acquired = await conn.fetchval("SELECT pg_try_advisory_lock($1)", self.key)
+        except Exception:
+            await self.db.pool.release(conn)
+            raise
+        if not acquired:
+            await self.db.pool.release(conn)
+            return False
+        self.conn = conn
+        return True
+
+    async def release(self):
+        if self.conn is None:
+            return
+        try:
+            await self.conn.execute("SELECT pg_advisory_unlock($1)", self.key)
+        except Exception as e:
+            print(f"Не удалось снять блокировку планировщика: {e}")
+        await self._drop()
+
+    async def _drop(self):
+        conn, self.conn = self.conn, None
+        # При возврате в пул соединение сбрасывается: UNLISTEN и снятие
+        # всех advisory-блокировок, если оно еще живо
+        try:
+            await self.db.pool.release(conn)
+        except Exception:
+            conn.terminate()
+
+
+class TaskRunner:
+    def __init__(self, db: Database):
+        self.db = db
+        self.leader = LeaderLock(db)
+        self.scheduler = AsyncIOScheduler(
+            job_defaults={
+                "max_instances": 1,
+                "coalesce": True,
+                "misfire_grace_time": TASK_MISFIRE_GRACE_SECONDS,
+            }
+        )
+        self.listeners = {}
+        self.services = {}
+        self._service_tasks = {}
+        Gauge(
+            "bot_task_leader",
+            "1, если эта реплика выполняет фоновые задачи",
+            callback=lambda: {(): int(self.leader.is_leader)},
+        )
+
+    def add_task(
+        self,
+        name: str,
+        func,
+        seconds: float,
+        *,
+        args=(),
+        first_run_in: float = None,
+        next_interval=None,
+    ):
+        """
+        Регистрирует задачу func(*args) с интервалом seconds.
+        next_interval — async-функция без аргументов, возвращающая интервал
+        до следующего запуска; seconds тогда лишь запасной интервал.
+        """
+        self.scheduler.add_job(
+            self._run,
+            "interval",
+            seconds=seconds,
+            jitter=TASK_JITTER_SECONDS,
+            id=name,
+            args=(name, func, args, next_interval),
+            next_run_time=datetime.now()
+            + timedelta(seconds=seconds if first_run_in is None else first_run_in),
+        )
+
+    def add_service(self, name: str, func, *, args=()):
+        """Регистрирует службу func(*args), работающую только на ведущей реплике"""
+        self.services[name] = (func, args)
+
+    def _start_services(self):
+        for name, (func, args) in self.services.items():
+            task = self._service_tasks.get(name)
+            if task is not None and not task.done():
+                continue
+            if task is not None and not task.cancelled() and task.exception():
+                print(f"Служба {name} упала: {task.exception()}, перезапускаем")
+            self._service_tasks[name] = asyncio.create_task(func(*args))
+
+    async def _stop_services(self):
+        tasks = list(self._service_tasks.values())
+        self._service_tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def listen(self, channel: str, callback):
+        """callback() вызывается на ведущей реплике при NOTIFY channel"""
+        self.listeners[channel] = callback
+
+    def wake(self, name: str, delay: float):
+        """Запустить задачу не позже чем через delay секунд"""
+        job = self.scheduler.get_job(name)
+        if job is None:
+            return
+        run_at = datetime.now().astimezone() + timedelta(seconds=delay)
+        if job.next_run_time is None or run_at < job.next_run_time:
+            job.modify(next_run_time=run_at)
+
+    def _reschedule(self, name: str, seconds: float):
+        job = self.scheduler.get_job(name)
+        if job is None:
+            return
+        seconds += random.uniform(0, TASK_JITTER_SECONDS)
+        job.modify(
+            next_run_time=datetime.now().astimezone() + timedelta(seconds=seconds)
+        )
+
+    async def _run(self, name: str, func, args, next_interval):
+        if not self.leader.is_leader:
+            TASK_RUNS.inc(name, "skipped")
+            return
+
+        started = time.perf_counter()
+        try:
+            await func(*args)
+        except Exception as e:
+            TASK_RUNS.inc(name, "error")
+            print(f"Ошибка фоновой задачи {name}: {e}")
+        else:
+            TASK_RUNS.inc(name, "ok")
+            TASK_LAST_SUCCESS.set(time.time(), name)
+        finally:
+            TASK_RUN_SECONDS.observe(time.perf_counter() - started, name)
+
+        if next_interval is not None:
+            try:
+                self._reschedule(name, await next_interval())
+            except Exception as e:
+                print(f"Не удалось вычислить интервал задачи {name}: {e}")
+
+    async def _check_leader(self):
+        was_leader = self.leader.is_leader
+        old_conn = self.leader.conn
+        try:
+            is_leader = await self.leader.refresh()
+        except Exception as e:
+            print(f"Не удалось проверить блокировку планировщика: {e}")
+            return
+
+        if is_leader and not was_leader:
+            print("Эта реплика выполняет фоновые задачи")
+        elif was_leader and not is_leader:
+            print("Реплика больше не выполняет фоновые задачи")
+
+        # Упавшие службы ведущая реплика перезапускает при следующей проверке
+        if is_leader:
+            self._start_services()
+        else:
+            await self._stop_services()
+
+        if is_leader and self.leader.conn is not old_conn:
+            # Блокировка взята на новом соединении — слушаем каналы на нем
+            for channel, callback in self.listeners.items():
+                await self.leader.conn.add_listener(
+                    channel, lambda *_, callback=callback: callback()
+                )
+
+    async def start(self):
+        await self._check_leader()
+        self.scheduler.add_job(
+            self._check_leader,
+            "interval",
+            seconds=LEADER_CHECK_SECONDS,
+            id="leader_check",
+        )
+        self.scheduler.start()
+
+    async def shutdown(self):
+        self.scheduler.shutdown(wait=False)
+        await self._stop_services()
+        await self.leader.release()
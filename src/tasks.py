@@ -1,29 +1,75 @@
+from datetime import datetime, timedelta, timezone
 from database import Database
-from payment import check_yoomoney_payment
+from payment import check_yoomoney_payments, fetch_paid_labels
 from aiogram import Bot
 import os
 
 YOOMONEY_TOKEN = os.getenv("YOOMONEY_TOKEN")
+RECONCILE_LOOKBACK_HOURS = int(os.getenv("RECONCILE_LOOKBACK_HOURS", "72"))
+# Сверка платежей: не чаще раза в MIN и не реже раза в MAX секунд
+PAYMENTS_MIN_INTERVAL = float(os.getenv("PAYMENTS_MIN_INTERVAL_SECONDS", "30"))
+PAYMENTS_MAX_INTERVAL = float(os.getenv("PAYMENTS_MAX_INTERVAL_SECONDS", "600"))
 
 
 async def check_pending_payments(db: Database, bot: Bot):
+    # Сначала сверяем все счета, которые пора проверить (включая только что
+    # просроченные), и лишь потом архивируем то, что так и не оплатили
+    await reconcile_payments(db, bot)
+
+    archived = await db.archive_expired_payments()
+    if archived:
+        print(f"Перенесено в архив просроченных счетов: {archived}")
+
+
+async def next_payments_check(db: Database) -> float:
+    """
+    Через сколько секунд снова запускать check_pending_payments: к сроку
+    ближайшей проверки неоплаченного счета, без счетов — раз в MAX.
+    """
+    delay = await db.get_next_payment_check_delay()
+    if delay is None:
+        return PAYMENTS_MAX_INTERVAL
+    return min(max(delay, PAYMENTS_MIN_INTERVAL), PAYMENTS_MAX_INTERVAL)
+
+
+async def reconcile_payments(db: Database, bot: Bot):
     pending_payments = await db.get_unpaid_payments()
+    if not pending_payments:
+        return
+
+    pending_labels = {pay["label"] for pay in pending_payments}
 
-    for pay in pending_payments:
-        label = pay["label"]
-        user_id = pay["user_id"]
-        amount = pay["amount"]
+    unknown_labels = set()
+    try:
+        since = max(
+            min(pay["created_at"] for pay in pending_payments),
+            datetime.now(timezone.utc) - timedelta(hours=RECONCILE_LOOKBACK_HOURS),
+        )
+        paid_labels = await fetch_paid_labels(YOOMONEY_TOKEN, since)
+    except Exception as e:
+        print(f"Не удалось выгрузить историю ЮMoney, проверяем по меткам: {e}")
+        paid_labels, unknown_labels = await check_yoomoney_payments(
+            YOOMONEY_TOKEN, pending_labels
+        )
 
-        is_confirmed = await check_yoomoney_payment(YOOMONEY_TOKEN, label)
+    matched = list(pending_labels & paid_labels)
+    # Непроверенные метки не откладываем: last_checked_at не сдвинется,
+    # и просроченный счет не уйдет в архив, пока ЮMoney не ответит
+    unmatched = list(pending_labels - paid_labels - unknown_labels)
+    if unmatched:
+        await db.postpone_payment_checks(unmatched)
+    if not matched:
+        return
 
-        if is_confirmed:
-            await db.set_payment_paid(label)
-            await db.add_money(user_id, amount, "Автоматическое зачисление")
+    credited = await db.credit_payments(matched, "Автоматическое зачисление")
 
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"✅ Мы обнаружили вашу оплату на сумму {amount} руб. Баланс пополнен!",
-                )
-            except Exception as e:
-                print(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+    await db.enqueue_notifications(
+        [
+            (
+                pay["user_id"],
+                f"✅ Мы обнаружили вашу оплату на сумму {pay['amount']} руб. Баланс пополнен!",
+                None,
+            )
+            for pay in credited
+        ]
+    )
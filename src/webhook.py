@@ -0,0 +1,105 @@
+"""
+Режим вебхука: Telegram присылает обновления на локальный aiohttp-сервер.
+
+Включается BOT_MODE=webhook. WEBHOOK_URL — внешний адрес (https://...),
+по которому Telegram достучится до WEBHOOK_HOST:WEBHOOK_PORT.
+"""
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+import asyncio
+import os
+import signal
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "100"))
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "5000"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT_SECONDS", "30"))
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """
+    Отвечает Telegram сразу, а обработчики запускает в фоне, не больше
+    max_concurrency одновременно. Если в очереди больше max_pending
+    обновлений, отвечает 503 — Telegram повторит доставку позже.
+    При остановке дожидается уже принятых обновлений.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        max_concurrency: int = WEBHOOK_MAX_CONCURRENCY,
+        max_pending: int = WEBHOOK_MAX_PENDING,
+        drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT,
+        **kwargs,
+    ):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_pending = max_pending
+        self.drain_timeout = drain_timeout
+        self._closing = False
+
+    async def _background_feed_update(self, bot: Bot, update: dict) -> None:
+        async with self._semaphore:
+            await super()._background_feed_update(bot, update)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self._closing or len(self._background_feed_update_tasks) >= self.max_pending:
+            return web.Response(status=503)
+        return await super().handle(request)
+
+    async def drain(self):
+        self._closing = True
+        tasks = list(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        print(f"Ожидаем завершения {len(tasks)} обработчиков...")
+        _, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+        for task in pending:
+            task.cancel()
+
+    async def close(self) -> None:
+        await self.drain()
+        await super().close()
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, **data):
+    if not WEBHOOK_URL:
+        raise ValueError("Для BOT_MODE=webhook нужна переменная WEBHOOK_URL.")
+
+    app = web.Application()
+    handler = LimitedRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, **data
+    )
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot, **data)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100),
+    )
+    print(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        await stop.wait()
+    finally:
+        # on_shutdown приложения вызывает handler.close(), который дожидается
+        # обработчиков, и только потом закрывает сессию бота
+        await runner.cleanup()
@@ -0,0 +1,221 @@
+"""
+Нагрузочная проверка вебхука: воспроизводит записанные обновления Telegram.
+
+Запуск: python src/webhook_loadtest.py updates.jsonl — по одному Update
+в JSON на строку. Бот запущен с BOT_MODE=webhook и METRICS_PORT: задержку
+обработчиков считаем по гистограмме bot_handler_seconds из /metrics
+(разница до и после прогона), ведь вебхук отвечает Telegram раньше,
+чем отработает обработчик.
+"""
+
+from aiohttp import ClientSession
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+
+from metrics import METRICS_HOST, METRICS_PORT
+from webhook import WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET
+
+LOADTEST_URL = os.getenv(
+    "LOADTEST_URL", f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+)
+LOADTEST_METRICS_URL = os.getenv(
+    "LOADTEST_METRICS_URL", f"http://{METRICS_HOST}:{METRICS_PORT}/metrics"
+)
+LOADTEST_CONCURRENCY = int(os.getenv("LOADTEST_CONCURRENCY", "100"))
+LOADTEST_REPEAT = int(os.getenv("LOADTEST_REPEAT", "1"))
+LOADTEST_DRAIN_TIMEOUT = float(os.getenv("LOADTEST_DRAIN_TIMEOUT_SECONDS", "60"))
+
+HANDLER_METRIC = "bot_handler_seconds"
+IN_FLIGHT_METRIC = "bot_handlers_in_flight"
+
+
+def load_updates(path: str):
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _parse_labels(text: str):
+    labels = {}
+    for item in text.split('",'):
+        if item:
+            name, value = item.split('="', 1)
+            labels[name] = value.rstrip('"')
+    return labels
+
+
+def parse_metrics(text: str):
+    """
+    Текст /metrics -> (гистограммы обработчиков, обработчиков в работе).
+    Гистограммы: {handler: {le: накопленное число}}.
+    """
+    histograms = {}
+    in_flight = 0.0
+    for line in text.splitlines():
+        if line.startswith(HANDLER_METRIC + "_bucket{"):
+            series, value = line.rsplit(" ", 1)
+            labels = _parse_labels(series[series.index("{") + 1 : -1])
+            histograms.setdefault(labels["handler"], {})[float(labels["le"])] = float(
+                value
+            )
+        elif line.startswith(IN_FLIGHT_METRIC):
+            in_flight += float(line.rsplit(" ", 1)[1])
+    return histograms, in_flight
+
+
+def subtract_histograms(after: dict, before: dict):
+    return {
+        handler: {
+            le: count - before.get(handler, {}).get(le, 0)
+            for le, count in buckets.items()
+        }
+        for handler, buckets in after.items()
+    }
+
+
+def merge_histograms(histograms: dict):
+    merged = {}
+    for buckets in histograms.values():
+        for le, count in buckets.items():
+            merged[le] = merged.get(le, 0) + count
+    return merged
+
+
+def histogram_quantile(q: float, buckets: dict):
+    """
+    Квантиль по накопленным корзинам, как histogram_quantile в Prometheus:
+    линейно внутри корзины. Попадание в +Inf дает верхнюю конечную границу.
+    """
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]] if bounds else 0
+    if not total:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= rank:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * (rank - below) / (count - below)
+        lower, below = bound, count
+    return lower
+
+
+def _percentile(values, q: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def fetch_metrics(session: ClientSession, url: str):
+    async with session.get(url) as response:
+        response.raise_for_status()
+        return parse_metrics(await response.text())
+
+
+async def replay(
+    updates,
+    url: str = LOADTEST_URL,
+    metrics_url: str = LOADTEST_METRICS_URL,
+    concurrency: int = LOADTEST_CONCURRENCY,
+    repeat: int = LOADTEST_REPEAT,
+    secret: str = WEBHOOK_SECRET,
+    drain_timeout: float = LOADTEST_DRAIN_TIMEOUT,
+):
+    """
+    Отправляет updates repeat раз, не больше concurrency запросов
+    одновременно, и ждет, пока бот доработает принятые обновления.
+    update_id у повторов сдвигается, чтобы они не совпадали.
+    """
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    max_update_id = max(update["update_id"] for update in updates)
+    queue = asyncio.Queue()
+    for n, update in itertools.product(range(repeat), updates):
+        queue.put_nowait(
+            {**update, "update_id": update["update_id"] + n * max_update_id}
+        )
+
+    statuses = {}
+    response_times = []
+
+    async with ClientSession() as session:
+        before, _ = await fetch_metrics(session, metrics_url)
+
+        async def sender():
+            while not queue.empty():
+                update = queue.get_nowait()
+                started = time.perf_counter()
+                async with session.post(url, json=update, headers=headers) as response:
+                    await response.read()
+                response_times.append(time.perf_counter() - started)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        sent_in = time.perf_counter() - started
+
+        # Вебхук отвечает сразу — ждем, пока обработчики в фоне закончат
+        # (в работе ни одного, и с прошлого опроса никто не завершился)
+        deadline = time.monotonic() + drain_timeout
+        finished = None
+        while True:
+            after, in_flight = await fetch_metrics(session, metrics_url)
+            total = merge_histograms(after).get(float("inf"), 0)
+            if not in_flight and total == finished or time.monotonic() > deadline:
+                break
+            finished = total
+            await asyncio.sleep(0.1)
+
+    return {
+        "sent": len(response_times),
+        "seconds": sent_in,
+        "statuses": statuses,
+        "response_times": response_times,
+        "handlers": subtract_histograms(after, before),
+        "in_flight": in_flight,
+    }
+
+
+def format_report(result: dict):
+    lines = [
+        f"Отправлено {result['sent']} обновлений за {result['seconds']:.1f} с "
+        f"({result['sent'] / result['seconds']:.0f}/с), ответы: "
+        + ", ".join(f"{s}: {n}" for s, n in sorted(result["statuses"].items())),
+        f"Ответ вебхука: p50 {_percentile(result['response_times'], 0.5) * 1000:.1f} мс, "
+        f"p99 {_percentile(result['response_times'], 0.99) * 1000:.1f} мс",
+    ]
+    if result["in_flight"]:
+        lines.append(f"Не дождались {result['in_flight']:.0f} обработчиков")
+
+    handlers = {**result["handlers"], "всего": merge_histograms(result["handlers"])}
+    for handler, buckets in handlers.items():
+        p50 = histogram_quantile(0.5, buckets)
+        if p50 is None:
+            continue
+        p99 = histogram_quantile(0.99, buckets)
+        lines.append(
+            f"{handler}: {buckets[float('inf')]:.0f} вызовов, "
+            f"p50 {p50 * 1000:.1f} мс, p99 {p99 * 1000:.1f} мс"
+        )
+    return "\n".join(lines)
+
+
+async def main(path: str):
+    if not METRICS_PORT and not os.getenv("LOADTEST_METRICS_URL"):
+        print("Задайте METRICS_PORT бота или LOADTEST_METRICS_URL")
+        return
+    updates = load_updates(path)
+    if not updates:
+        print(f"В {path} нет обновлений")
+        return
+    print(format_report(await replay(updates)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Использование: python src/webhook_loadtest.py updates.jsonl")
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1]))
@@ -0,0 +1,214 @@
+"""
+Асинхронный клиент API ЮMoney.
+
+Один aiohttp-сеанс на токен держит keep-alive соединения, число
+одновременных запросов ограничено, у каждого запроса есть таймаут.
+Circuit breaker после серии сбоев перестает обращаться к ЮMoney на
+YOOMONEY_BREAKER_RESET секунд, а затем пропускает один пробный запрос.
+
+Для локальной проверки — YOOMONEY_API_URL на заглушку yoomoney_stub.py.
+"""
+
+from datetime import datetime, timezone
+import aiohttp
+import asyncio
+import os
+import time
+
+from metrics import Counter, add_dependency_time
+
+YOOMONEY_API_URL = os.getenv("YOOMONEY_API_URL", "https://yoomoney.ru/api/")
+YOOMONEY_CHECK_CONCURRENCY = int(os.getenv("YOOMONEY_CHECK_CONCURRENCY", "5"))
+YOOMONEY_TIMEOUT = float(os.getenv("YOOMONEY_TIMEOUT_SECONDS", "10"))
+YOOMONEY_CONNECT_TIMEOUT = float(os.getenv("YOOMONEY_CONNECT_TIMEOUT_SECONDS", "5"))
+YOOMONEY_BREAKER_FAILURES = int(os.getenv("YOOMONEY_BREAKER_FAILURES", "5"))
+YOOMONEY_BREAKER_RESET = float(os.getenv("YOOMONEY_BREAKER_RESET_SECONDS", "30"))
+
+YOOMONEY_REQUESTS = Counter(
+    "bot_yoomoney_requests_total",
+    "Запросы к API ЮMoney по результату",
+    ("method", "result"),
+)
+
+
+class YooMoneyError(Exception):
+    """Ошибка ответа API ЮMoney"""
+
+
+class CircuitOpenError(YooMoneyError):
+    """ЮMoney недавно сбоил, запрос не отправлялся"""
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        failure_threshold: int = YOOMONEY_BREAKER_FAILURES,
+        reset_timeout: float = YOOMONEY_BREAKER_RESET,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        """Пробный запрос отменен, не дождавшись ответа: пустим следующий"""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probe_in_flight or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+
+def _format_date(value: datetime) -> str:
+    # RFC3339 со смещением: без него ЮMoney читает время в своем поясе.
+    # Наивное время считается локальным
+    return value.astimezone(timezone.utc).isoformat(timespec="seconds")
+
+
+class YooMoneyClient:
+    def __init__(
+        self,
+        token: str,
+        base_url: str = YOOMONEY_API_URL,
+        concurrency: int = YOOMONEY_CHECK_CONCURRENCY,
+        timeout: float = YOOMONEY_TIMEOUT,
+        breaker: CircuitBreaker = None,
+    ):
+        self.token = token
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.timeout = aiohttp.ClientTimeout(
+            total=timeout, connect=YOOMONEY_CONNECT_TIMEOUT
+        )
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=self.timeout,
+                headers={"Authorization": f"Bearer {self.token}"},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, method: str, data: dict) -> dict:
+        if not self.breaker.allow():
+            YOOMONEY_REQUESTS.inc(method, "circuit_open")
+            raise CircuitOpenError("ЮMoney временно недоступен")
+
+        started = time.perf_counter()
+        # Любой исход, кроме ответа сервиса, считается сбоем: иначе пробный
+        # запрос в half_open, упавший непредвиденно, навсегда заблокирует breaker
+        outcome = "failure"
+        try:
+            async with self._semaphore:
+                async with self._get_session().post(
+                    self.base_url + method, data=data
+                ) as response:
+                    if response.status >= 500 or response.status == 429:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info,
+                            response.history,
+                            status=response.status,
+                        )
+                    if response.status != 200:
+                        # Сервис жив, ошибка в запросе или токене
+                        outcome = "error"
+                        raise YooMoneyError(f"HTTP {response.status}")
+                    try:
+                        payload = await response.json(content_type=None)
+                    except ValueError as e:
+                        raise YooMoneyError("Ответ ЮMoney — не JSON") from e
+                    if not isinstance(payload, dict):
+                        raise YooMoneyError("Неожиданный ответ ЮMoney")
+            outcome = "error" if "error" in payload else "ok"
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            add_dependency_time("yoomoney", time.perf_counter() - started)
+            YOOMONEY_REQUESTS.inc(method, outcome)
+            if outcome == "failure":
+                self.breaker.record_failure()
+            elif outcome == "cancelled":
+                self.breaker.release_probe()
+            else:
+                self.breaker.record_success()
+
+        if outcome == "error":
+            raise YooMoneyError(payload["error"])
+        return payload
+
+    async def operation_history(
+        self,
+        *,
+        type: str = None,
+        label: str = None,
+        from_date: datetime = None,
+        till_date: datetime = None,
+        start_record: str = None,
+        records: int = None,
+    ) -> dict:
+        data = {}
+        if type is not None:
+            data["type"] = type
+        if label is not None:
+            data["label"] = label
+        if from_date is not None:
+            data["from"] = _format_date(from_date)
+        if till_date is not None:
+            data["till"] = _format_date(till_date)
+        if start_record is not None:
+            data["start_record"] = start_record
+        if records is not None:
+            data["records"] = str(records)
+        return await self._request("operation-history", data)
+
+
+_clients = {}
+
+
+def get_client(token: str) -> YooMoneyClient:
+    """Общий клиент на токен, чтобы соединения переиспользовались"""
+    client = _clients.get(token)
+    if client is None:
+        client = _clients[token] = YooMoneyClient(token)
+    return client
+
+
+async def close_clients():
+    for client in list(_clients.values()):
+        await client.close()
+    _clients.clear()
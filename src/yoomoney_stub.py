@@ -0,0 +1,122 @@
+"""
+Локальная заглушка API ЮMoney для проверки оплат без выхода в сеть.
+
+Запуск: python src/yoomoney_stub.py, затем YOOMONEY_API_URL=http://127.0.0.1:8081/api/
+Оплатить счет: POST /stub/pay с полями label и amount.
+Сбой ЮMoney: POST /stub/fail с полями status (500) и times (1) — столько
+следующих запросов истории получат этот статус.
+"""
+
+from aiohttp import web
+from datetime import datetime, timezone
+import asyncio
+import itertools
+import os
+
+STUB_HOST = os.getenv("YOOMONEY_STUB_HOST", "127.0.0.1")
+STUB_PORT = int(os.getenv("YOOMONEY_STUB_PORT", "8081"))
+
+
+def _parse_date(value: str):
+    # YooMoneyClient присылает RFC3339: 2024-01-05T03:04:05+00:00
+    return _as_utc(datetime.fromisoformat(value))
+
+
+def _as_utc(value: datetime):
+    # Наивное время считаем локальным, как и клиент
+    return value.astimezone(timezone.utc)
+
+
+class YooMoneyStub:
+    def __init__(self):
+        self.operations = []
+        self.requests = []
+        # Ответы следующих запросов истории вместо настоящих: (status, payload)
+        self.failures = []
+        # Задержка ответа на историю и сколько запросов обрабатывалось разом
+        self.delay = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._ids = itertools.count(1)
+
+    def fail(self, times: int = 1, status: int = 500, payload=None):
+        """Следующие times запросов истории получат status и payload (JSON)"""
+        self.failures.extend([(status, {} if payload is None else payload)] * times)
+
+    def pay(self, label: str, amount: float, when: datetime = None):
+        self.operations.append(
+            {
+                "operation_id": str(next(self._ids)),
+                "status": "success",
+                "datetime": _as_utc(when or datetime.now()),
+                "title": "Пополнение",
+                "direction": "in",
+                "amount": amount,
+                "label": label,
+                "type": "deposition",
+            }
+        )
+
+    def history(self, params):
+        operations = [op for op in reversed(self.operations)]
+        if "label" in params:
+            operations = [op for op in operations if op["label"] == params["label"]]
+        if "type" in params:
+            types = params["type"].split()
+            operations = [op for op in operations if op["type"] in types]
+        if "from" in params:
+            from_date = _parse_date(params["from"])
+            operations = [op for op in operations if op["datetime"] >= from_date]
+        if "till" in params:
+            till_date = _parse_date(params["till"])
+            operations = [op for op in operations if op["datetime"] < till_date]
+
+        start = int(params.get("start_record", 0))
+        records = int(params.get("records", 30))
+        page = operations[start : start + records]
+
+        data = {
+            "operations": [
+                {**op, "datetime": op["datetime"].strftime("%Y-%m-%dT%H:%M:%SZ")}
+                for op in page
+            ]
+        }
+        if start + records < len(operations):
+            data["next_record"] = str(start + records)
+        return data
+
+    async def handle_history(self, request: web.Request):
+        params = await request.post()
+        self.requests.append(dict(params))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            if self.failures:
+                status, payload = self.failures.pop(0)
+                return web.json_response(payload, status=status)
+            return web.json_response(self.history(params))
+        finally:
+            self.in_flight -= 1
+
+    async def handle_pay(self, request: web.Request):
+        params = await request.post()
+        self.pay(params["label"], float(params.get("amount", 0)))
+        return web.json_response({"status": "success"})
+
+    async def handle_fail(self, request: web.Request):
+        params = await request.post()
+        self.fail(int(params.get("times", 1)), int(params.get("status", 500)))
+        return web.json_response({"status": "success"})
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/api/operation-history", self.handle_history)
+        app.router.add_post("/stub/pay", self.handle_pay)
+        app.router.add_post("/stub/fail", self.handle_fail)
+        return app
+
+
+if __name__ == "__main__":
+    web.run_app(YooMoneyStub().make_app(), host=STUB_HOST, port=STUB_PORT)
@@ -0,0 +1,181 @@
+"""
+Замеры производительности (TEST_BENCHMARKS=1): результаты выводятся
+в разделе "замеры" в конце прогона pytest.
+"""
+
+import asyncio
+import random
+import time
+from decimal import Decimal
+
+import pytest
+
+BUYERS = 1000
+PURCHASES = 5000
+CONCURRENCY = 32
+
+CATALOG_SIZE = 1_000_000
+SEARCHES = 300
+SEARCH_TARGET_MS = 20
+BRANDS = ["Steam", "Xbox", "PlayStation", "Nintendo", "Spotify", "Netflix", "Яндекс"]
+PRODUCTS = ["ключ", "подписка", "карта", "аккаунт", "код", "пополнение", "игра"]
+EDITIONS = ["стандарт", "делюкс", "премиум", "год", "месяц", "золото", "коллекция"]
+
+
+@pytest.mark.benchmark
+def test_buy_product_throughput_by_shards(temp_db, report):
+    """Пропускная способность покупок одного товара при 0, 1, 4 и 8 шардах"""
+
+    async def scenario():
+        db = await temp_db.connect(max_size=CONCURRENCY)
+        try:
+            await db.pool.execute(
+                "INSERT INTO users (user_id, balance) "
+                "SELECT generate_series(1, $1::int), 1000000",
+                BUYERS,
+            )
+            for shards in (0, 1, 4, 8):
+                product_id = await db.pool.fetchval(
+                    "INSERT INTO goods (type, name, description, price, stock) "
+                    "VALUES ('Тест', $1, '', 1, $2) RETURNING id",
+                    f"Товар {shards}",
+                    PURCHASES,
+                )
+                await db.set_stock_shards(product_id, shards)
+                purchases = iter(range(PURCHASES))
+
+                async def buyer():
+                    for n in purchases:
+                        status, _ = await db.buy_product(
+                            n % BUYERS + 1, product_id, Decimal(1)
+                        )
+                        assert status == "success"
+
+                started = time.perf_counter()
+                await asyncio.gather(*(buyer() for _ in range(CONCURRENCY)))
+                elapsed = time.perf_counter() - started
+                report(
+                    f"buy_product, шардов {shards}: {PURCHASES / elapsed:.0f} заказов/с "
+                    f"({CONCURRENCY} параллельно)"
+                )
+        finally:
+            await db.pool.close()
+
+    asyncio.run(scenario())
+
+
+def _catalog(size: int):
+    rng = random.Random(1)
+    for n in range(1, size + 1):
+        brand, product = rng.choice(BRANDS), rng.choice(PRODUCTS)
+        yield (
+            brand,
+            f"{brand} {product} {rng.choice(EDITIONS)} {n}",
+            f"Цифровой товар: {product} для {brand}, доставка сразу после оплаты",
+            Decimal(rng.randint(100, 10000)),
+            rng.randint(0, 100),
+        )
+
+
+def _percentile(values, q: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+@pytest.mark.benchmark
+def test_search_goods_latency(temp_db, report):
+    """p95 search_goods на каталоге из миллиона товаров — меньше 20 мс"""
+
+    async def scenario():
+        db = await temp_db.connect(max_size=2)
+        try:
+            async with db.pool.acquire() as conn:
+                # Сводку категорий триггер обновлял бы на каждую строку в одной
+                # транзакции — для замера поиска она не нужна
+                await conn.execute(
+                    "ALTER TABLE goods DISABLE TRIGGER goods_categories_trigger"
+                )
+                await conn.copy_records_to_table(
+                    "goods",
+                    records=_catalog(CATALOG_SIZE),
+                    columns=["type", "name", "description", "price", "stock"],
+                    timeout=3600,
+                )
+                await conn.execute(
+                    "ALTER TABLE goods ENABLE TRIGGER goods_categories_trigger"
+                )
+                await conn.execute("VACUUM ANALYZE goods", timeout=3600)
+
+            rng = random.Random(2)
+            queries = []
+            for _ in range(SEARCHES):
+                form = rng.randrange(3)
+                if form == 0:
+                    queries.append(
+                        f"{rng.choice(PRODUCTS)} {rng.randint(1, CATALOG_SIZE)}"
+                    )
+                elif form == 1:
+                    queries.append(f"{rng.choice(BRANDS)} {rng.choice(EDITIONS)}")
+                else:
+                    # Опечатка: пропущена буква в названии бренда
+                    brand = rng.choice(BRANDS)
+                    cut = rng.randrange(1, len(brand))
+                    queries.append(brand[:cut] + brand[cut + 1 :])
+
+            timings = []
+            for text in queries:
+                started = time.perf_counter()
+                await db.search_goods(text, 10)
+                timings.append((time.perf_counter() - started) * 1000)
+
+            p50, p95 = _percentile(timings, 0.5), _percentile(timings, 0.95)
+            report(
+                f"search_goods, {CATALOG_SIZE} товаров: p50 {p50:.1f} мс, "
+                f"p95 {p95:.1f} мс (цель {SEARCH_TARGET_MS} мс)"
+            )
+            assert p95 < SEARCH_TARGET_MS
+        finally:
+            await db.pool.close()
+
+    asyncio.run(scenario())
+
+
+START_CALLS = 2000
+
+
+@pytest.mark.benchmark
+def test_register_user_round_trips(temp_db, report):
+    """/start: register_user одним запросом против прежних INSERT + get_user"""
+
+    async def two_queries(db, user_id):
+        await db.pool.execute(
+            "INSERT INTO users (user_id, username) VALUES ($1, $2) "
+            "ON CONFLICT (user_id) DO NOTHING",
+            user_id,
+            "bench",
+        )
+        return await db.get_user(user_id)
+
+    async def one_query(db, user_id):
+        return await db.register_user(user_id, "bench")
+
+    async def scenario():
+        db = await temp_db.connect(max_size=1)
+        try:
+            for name, start, first_id in (
+                ("INSERT + get_user", two_queries, 1),
+                ("register_user", one_query, START_CALLS + 1),
+            ):
+                for kind in ("новый", "повторный"):
+                    started = time.perf_counter()
+                    for user_id in range(first_id, first_id + START_CALLS):
+                        assert await start(db, user_id) is not None
+                    elapsed = time.perf_counter() - started
+                    report(
+                        f"/start, {name}, {kind} пользователь: "
+                        f"{elapsed / START_CALLS * 1e6:.0f} мкс на вызов"
+                    )
+        finally:
+            await db.pool.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,79 @@
+import asyncio
+import random
+import time
+from decimal import Decimal
+
+import pytest
+
+BUYERS = 500
+STOCK = 100
+PRICE = Decimal(10)
+
+
+@pytest.mark.parametrize("shards", [0, 8, "toggle"])
+def test_no_oversell(temp_db, report, shards):
+    """
+    500 покупателей одновременно покупают товар с остатком 100: ровно 100
+    заказов, остаток 0, деньги списаны только у купивших. В режиме toggle
+    админ параллельно переключает шардирование остатка. Пропускная
+    способность попадает в отчет о замерах.
+    """
+
+    async def scenario():
+        db = await temp_db.connect(max_size=40)
+        try:
+            await db.pool.execute(
+                "INSERT INTO users (user_id, balance) "
+                "SELECT generate_series(1, $1::int), 100",
+                BUYERS,
+            )
+            product_id = await db.pool.fetchval(
+                "INSERT INTO goods (type, name, description, price, stock) "
+                "VALUES ('Тест', 'Товар', '', $1, $2) RETURNING id",
+                PRICE,
+                STOCK,
+            )
+            if shards != "toggle":
+                await db.set_stock_shards(product_id, shards)
+
+            buying = True
+
+            async def toggle_shards():
+                while buying:
+                    await db.set_stock_shards(product_id, random.choice([0, 3, 8]))
+                    await asyncio.sleep(0)
+
+            toggler = (
+                asyncio.create_task(toggle_shards()) if shards == "toggle" else None
+            )
+            started = time.perf_counter()
+            try:
+                results = await asyncio.gather(
+                    *(
+                        db.buy_product(user_id, product_id, PRICE)
+                        for user_id in range(1, BUYERS + 1)
+                    )
+                )
+            finally:
+                buying = False
+                if toggler is not None:
+                    await toggler
+            elapsed = time.perf_counter() - started
+
+            statuses = [status for status, _ in results]
+            assert statuses.count("success") == STOCK
+            assert statuses.count("no_stock") == BUYERS - STOCK
+            report(
+                f"buy_product, {BUYERS} покупателей, шардов {shards}: "
+                f"{BUYERS / elapsed:.0f} вызовов/с, {STOCK / elapsed:.0f} заказов/с"
+            )
+
+            assert await db.pool.fetchval("SELECT COUNT(*) FROM orders") == STOCK
+            product = await db.get_product_by_id(product_id)
+            assert product["stock"] == 0
+            spent = await db.pool.fetchval("SELECT SUM(100 - balance) FROM users")
+            assert spent == STOCK * PRICE
+        finally:
+            await db.pool.close()
+
+    asyncio.run(scenario())
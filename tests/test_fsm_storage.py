@@ -0,0 +1,68 @@
+import asyncio
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm_storage import PostgresStorage
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=2)
+
+# Считаем записанные строки fsm_states триггером
+COUNT_WRITES_SQL = """
+CREATE TABLE fsm_writes (op TEXT);
+CREATE FUNCTION count_fsm_write() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO fsm_writes VALUES (TG_OP);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER count_fsm_write AFTER INSERT OR UPDATE OR DELETE ON fsm_states
+FOR EACH ROW EXECUTE FUNCTION count_fsm_write();
+"""
+
+
+def test_clear_writes_only_when_needed(temp_db):
+    """
+    state.clear() без диалога ничего не пишет, диалог без данных удаляет
+    одним DELETE; пустых строк в fsm_states не остается, а данные без
+    состояния set_state(None) не теряет.
+    """
+
+    async def scenario():
+        db = await temp_db.connect()
+        try:
+            await db.pool.execute(COUNT_WRITES_SQL)
+            state = FSMContext(PostgresStorage(db), KEY)
+
+            async def writes():
+                ops = await db.pool.fetch("DELETE FROM fsm_writes RETURNING op")
+                return [row["op"] for row in ops]
+
+            async def rows():
+                return await db.pool.fetchval("SELECT COUNT(*) FROM fsm_states")
+
+            await state.clear()
+            assert await writes() == []
+
+            await state.set_state("Buy:confirm")
+            await writes()
+            await state.clear()
+            assert await writes() == ["DELETE"]
+            assert await rows() == 0
+
+            await state.set_state("Buy:confirm")
+            await state.update_data(prod_id=1)
+            await state.set_state(None)
+            assert await state.get_data() == {"prod_id": 1}
+            assert await state.get_state() is None
+            await state.clear()
+            assert await rows() == 0
+
+            await state.update_data(prod_id=1)
+            await writes()
+            await state.set_data({})
+            assert await writes() == ["DELETE"]
+        finally:
+            await db.pool.close()
+
+    asyncio.run(scenario())
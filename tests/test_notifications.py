@@ -0,0 +1,217 @@
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+import notifications
+import task_runner
+from notifications import Notifier
+from task_runner import TaskRunner
+
+CHATS = 20
+MESSAGES_PER_CHAT = 3
+BLOCKED_CHAT = 999
+CHAT_RATE = 5
+RETRY_AFTER = 1
+WORKERS = 8
+
+
+class FakeBotAPI:
+    """sendMessage локального Bot API: первый запрос — 429, BLOCKED_CHAT — 403"""
+
+    def __init__(self, rate_limit_first: bool = True):
+        self.sent = []
+        self.rate_limited_at = None if rate_limit_first else 0.0
+
+    async def send_message(self, request: web.Request):
+        data = await request.post()
+        chat_id = int(data["chat_id"])
+        if self.rate_limited_at is None:
+            self.rate_limited_at = time.monotonic()
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {RETRY_AFTER}",
+                    "parameters": {"retry_after": RETRY_AFTER},
+                },
+                status=429,
+            )
+        if chat_id == BLOCKED_CHAT:
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 403,
+                    "description": "Forbidden: bot was blocked by the user",
+                },
+                status=403,
+            )
+
+        self.sent.append((time.monotonic(), chat_id, data["text"]))
+        return web.json_response(
+            {
+                "ok": True,
+                "result": {
+                    "message_id": len(self.sent),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": data["text"],
+                },
+            }
+        )
+
+
+async def start_fake_api(api: FakeBotAPI):
+    app = web.Application()
+    app.router.add_post("/bot{token}/sendMessage", api.send_message)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    bot = Bot(
+        "123:test",
+        session=AiohttpSession(
+            api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")
+        ),
+    )
+    return runner, bot
+
+
+def test_notifier_respects_limits(temp_db, monkeypatch):
+    """
+    Notifier доставляет очередь через локальный Bot API: после 429 пауза
+    retry_after для всех чатов, в один чат не чаще CHAT_RATE сообщений
+    в секунду, заблокировавший бота чат уходит в dead.
+    """
+    monkeypatch.setattr(notifications, "NOTIFY_POLL_INTERVAL", 0.05)
+
+    async def scenario():
+        api = FakeBotAPI()
+        runner, bot = await start_fake_api(api)
+        db = await temp_db.connect(max_size=10)
+        notifier_task = None
+        try:
+            await db.enqueue_notifications(
+                [
+                    (chat_id, f"{chat_id}:{n}", None)
+                    for n in range(MESSAGES_PER_CHAT)
+                    for chat_id in range(1, CHATS + 1)
+                ]
+                + [(BLOCKED_CHAT, "blocked", None)]
+            )
+            notifier = Notifier(
+                db, bot, workers=WORKERS, global_rate=200, chat_rate=CHAT_RATE
+            )
+            notifier_task = asyncio.create_task(notifier.run())
+
+            deadline = time.monotonic() + 30
+            while await db.pool.fetchval(
+                "SELECT COUNT(*) FROM notifications WHERE status = 'pending'"
+            ):
+                assert time.monotonic() < deadline, "очередь не разошлась"
+                await asyncio.sleep(0.1)
+        finally:
+            if notifier_task is not None:
+                notifier_task.cancel()
+                await asyncio.gather(notifier_task, return_exceptions=True)
+            await db.pool.close()
+            await bot.session.close()
+            await runner.cleanup()
+
+        texts = sorted(text for _, _, text in api.sent)
+        assert texts == sorted(
+            f"{chat_id}:{n}"
+            for n in range(MESSAGES_PER_CHAT)
+            for chat_id in range(1, CHATS + 1)
+        )
+
+        # Во время паузы доходят лишь запросы, уже отправленные другими воркерами
+        paused = [
+            sent_at
+            for sent_at, _, _ in api.sent
+            if 0 < sent_at - api.rate_limited_at < RETRY_AFTER * 0.9
+        ]
+        assert len(paused) < WORKERS
+
+        by_chat = {}
+        for sent_at, chat_id, _ in api.sent:
+            by_chat.setdefault(chat_id, []).append(sent_at)
+        for times in by_chat.values():
+            gaps = [b - a for a, b in zip(times, times[1:])]
+            assert min(gaps) >= 1 / CHAT_RATE * 0.9
+
+        return notifier
+
+    notifier = asyncio.run(scenario())
+    assert notifier.dead == 1
+
+
+def test_replicas_share_global_rate(temp_db, monkeypatch):
+    """
+    Две реплики с общим outbox: отправляет только ведущая, так что вместе
+    они не превышают GLOBAL_RATE. Остановилась ведущая — очередь дошлет
+    другая.
+    """
+    monkeypatch.setattr(notifications, "NOTIFY_POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(task_runner, "LEADER_CHECK_SECONDS", 0.2)
+    monkeypatch.setattr(task_runner, "TASK_JITTER_SECONDS", 0)
+    global_rate = 60
+    # Больше NOTIFY_BATCH_SIZE: каждая реплика успела бы забрать свою пачку
+    messages = 300
+
+    async def wait_sent(db):
+        deadline = time.monotonic() + 30
+        while await db.pool.fetchval(
+            "SELECT COUNT(*) FROM notifications WHERE status = 'pending'"
+        ):
+            assert time.monotonic() < deadline, "очередь не разошлась"
+            await asyncio.sleep(0.1)
+
+    async def scenario():
+        api = FakeBotAPI(rate_limit_first=False)
+        runner, bot = await start_fake_api(api)
+        replicas = []
+        try:
+            for _ in range(2):
+                db = await temp_db.connect(max_size=10)
+                notifier = Notifier(db, bot, workers=WORKERS, global_rate=global_rate)
+                task_runner_ = TaskRunner(db)
+                task_runner_.add_service("notifier", notifier.run)
+                replicas.append((db, notifier, task_runner_))
+                await task_runner_.start()
+
+            db = replicas[0][0]
+            await db.enqueue_notifications(
+                [(chat_id, str(chat_id), None) for chat_id in range(1, messages + 1)]
+            )
+            await wait_sent(db)
+            times = sorted(sent_at for sent_at, _, _ in api.sent)
+            assert len(times) == messages
+            # Запас bucket — global_rate сообщений сразу, остальные по лимиту;
+            # у двух независимых bucket'ов ушло бы вдвое быстрее
+            assert times[-1] - times[0] >= (messages - global_rate) / global_rate * 0.9
+            senders = [notifier for _, notifier, _ in replicas if notifier.sent]
+            assert len(senders) == 1
+
+            leader = next(r for r in replicas if r[1] is senders[0])
+            follower = next(r for r in replicas if r is not leader)
+            await leader[2].shutdown()
+            replicas.remove(leader)
+            await leader[0].pool.close()
+            await follower[1].db.enqueue_notifications(
+                [(chat_id, "again", None) for chat_id in range(1, 4)]
+            )
+            await wait_sent(follower[0])
+            assert follower[1].sent == 3
+        finally:
+            for db, _, task_runner_ in replicas:
+                await task_runner_.shutdown()
+                await db.pool.close()
+            await bot.session.close()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
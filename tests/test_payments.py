@@ -0,0 +1,68 @@
+import asyncio
+from decimal import Decimal
+
+import tasks
+
+PAYMENTS = 300
+ROUNDS = 3
+
+
+def test_payment_credited_exactly_once(temp_db, monkeypatch):
+    """
+    Ручная проверка оплаты (credit_payment, дважды на счет — двойное
+    нажатие) идет параллельно с несколькими фоновыми сверками: каждый
+    счет зачисляется ровно один раз.
+    """
+
+    async def fake_fetch_paid_labels(token, from_date, *args, **kwargs):
+        # ЮMoney видит все счета оплаченными; пауза дает запросам перемешаться
+        await asyncio.sleep(0)
+        return set(labels)
+
+    monkeypatch.setattr(tasks, "fetch_paid_labels", fake_fetch_paid_labels)
+    labels = []
+
+    async def scenario():
+        db = await temp_db.connect(max_size=20)
+        try:
+            await db.pool.execute(
+                "INSERT INTO users (user_id) SELECT generate_series(1, $1::int)",
+                PAYMENTS,
+            )
+            for round in range(ROUNDS):
+                labels[:] = [f"label-{round}-{i}" for i in range(1, PAYMENTS + 1)]
+                await asyncio.gather(
+                    *(
+                        db.create_payment(i, Decimal(i), label)
+                        for i, label in enumerate(labels, start=1)
+                    )
+                )
+
+                await asyncio.gather(
+                    *(tasks.check_pending_payments(db, None) for _ in range(4)),
+                    *(
+                        db.credit_payment(label, "Ручная проверка")
+                        for label in labels * 2
+                    ),
+                )
+
+                unpaid = await db.pool.fetchval(
+                    "SELECT COUNT(*) FROM payments WHERE is_paid = FALSE"
+                )
+                assert unpaid == 0
+                mismatched = await db.pool.fetch(
+                    """
+                    SELECT u.user_id, u.balance, COUNT(t.*) AS credits
+                    FROM users u
+                    LEFT JOIN transactions t ON t.user_id = u.user_id
+                    GROUP BY u.user_id
+                    HAVING u.balance <> u.user_id * $1::int
+                        OR COUNT(t.*) <> $1::int
+                    """,
+                    round + 1,
+                )
+                assert mismatched == []
+        finally:
+            await db.pool.close()
+
+    asyncio.run(scenario())
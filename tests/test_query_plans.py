@@ -0,0 +1,286 @@
+"""
+Планы запросов Database на большой выборке: ни один метод горячего пути
+не должен читать большие таблицы последовательным сканированием.
+
+Запросы перехватываются на уровне соединения, затем для каждого
+выполняется EXPLAIN с теми же параметрами. Методы, которые по смыслу
+читают таблицу целиком (статистика, архивация, импорт), сюда не входят.
+Далекие страницы каталога и истории заказов дополнительно сравниваются
+с первыми по EXPLAIN ANALYZE: читать они должны столько же строк.
+"""
+
+import asyncio
+import json
+from decimal import Decimal
+
+import asyncpg
+
+LARGE_TABLES = {"users", "goods", "orders", "payments", "transactions"}
+EXPLAINED_COMMANDS = ("SELECT", "WITH", "UPDATE", "DELETE", "INSERT")
+
+FIXTURE_SQL = [
+    """
+    INSERT INTO users (user_id, username, balance)
+    SELECT g, 'user' || g, 1000 FROM generate_series(1, 50000) g
+    """,
+    """
+    INSERT INTO goods (type, name, description, price, stock)
+    SELECT 'Категория ' || g % 50, 'Товар ' || g, 'Описание товара ' || g,
+           10 + g % 990, g % 20
+    FROM generate_series(1, 20000) g
+    """,
+    # Почти все заказы завершены, как в живой базе
+    """
+    INSERT INTO orders (
+        order_code, user_id, product_id, price_at_purchase, status, created_at
+    )
+    SELECT 'CODE' || g, 1 + g % 50000, 1 + g % 20000, 100,
+           CASE WHEN g % 50 = 0 THEN 'paid' ELSE 'completed' END,
+           NOW() - g * INTERVAL '1 minute'
+    FROM generate_series(1, 200000) g
+    """,
+    # Длинная история одного покупателя для глубоких страниц заказов
+    """
+    INSERT INTO orders (
+        order_code, user_id, product_id, price_at_purchase, status, created_at
+    )
+    SELECT 'DEEP' || g, 7777, 1 + g % 20000, 100, 'completed',
+           NOW() - g * INTERVAL '1 second'
+    FROM generate_series(1, 100000) g
+    """,
+    """
+    INSERT INTO payments (
+        user_id, amount, label, is_paid, created_at, expires_at, next_check_at
+    )
+    SELECT 1 + g % 50000, 100, 'label-' || g, g % 100 <> 0,
+           NOW() - g * INTERVAL '1 minute', NOW() + INTERVAL '1 day',
+           NOW() + (g % 7 - 3) * INTERVAL '1 minute'
+    FROM generate_series(1, 50000) g
+    """,
+    """
+    INSERT INTO transactions (user_id, amount, description)
+    SELECT 1 + g % 50000, 100, 'Пополнение' FROM generate_series(1, 100000) g
+    """,
+    # VACUUM переносит список ожидания GIN в индекс, как сделал бы
+    # autovacuum: иначе планировщик считает поиск по GIN слишком дорогим
+    "VACUUM ANALYZE",
+]
+
+# Вызовы методов горячего пути: (название, функция от db)
+CASES = [
+    ("register_user", lambda db: db.register_user(123, "user123")),
+    ("get_user", lambda db: db.get_user(123)),
+    ("get_profile", lambda db: db.get_profile(123)),
+    ("get_balance", lambda db: db.get_balance(123)),
+    ("get_payment", lambda db: db.get_payment("label-100")),
+    ("get_unpaid_payments", lambda db: db.get_unpaid_payments()),
+    ("get_next_payment_check_delay", lambda db: db.get_next_payment_check_delay()),
+    ("postpone_payment_checks", lambda db: db.postpone_payment_checks(["label-200"])),
+    ("credit_payment", lambda db: db.credit_payment("label-300", "Тест")),
+    ("get_goods_page", lambda db: db.get_goods_page(10, after_id=5000)),
+    ("get_goods_page before", lambda db: db.get_goods_page(10, before_id=5000)),
+    ("get_goods_page category", lambda db: db.get_goods_page(10, category_id=1)),
+    ("get_product_by_id", lambda db: db.get_product_by_id(456)),
+    (
+        "edit_product",
+        lambda db: db.edit_product(456, "Категория 6", "Товар 456", "", Decimal(10), 5),
+    ),
+    ("get_order_by_id", lambda db: db.get_order_by_id(1000)),
+    ("get_order_by_code", lambda db: db.get_order_by_code("CODE1000")),
+    ("get_orders_page", lambda db: db.get_orders_page(123, 10)),
+    ("get_orders_page after", lambda db: db.get_orders_page(123, 10, after_id=50123)),
+    ("get_orders_page before", lambda db: db.get_orders_page(123, 10, before_id=50123)),
+    ("update_order_status", lambda db: db.update_order_status("packing", order_id=50)),
+    (
+        "update_order_status by code",
+        lambda db: db.update_order_status("packing", order_code="CODE100"),
+    ),
+    (
+        "bulk_update_order_status",
+        lambda db: db.bulk_update_order_status("shipping", order_ids=[150, 200]),
+    ),
+    (
+        "bulk_update_order_status by codes",
+        lambda db: db.bulk_update_order_status("shipping", order_codes=["CODE250"]),
+    ),
+    ("get_active_orders_page", lambda db: db.get_active_orders_page(10)),
+    (
+        "get_active_orders_page status",
+        lambda db: db.get_active_orders_page(10, status="paid", after_id=1000),
+    ),
+    ("get_active_order_counts", lambda db: db.get_active_order_counts()),
+    ("get_broadcast_recipients", lambda db: db.get_broadcast_recipients(25000, 500)),
+    ("buy_product", lambda db: db.buy_product(123, 456, Decimal(466))),
+    ("add_money", lambda db: db.add_money(123, Decimal(1), "Тест")),
+    ("search_goods", lambda db: db.search_goods("Товар 12345", 10)),
+]
+
+# Вызовы, план которых обязан читать через эти индексы
+INDEX_CASES = [
+    (
+        "search_goods",
+        lambda db: db.search_goods("Товар 12345", 10),
+        {"idx_goods_search_vector", "idx_goods_name_trgm"},
+    ),
+]
+
+# Первая и далекая страницы: (название, первая, далекая). Далекая должна
+# читать столько же строк, сколько первая, — проход по индексу от курсора
+# без сортировки всей выборки и без OFFSET.
+# 299990 — заказ покупателя 7777 на 10 000-й странице по 10
+DEEP_PAGE_LIMIT = 10
+DEEP_PAGE_CASES = [
+    (
+        "get_goods_page after",
+        lambda db: db.get_goods_page(DEEP_PAGE_LIMIT),
+        lambda db: db.get_goods_page(DEEP_PAGE_LIMIT, after_id=19980),
+    ),
+    (
+        "get_goods_page before",
+        lambda db: db.get_goods_page(DEEP_PAGE_LIMIT, before_id=21),
+        lambda db: db.get_goods_page(DEEP_PAGE_LIMIT, before_id=19980),
+    ),
+    (
+        "get_goods_page category",
+        lambda db: db.get_goods_page(DEEP_PAGE_LIMIT, category_id=1),
+        lambda db: db.get_goods_page(DEEP_PAGE_LIMIT, after_id=19000, category_id=1),
+    ),
+    (
+        "get_orders_page after",
+        lambda db: db.get_orders_page(7777, DEEP_PAGE_LIMIT),
+        lambda db: db.get_orders_page(7777, DEEP_PAGE_LIMIT, after_id=299990),
+    ),
+    (
+        "get_orders_page before",
+        lambda db: db.get_orders_page(7777, DEEP_PAGE_LIMIT, before_id=200100),
+        lambda db: db.get_orders_page(7777, DEEP_PAGE_LIMIT, before_id=299990),
+    ),
+]
+
+
+class RecordingConnection(asyncpg.Connection):
+    """Запоминает запросы, отправленные через публичные методы"""
+
+    recorded = []
+
+    def _record(self, query, args):
+        command = query.lstrip().split(None, 1)[0].upper()
+        # Сброс соединения при возврате в пул — несколько команд через ";"
+        if command in EXPLAINED_COMMANDS and ";" not in query.strip().rstrip(";"):
+            self.recorded.append((query, args))
+
+    async def execute(self, query, *args, **kwargs):
+        self._record(query, args)
+        return await super().execute(query, *args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        self._record(query, args)
+        return await super().fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        self._record(query, args)
+        return await super().fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        self._record(query, args)
+        return await super().fetchval(query, *args, **kwargs)
+
+
+def _seq_scans(plan):
+    """Большие таблицы, которые план читает последовательно"""
+    found = []
+    if plan.get("Node Type") == "Seq Scan" and plan["Relation Name"] in LARGE_TABLES:
+        found.append(plan["Relation Name"])
+    for child in plan.get("Plans", ()):
+        found.extend(_seq_scans(child))
+    return found
+
+
+def _index_names(plan):
+    names = {plan["Index Name"]} if "Index Name" in plan else set()
+    for child in plan.get("Plans", ()):
+        names |= _index_names(child)
+    return names
+
+
+def _rows_read(plan):
+    """Строки, которые прочитали узлы сканирования плана (EXPLAIN ANALYZE)"""
+    rows = 0
+    if "Scan" in plan["Node Type"]:
+        rows = (plan["Actual Rows"] + plan.get("Rows Removed by Filter", 0)) * plan[
+            "Actual Loops"
+        ]
+    return rows + sum(_rows_read(child) for child in plan.get("Plans", ()))
+
+
+def _sorts_under_limit(plan, limited=False):
+    """Sort ниже Limit — страница сортирует все подходящие строки"""
+    found = int(limited and plan["Node Type"] == "Sort")
+    limited = limited or plan["Node Type"] == "Limit"
+    return found + sum(
+        _sorts_under_limit(child, limited) for child in plan.get("Plans", ())
+    )
+
+
+async def _explain(db, call, options="FORMAT JSON"):
+    """Планы запросов, которые выполняет call(db)"""
+    RecordingConnection.recorded = []
+    await call(db)
+    plans = []
+    async with db.pool.acquire() as conn:
+        for query, args in RecordingConnection.recorded:
+            plan = json.loads(
+                await conn.fetchval(f"EXPLAIN ({options}) " + query, *args)
+            )[0]["Plan"]
+            plans.append((query, plan))
+    return plans
+
+
+def test_hot_queries_use_indexes(temp_db):
+    async def scenario():
+        db = await temp_db.connect(connection_class=RecordingConnection)
+        db.product_cache = None
+        try:
+            async with db.pool.acquire() as conn:
+                for statement in FIXTURE_SQL:
+                    await conn.execute(statement, timeout=600)
+
+            offenders = []
+            for name, call in CASES:
+                plans = await _explain(db, call)
+                assert plans, f"{name}: нет запросов"
+                for query, plan in plans:
+                    for table in _seq_scans(plan):
+                        offenders.append(f"{name}: Seq Scan on {table}\n{query}")
+
+            for name, call, indexes in INDEX_CASES:
+                used = set()
+                for _, plan in await _explain(db, call):
+                    used |= _index_names(plan)
+                if not indexes <= used:
+                    offenders.append(f"{name}: не использованы {indexes - used}")
+
+            for name, first, deep in DEEP_PAGE_CASES:
+                first_rows = sum(
+                    _rows_read(plan)
+                    for _, plan in await _explain(db, first, "ANALYZE, FORMAT JSON")
+                )
+                deep_plans = await _explain(db, deep, "ANALYZE, FORMAT JSON")
+                deep_rows = sum(_rows_read(plan) for _, plan in deep_plans)
+                if deep_rows > 2 * first_rows:
+                    offenders.append(
+                        f"{name}: далекая страница прочитала {deep_rows} строк, "
+                        f"первая — {first_rows}"
+                    )
+                for query, plan in deep_plans:
+                    if not _index_names(plan):
+                        offenders.append(f"{name}: нет Index Scan\n{query}")
+                    if _sorts_under_limit(plan):
+                        offenders.append(f"{name}: Sort до Limit\n{query}")
+                    if "OFFSET" in query.upper():
+                        offenders.append(f"{name}: OFFSET\n{query}")
+            assert not offenders, "\n\n".join(offenders)
+        finally:
+            await db.pool.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,29 @@
+import asyncio
+
+
+def test_first_start_racing_another_insert(temp_db):
+    """
+    Первый /start ждет чужую незавершенную вставку того же пользователя
+    (второй /start, пришедший разом): register_user все равно возвращает
+    строку пользователя.
+    """
+
+    async def scenario():
+        db = await temp_db.connect(max_size=5)
+        try:
+            async with db.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(
+                        "INSERT INTO users (user_id, username) VALUES (1, 'user1')"
+                    )
+                    racing = asyncio.create_task(db.register_user(1, "user1"))
+                    # Дадим ему упереться в блокировку нашей вставки
+                    await asyncio.sleep(0.5)
+                    assert not racing.done()
+            user = await racing
+            assert user is not None and user["user_id"] == 1
+            assert await db.pool.fetchval("SELECT COUNT(*) FROM users") == 1
+        finally:
+            await db.pool.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Message
+from aiohttp import web
+
+from metrics import render_metrics
+from middlewares import HandlerMetricsMiddleware
+from webhook import LimitedRequestHandler
+import webhook_loadtest
+
+UPDATES = 200
+HANDLER_DELAY = 0.02
+SECRET = "test-secret"
+
+
+def _update(update_id: int):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": update_id, "type": "private"},
+            "from": {"id": update_id, "is_bot": False, "first_name": "Тест"},
+            "text": "/start",
+        },
+    }
+
+
+def test_histogram_quantile():
+    buckets = {0.01: 0, 0.1: 50, 1.0: 100, float("inf"): 100}
+    assert abs(webhook_loadtest.histogram_quantile(0.5, buckets) - 0.1) < 1e-9
+    assert abs(webhook_loadtest.histogram_quantile(0.75, buckets) - 0.55) < 1e-9
+    assert webhook_loadtest.histogram_quantile(0.5, {float("inf"): 0}) is None
+
+
+def test_replay_reports_handler_latency(tmp_path):
+    """
+    Записанные обновления проигрываются в LimitedRequestHandler, задержка
+    обработчиков берется из /metrics: учтены все обновления, p50 попадает
+    в корзину времени работы обработчика, хотя вебхук отвечает раньше.
+    """
+    path = tmp_path / "updates.jsonl"
+    path.write_text(
+        "\n".join(json.dumps(_update(i)) for i in range(1, UPDATES + 1)) + "\n"
+    )
+
+    async def loadtest_echo(message: Message):
+        await asyncio.sleep(HANDLER_DELAY)
+
+    async def scenario():
+        router = Router()
+        router.message.middleware(HandlerMetricsMiddleware())
+        router.message.register(loadtest_echo)
+        dp = Dispatcher()
+        dp.include_router(router)
+        bot = Bot("123:test")
+
+        async def handle_metrics(request: web.Request):
+            return web.Response(text=render_metrics(), content_type="text/plain")
+
+        app = web.Application()
+        handler = LimitedRequestHandler(
+            dispatcher=dp, bot=bot, secret_token=SECRET, max_concurrency=10
+        )
+        handler.register(app, path="/webhook")
+        app.router.add_get("/metrics", handle_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        try:
+            return await webhook_loadtest.replay(
+                webhook_loadtest.load_updates(path),
+                url=base + "/webhook",
+                metrics_url=base + "/metrics",
+                concurrency=20,
+                repeat=2,
+                secret=SECRET,
+                drain_timeout=30,
+            )
+        finally:
+            await handler.drain()
+            await runner.cleanup()
+            await bot.session.close()
+
+    result = asyncio.run(scenario())
+    assert result["statuses"] == {200: UPDATES * 2}
+    assert not result["in_flight"]
+
+    buckets = result["handlers"]["loadtest_echo"]
+    assert buckets[float("inf")] == UPDATES * 2
+    # Точность — корзина гистограммы: 0.02 с попадает в (0.01, 0.025]
+    assert webhook_loadtest.histogram_quantile(0.5, buckets) > 0.01
+    assert buckets[0.01] == 0
+    assert "loadtest_echo: 400 вызовов" in webhook_loadtest.format_report(result)
@@ -0,0 +1,239 @@
+"""
+Проверка оплат (payment.py) и клиента ЮMoney против локальной заглушки
+(yoomoney_stub.py): выгрузка истории окнами и страницами, ошибки API,
+откат сверки на проверку по меткам, circuit breaker и лимит
+одновременных запросов.
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+from aiohttp import web
+
+import payment
+import tasks
+import yoomoney_client
+from payment import check_yoomoney_payment, check_yoomoney_payments, fetch_paid_labels
+from yoomoney_client import (
+    CircuitBreaker,
+    CircuitOpenError,
+    YooMoneyClient,
+    YooMoneyError,
+)
+from yoomoney_stub import YooMoneyStub
+
+TOKEN = "stub-token"
+
+
+async def start_stub(stub: YooMoneyStub, **client_kwargs):
+    """Запускает заглушку и регистрирует клиент TOKEN, смотрящий на нее"""
+    runner = web.AppRunner(stub.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    yoomoney_client._clients[TOKEN] = YooMoneyClient(
+        TOKEN, base_url=f"http://127.0.0.1:{port}/api/", **client_kwargs
+    )
+    return runner
+
+
+async def stop_stub(runner):
+    await yoomoney_client.close_clients()
+    await runner.cleanup()
+
+
+def test_fetch_paid_labels_windows_and_pages(monkeypatch):
+    """
+    Платежи за три дня выгружаются окнами по суткам и страницами: в итог
+    попадают все метки периода и ни одной более старой, последнее окно
+    открыто (без till).
+    """
+    monkeypatch.setattr(payment, "HISTORY_PAGE_SIZE", 40)
+    now = datetime.now(timezone.utc)
+    stub = YooMoneyStub()
+    labels = {f"label-{n}" for n in range(250)}
+    for n, label in enumerate(sorted(labels)):
+        stub.pay(label, 100, when=now - timedelta(minutes=15 * n + 1))
+    stub.pay("too-old", 100, when=now - timedelta(days=5))
+
+    async def scenario():
+        runner = await start_stub(stub)
+        try:
+            return await fetch_paid_labels(
+                TOKEN,
+                now - timedelta(days=3) + timedelta(minutes=1),
+                window=timedelta(days=1),
+            )
+        finally:
+            await stop_stub(runner)
+
+    assert asyncio.run(scenario()) == labels
+    assert len({request["from"] for request in stub.requests}) == 3
+    assert any("start_record" in request for request in stub.requests)
+    assert "till" not in stub.requests[-1]
+
+
+def test_fetch_paid_labels_rejects_response_without_operations():
+    stub = YooMoneyStub()
+    stub.fail(status=200)
+
+    async def scenario():
+        runner = await start_stub(stub)
+        try:
+            with pytest.raises(YooMoneyError):
+                await fetch_paid_labels(TOKEN, datetime.now(timezone.utc))
+        finally:
+            await stop_stub(runner)
+
+    asyncio.run(scenario())
+
+
+def test_check_payment_results():
+    """True — оплачен, False — не найден, None — ЮMoney не ответил толком"""
+    stub = YooMoneyStub()
+    stub.pay("paid", 100)
+
+    async def scenario():
+        runner = await start_stub(stub)
+        try:
+            assert await check_yoomoney_payment(TOKEN, "paid") is True
+            assert await check_yoomoney_payment(TOKEN, "unknown") is False
+            stub.fail(status=500)
+            assert await check_yoomoney_payment(TOKEN, "paid") is None
+            stub.fail(status=200)
+            assert await check_yoomoney_payment(TOKEN, "paid") is None
+            stub.fail(status=200, payload={"error": "illegal_param_label"})
+            assert await check_yoomoney_payment(TOKEN, "paid") is None
+
+            stub.fail(status=500)
+            paid, unknown = await check_yoomoney_payments(TOKEN, ["paid"])
+            assert (paid, unknown) == (set(), {"paid"})
+            paid, unknown = await check_yoomoney_payments(TOKEN, ["paid", "unknown"])
+            assert (paid, unknown) == ({"paid"}, set())
+        finally:
+            await stop_stub(runner)
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("failed_requests", [1, 100])
+def test_reconcile_falls_back_to_label_checks(temp_db, monkeypatch, failed_requests):
+    """
+    Выгрузка истории упала — сверка проверяет счета по меткам. Оплаченный
+    зачисляется, ненайденный откладывается; если ЮMoney не ответил и на
+    проверку по метке, счет не откладывается (и не уйдет в архив).
+    """
+    monkeypatch.setattr(tasks, "YOOMONEY_TOKEN", TOKEN)
+    stub = YooMoneyStub()
+    stub.pay("paid", 100)
+    stub.fail(times=failed_requests)
+
+    async def scenario():
+        runner = await start_stub(stub)
+        db = await temp_db.connect()
+        try:
+            await db.pool.execute("INSERT INTO users (user_id) VALUES (1), (2)")
+            await db.create_payment(1, Decimal(100), "paid")
+            await db.create_payment(2, Decimal(100), "unpaid")
+
+            await tasks.reconcile_payments(db, None)
+
+            rows = await db.pool.fetch(
+                "SELECT label, is_paid, last_checked_at FROM payments"
+            )
+            return {row["label"]: row for row in rows}
+        finally:
+            await db.pool.close()
+            await stop_stub(runner)
+
+    payments = asyncio.run(scenario())
+    if failed_requests == 1:
+        assert payments["paid"]["is_paid"]
+        assert payments["unpaid"]["last_checked_at"] is not None
+    else:
+        assert not payments["paid"]["is_paid"]
+        assert payments["paid"]["last_checked_at"] is None
+        assert payments["unpaid"]["last_checked_at"] is None
+
+
+RESET_TIMEOUT = 0.3
+
+
+def test_circuit_breaker_cycle():
+    """
+    Серия сбоев открывает breaker: запросы не уходят в ЮMoney. Через
+    reset_timeout пропускается ровно один пробный; его сбой (в том числе
+    непредвиденный ответ) снова открывает breaker, успех — закрывает.
+    """
+    stub = YooMoneyStub()
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=RESET_TIMEOUT)
+
+    async def history():
+        return await yoomoney_client.get_client(TOKEN).operation_history(records=1)
+
+    async def scenario():
+        runner = await start_stub(stub, breaker=breaker)
+        try:
+            stub.fail(times=3)
+            for _ in range(3):
+                with pytest.raises(Exception):
+                    await history()
+            assert breaker.state == "open"
+            with pytest.raises(CircuitOpenError):
+                await history()
+            assert len(stub.requests) == 3
+
+            # Пробный запрос упал на ответе не того формата — снова open
+            await asyncio.sleep(RESET_TIMEOUT)
+            assert breaker.state == "half_open"
+            stub.fail(status=200, payload=[])
+            with pytest.raises(YooMoneyError):
+                await history()
+            assert breaker.state == "open"
+
+            # Пробный запрос отменили — следующий снова может стать пробным
+            await asyncio.sleep(RESET_TIMEOUT)
+            stub.delay = 0.2
+            probe = asyncio.create_task(history())
+            await asyncio.sleep(0.05)
+            probe.cancel()
+            await asyncio.gather(probe, return_exceptions=True)
+            assert breaker.state == "half_open"
+
+            # Пока пробный запрос в пути, остальные отклоняются
+            requests_before = len(stub.requests)
+            results = await asyncio.gather(
+                *(history() for _ in range(5)), return_exceptions=True
+            )
+            assert len(stub.requests) == requests_before + 1
+            assert sum(isinstance(r, CircuitOpenError) for r in results) == 4
+            assert breaker.state == "closed"
+            stub.delay = 0
+            await history()
+        finally:
+            await stop_stub(runner)
+
+    asyncio.run(scenario())
+
+
+def test_client_concurrency_limit():
+    """Одновременно в ЮMoney уходит не больше concurrency запросов"""
+    stub = YooMoneyStub()
+    stub.delay = 0.1
+
+    async def scenario():
+        runner = await start_stub(stub, concurrency=3)
+        try:
+            paid, unknown = await check_yoomoney_payments(
+                TOKEN, [f"label-{n}" for n in range(12)]
+            )
+            assert (paid, unknown) == (set(), set())
+        finally:
+            await stop_stub(runner)
+
+    asyncio.run(scenario())
+    assert len(stub.requests) == 12
+    assert stub.max_in_flight == 3